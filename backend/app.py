@@ -4,18 +4,38 @@ import logging
 import random
 from datetime import datetime, timedelta, timezone
 from functools import wraps
+from contextlib import contextmanager
 import time # <<< ADDED >>>
 import json # <<< ADDED >>>
+import threading
+import mimetypes
 from flask import Flask, request, jsonify, send_from_directory, Response, make_response # <<< MODIFIED (Added make_response) >>>
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError
 from dotenv import load_dotenv
 from bson import ObjectId
 from bson.errors import InvalidId
 import requests
+from ranking_stream import RankingBroadcaster, RankingLedger, parse_event_ids, stream_sources
+from user_events import UserEventHub
+from cache import TTLCache, create_shared_cache
+from ranking_writer import RankingWriteBuffer
+from json_provider import init_json
+from pagination import InvalidCursor, KEYSET_SORT, encode_cursor, fetch_keyset_page
+from uploads import ResumableUploadStore, UploadPolicy, UploadRejected, UploadRequest, commit_upload, new_temp_path, remove_stale_temp_files
+from blob_store import BlobStore
+from avatar_images import AvatarImageError, images_supported, ranking_avatar_url, remove_avatar_variants, render_avatar_variants, sanitize_avatar
+from job_queue import JobQueue
+from file_offload import FileOffload
+from static_assets import ENCODING_SUFFIXES, AssetManifest, choose_encoding
+from password_hashing import DEFAULT_METHOD as DEFAULT_PASSWORD_HASH_METHOD, HashingBusy, KeyedLimiter, PasswordHasher
+from roster_import import RosterFormatError, iter_roster_rows, roster_format
+from token_claims import TokenRevocations
+from gemini_client import DEFAULT_BASE_URL as GEMINI_DEFAULT_BASE_URL, GeminiBusy, GeminiClient, chunk_text
+from video_transcode import VIDEO_EXTENSIONS, TranscodeError, remove_video_rendition, render_video_rendition, transcoding_supported
+from werkzeug.exceptions import NotFound, RequestedRangeNotSatisfiable, RequestEntityTooLarge
 
 # --- Setup logging ---
 log_dir = 'backend/logs'
@@ -43,6 +63,15 @@ JWT_SECRET = os.getenv("JWT_SECRET")
 MONGO_URI = os.getenv("MONGO_URI")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 PORT = int(os.getenv("PORT", 5001))
+REDIS_URL = os.getenv("REDIS_URL") # Optional: shared cache/invalidation bus across processes
+# Waitress has no async I/O: every open Server-Sent Events stream holds one request thread until the
+# tab closes. A tab opens one stream (/api/events/stream: rankings + its user's events), so a class of
+# ~40 signed-in students needs ~40 threads per process. An idle stream thread is cheap: it sleeps on
+# an Event (heartbeat every 15 s) and costs its stack (~64 KB resident) plus a small queue.
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", 64)) # Request threads: SSE_MAX_STREAMS for streams, the rest for REST
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", max(1, WAITRESS_THREADS - 16))) # Open streams per process; beyond it 503 + polling
+JWT_CLAIMS = os.getenv("JWT_CLAIMS", "").lower() in ('1', 'true', 'yes') # Opt-in: tokens carry name/email so identity_required routes skip db.users
+TOKEN_EXPIRY_DAYS = 7
 
 # --- Environment Variable Checks ---
 if not MONGO_URI: logger.critical("CRITICAL: MONGO_URI not set."); raise SystemExit("MONGO_URI not set")
@@ -51,15 +80,20 @@ if not GEMINI_API_KEY: logger.warning("WARNING: GEMINI_API_KEY not set. Chatbot
 
 # --- Initialize Flask app ---
 app = Flask(__name__, static_folder='../frontend', static_url_path='')
+app.request_class = UploadRequest # Lets upload views stream file parts straight to disk (see uploads.py)
+# Serialize ObjectId/datetime during encoding so handlers can return raw PyMongo documents
+init_json(app)
 
 # Configure CORS to allow requests from any origin
 CORS(app,
      resources={r"/*": {
          "origins": "*",
          "allow_headers": ["Content-Type", "Authorization", "Access-Control-Allow-Origin",
-                          "Access-Control-Allow-Methods", "Access-Control-Allow-Headers"],
-         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-         "expose_headers": ["Content-Type", "Authorization"]
+                          "Access-Control-Allow-Methods", "Access-Control-Allow-Headers", "Upload-Offset"],
+         "methods": ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+         # Response headers the frontend reads: resumable uploads, keyset pagination, ranking and analytics freshness
+         "expose_headers": ["Content-Type", "Authorization", "Location", "Upload-Offset", "Upload-Length", "Upload-Expires",
+                            "X-Next-Cursor", "X-Ranking-Version", "Age", "X-Analytics-Generated-At"]
      }},
      supports_credentials=True)
 logger.info("Flask app initialized with CORS (all methods and origins allowed)")
@@ -91,8 +125,71 @@ except ConnectionFailure as e:
 except Exception as e:
     logger.critical(f"CRITICAL: MongoDB connection error: {e}"); raise SystemExit(f"MongoDB connection failed: {e}")
 
-# --- Gemini API endpoint ---
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent"
+# --- Gemini API client (see gemini_client.py) ---
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash-latest")
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", GEMINI_DEFAULT_BASE_URL) # e.g. a local stub for testing
+GEMINI_MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", 3)) # Chat calls in flight per process (each holds a request thread)
+gemini = GeminiClient(GEMINI_API_KEY, GEMINI_MODEL, GEMINI_API_BASE, max_concurrent=GEMINI_MAX_CONCURRENT,
+                      read_timeout=int(os.getenv("GEMINI_READ_TIMEOUT", 45)))
+
+# --- Password hashing (see password_hashing.py) ---
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", DEFAULT_PASSWORD_HASH_METHOD) # Hashes made otherwise are upgraded at login
+# Every admitted hash holds its Waitress request thread until it is done, so WORKERS + QUEUE is how many
+# request threads sign-ins may take; the defaults keep it at half of the threads not reserved for SSE
+# streams (4 + 4 of 16), leaving the rest to other endpoints. Callers beyond it get a 503 after
+# PASSWORD_HASH_WAIT seconds.
+REST_THREADS = max(1, WAITRESS_THREADS - SSE_MAX_STREAMS)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", max(1, min(4, os.cpu_count() or 1, REST_THREADS // 4)))) # Hashes computed at once
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", max(0, REST_THREADS // 2 - PASSWORD_HASH_WORKERS))) # Hashes waiting for a worker before callers get 503
+PASSWORD_HASH_WAIT = float(os.getenv("PASSWORD_HASH_WAIT", 0.5)) # Seconds a request waits for admission
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", 5)) # Seconds an admitted request waits for its hash
+PASSWORD_HASH_PER_ACCOUNT = int(os.getenv("PASSWORD_HASH_PER_ACCOUNT", 2)) # Concurrent login/register/change per email
+PASSWORD_HASH_PER_IP = int(os.getenv("PASSWORD_HASH_PER_IP", 10)) # Per client IP; a classroom often shares one NAT address
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_QUEUE,
+                                 wait_timeout=PASSWORD_HASH_WAIT, result_timeout=PASSWORD_HASH_TIMEOUT)
+hashing_per_account = KeyedLimiter(PASSWORD_HASH_PER_ACCOUNT)
+hashing_per_ip = KeyedLimiter(PASSWORD_HASH_PER_IP)
+
+@contextmanager
+def password_hash_slot(account):
+    # Admission for views that hash: yields False when this account or client IP is already at its limit
+    client_ip = request.remote_addr or 'unknown'
+    if not hashing_per_account.acquire(account):
+        yield False
+        return
+    if not hashing_per_ip.acquire(client_ip):
+        hashing_per_account.release(account)
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        hashing_per_ip.release(client_ip)
+        hashing_per_account.release(account)
+
+def hashing_busy_response(queue_full=False):
+    # 503 when the whole hashing queue is full, 429 when this account/IP has too many in flight
+    if queue_full:
+        logger.warning("Password hashing queue full; request rejected")
+        response = jsonify({'message': 'The server is busy signing people in. Please try again in a few seconds.'})
+        response.status_code = 503
+    else:
+        response = jsonify({'message': 'Too many sign-in attempts in progress. Please wait a moment and try again.'})
+        response.status_code = 429
+    response.headers['Retry-After'] = '2'
+    return response
+
+def upgrade_password_hash(user, password):
+    # After a successful login: re-hash with PASSWORD_HASH_METHOD if the stored hash uses another method/cost
+    if not password_hasher.needs_rehash(user['password']):
+        return
+    try:
+        new_hash = password_hasher.hash(password)
+    except HashingBusy:
+        return # Next login tries again
+    # Conditional on the old hash, so a password changed meanwhile isn't overwritten
+    db.users.update_one({'_id': user['_id'], 'password': user['password']}, {'$set': {'password': new_hash}})
+    logger.info(f"Password hash of user {user['_id']} upgraded to {password_hasher.method}")
 
 # --- Upload Folders Setup ---
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -107,12 +204,39 @@ MAX_SUBMISSION_SIZE = 50 * 1024 * 1024 # 50MB
 
 os.makedirs(UPLOAD_FOLDER_AVATARS, exist_ok=True)
 os.makedirs(UPLOAD_FOLDER_SUBMISSIONS, exist_ok=True)
+# Largest request body accepted at all: Werkzeug refuses bigger bodies from Content-Length, before reading them
+UPLOAD_FORM_OVERHEAD = 1 * 1024 * 1024 # Multipart headers + form fields around the file
+app.config['MAX_CONTENT_LENGTH'] = MAX_SUBMISSION_SIZE + UPLOAD_FORM_OVERHEAD
+# Partial uploads abandoned by a crashed or restarted worker
+remove_stale_temp_files(UPLOAD_FOLDER_SUBMISSIONS)
+# Resumable uploads: partial files kept on disk, expired after RESUMABLE_UPLOAD_TTL seconds without progress
+RESUMABLE_UPLOAD_TTL = int(os.getenv("RESUMABLE_UPLOAD_TTL", 24 * 3600))
+resumable_uploads = ResumableUploadStore(UPLOAD_FOLDER_SUBMISSIONS, ttl=RESUMABLE_UPLOAD_TTL)
+resumable_uploads.start_janitor(interval=int(os.getenv("RESUMABLE_JANITOR_INTERVAL", 600)))
+remove_stale_temp_files(UPLOAD_FOLDER_AVATARS)
 logger.info(f"Upload folders checked/created.")
 
 # Verify frontend assets directory exists
 if not os.path.exists(ASSETS_DIR):
     logger.warning(f"Frontend assets directory not found at {ASSETS_DIR}")
 
+# --- File download offload (see file_offload.py) ---
+# Unset: files are streamed by Flask. 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd): views only
+# authorize and the proxy sends the bytes, so long downloads don't hold Waitress threads
+FILE_OFFLOAD = os.getenv("FILE_OFFLOAD")
+FILE_OFFLOAD_PREFIX = os.getenv("FILE_OFFLOAD_PREFIX", "/_protected/") # nginx internal location aliasing the project root
+file_offload = FileOffload(FILE_OFFLOAD, os.path.dirname(BASE_DIR), FILE_OFFLOAD_PREFIX)
+if file_offload.enabled:
+    # Frontend files (static folder, incl. /assets) are offloaded as well
+    def serve_static_offloaded(filename):
+        return file_offload.response(app.static_folder, filename)
+    app.view_functions['static'] = serve_static_offloaded
+    logger.info(f"File downloads offloaded to the proxy ({file_offload.mode})")
+
+# --- Frontend assets build (see static_assets.py; run it on deploy) ---
+ASSET_BUILD_DIR = os.getenv("ASSET_BUILD_DIR", os.path.join(BASE_DIR, 'build', 'assets'))
+asset_manifest = AssetManifest(ASSET_BUILD_DIR)
+
 # --- Helper Functions ---
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
@@ -128,10 +252,103 @@ def stringify_ids(data):
     else:
         return data
 
+# --- Shared cache (Redis if REDIS_URL is set, otherwise in-process memory) ---
+shared_cache = create_shared_cache(REDIS_URL)
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", 300)) # Seconds course/flashcard lists are cached
+
+def get_cached_catalog(name, loader):
+    # Read-mostly lists (courses, flashcards) are cached for all processes; `loader` runs on a miss
+    key = f"catalog:{name}"
+    value = shared_cache.get(key)
+    if value is None:
+        value = loader()
+        shared_cache.set(key, value, ttl=CATALOG_CACHE_TTL)
+    return value
+
+# --- List pagination ---
+LISTING_COUNT_TTL = int(os.getenv("LISTING_COUNT_TTL", 30)) # Seconds a filtered list total is reused
+
+def count_listing(collection, query, mode='estimate'):
+    # Totals for list endpoints. Returns (total, exact) or (None, False) when mode is 'none'.
+    # 'estimate': collection metadata when unfiltered, otherwise a briefly cached count_documents
+    if mode == 'none':
+        return None, False
+    if mode == 'exact':
+        return collection.count_documents(query), True
+    if not query:
+        return collection.estimated_document_count(), False
+    key = f"count:{collection.name}:{json.dumps(query, sort_keys=True, default=str)}"
+    total = shared_cache.get(key)
+    if total is None:
+        total = collection.count_documents(query)
+        shared_cache.set(key, total, ttl=LISTING_COUNT_TTL)
+    return total, False
+
+def paginate_listing(collection, query, default_limit=10, max_limit=100):
+    # Reads one newest-first page of `collection` for the current request.
+    # ?cursor=<token> (empty for the first page) uses keyset pagination; otherwise ?page=N as before.
+    # ?count=exact|estimate|none picks how `total` is computed (default: none with cursors, estimate with pages).
+    # Raises InvalidCursor for a malformed cursor.
+    try: limit = int(request.args.get('limit', default_limit))
+    except ValueError: limit = default_limit
+    limit = max(1, min(limit, max_limit)) # Clamp limit
+    use_cursor = 'cursor' in request.args
+    count_mode = request.args.get('count', 'none' if use_cursor else 'estimate').lower()
+    if count_mode not in ('exact', 'estimate', 'none'):
+        count_mode = 'estimate'
+
+    if use_cursor:
+        rows, next_cursor = fetch_keyset_page(collection, query, limit, request.args.get('cursor') or None)
+        result = {'rows': rows, 'limit': limit, 'nextCursor': next_cursor, 'hasMore': next_cursor is not None}
+    else:
+        try: page = int(request.args.get('page', 1))
+        except ValueError: page = 1
+        page = max(1, page)
+        # One extra row tells whether another page exists
+        rows = list(collection.find(query).sort(KEYSET_SORT).skip((page - 1) * limit).limit(limit + 1))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        # Lets page-mode clients switch to cursors for the following pages
+        next_cursor = encode_cursor(rows[-1]) if has_more else None
+        result = {'rows': rows, 'limit': limit, 'page': page, 'nextCursor': next_cursor, 'hasMore': has_more}
+
+    total, exact = count_listing(collection, query, count_mode)
+    if total is not None:
+        result['total'] = total
+        result['totalExact'] = exact
+        if not use_cursor:
+            result['totalPages'] = (total + limit - 1) // limit
+    return result
+
+# --- Authenticated user cache ---
+# token_required serves request.current_user from here instead of querying db.users on every call
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 30)) # Seconds a cached user context stays valid
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 5000)) # Max cached users (least recently used evicted)
+user_context_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, name='user_context')
+
+def invalidate_user_cache(user_id):
+    # Call after every write to a users document so the next request reloads it
+    user_context_cache.delete(str(user_id))
+    # Other processes drop their copy when the message arrives on the invalidation bus
+    if shared_cache.distributed:
+        shared_cache.publish('user', str(user_id))
+
+def _on_cache_invalidation(namespace, key):
+    if namespace == 'user' and key:
+        user_context_cache.delete(key)
+
+shared_cache.subscribe(_on_cache_invalidation)
+
+# --- Per-user push events (see user_events.py); streamed by /api/events/stream ---
+user_events = UserEventHub(shared_cache)
+
+NOTIFICATION_READ_TTL_DAYS = int(os.getenv("NOTIFICATION_READ_TTL_DAYS", 30)) # Read notifications are deleted this many days after being read
+ROSTER_IMPORT_REPORT_TTL_DAYS = int(os.getenv("ROSTER_IMPORT_REPORT_TTL_DAYS", 7)) # Finished import reports are kept this long
+
 # --- Ensure collections and indexes ---
 def ensure_db_setup():
     # Collections
-    required_collections = ['users', 'courses', 'rankings', 'flashcards', 'challenges', 'learning_path', 'submissions', 'feedback', 'daily_challenges']
+    required_collections = ['users', 'courses', 'rankings', 'flashcards', 'challenges', 'learning_path', 'submissions', 'feedback', 'daily_challenges', 'analytics_snapshots', 'blobs', 'jobs', 'notifications', 'notification_counts']
     existing_collections = db.list_collection_names()
     for coll_name in required_collections:
         if coll_name not in existing_collections:
@@ -145,6 +362,7 @@ def ensure_db_setup():
         # users collection
         db.users.create_index([("email", 1)], unique=True, name="email_unique")
         db.users.create_index([("points", -1)], name="user_points_desc") # For potential internal sorting
+        db.users.create_index([("tokenVersionChangedAt", 1)], sparse=True, name="user_token_version_changed") # Revocation refresh
 
         # courses collection
         db.courses.create_index([("category", 1)], name="course_category")
@@ -159,6 +377,7 @@ def ensure_db_setup():
 
         # challenges collection
         db.challenges.create_index([("createdAt", -1)], name="challenge_created_desc")
+        db.challenges.create_index([("createdAt", -1), ("_id", -1)], name="challenge_created_id") # Keyset pagination
 
         # learning_path collection
         db.learning_path.create_index([("order", 1)], name="learningpath_order")
@@ -166,9 +385,25 @@ def ensure_db_setup():
         # submissions collection
         db.submissions.create_index([("userId", 1), ("createdAt", -1)], name="submission_user_created")
         db.submissions.create_index([("status", 1), ("type", 1)], name="submission_status_type") # For filtering by status/type
+        # Keyset pagination (createdAt, _id): unfiltered teacher queue and status-filtered review queue
+        db.submissions.create_index([("createdAt", -1), ("_id", -1)], name="submission_created_id")
+        db.submissions.create_index([("status", 1), ("createdAt", -1), ("_id", -1)], name="submission_status_created_id")
+        db.submissions.create_index([("sha256", 1)], name="submission_sha256") # Submissions sharing a blob (renditions)
+        db.submissions.create_index([("url", 1), ("userId", 1)], name="submission_url_user") # File serving authorization
 
         # feedback collection
         db.feedback.create_index([("createdAt", -1)], name="feedback_created_desc")
+        db.feedback.create_index([("userId", 1), ("createdAt", -1), ("_id", -1)], name="feedback_user_created_id") # Students' own feedback, keyset pages
+
+        # blobs collection (content-addressed uploads; _id is '<namespace>:<sha256>')
+        db.blobs.create_index([("namespace", 1), ("refs", 1), ("releasedAt", 1)], name="blob_gc") # Unreferenced-blob sweep
+
+        # notifications collection (inbox; unread totals live in notification_counts)
+        db.notifications.create_index([("userId", 1), ("read", 1), ("createdAt", -1), ("_id", -1)], name="notification_user_read_created") # Inbox keyset pages, unread filter
+        db.notifications.create_index([("readAt", 1)], expireAfterSeconds=NOTIFICATION_READ_TTL_DAYS * 86400, name="notification_read_ttl") # Only read ones have readAt
+
+        # roster_imports collection (progress and report of POST /api/users/import)
+        db.roster_imports.create_index([("finishedAt", 1)], expireAfterSeconds=ROSTER_IMPORT_REPORT_TTL_DAYS * 86400, name="roster_import_finished_ttl")
 
         logger.info("MongoDB indexes checked/ensured.")
     except Exception as e:
@@ -176,8 +411,64 @@ def ensure_db_setup():
 # Run setup on startup
 ensure_db_setup()
 
+# --- Token revocation (see token_claims.py) ---
+TOKEN_REVOCATION_REFRESH = int(os.getenv("TOKEN_REVOCATION_REFRESH", 30)) # Seconds between revocation map refreshes
+token_revocations = TokenRevocations(db.users, shared_cache, refresh_interval=TOKEN_REVOCATION_REFRESH)
+token_revocations.start()
+
+def issue_token(user):
+    # JWT for `user` (a users document or request.current_user); carries the user's tokenVersion
+    now = datetime.now(timezone.utc)
+    payload = {'id': str(user['_id']), 'role': user['role'], 'tokenVersion': user.get('tokenVersion') or 0,
+               'iat': now, 'exp': now + timedelta(days=TOKEN_EXPIRY_DAYS)}
+    if JWT_CLAIMS:
+        # Everything identity_required routes read from request.current_user
+        payload.update(name=user.get('name'), email=user.get('email'))
+    return pyjwt.encode(payload, JWT_SECRET, algorithm="HS256")
+
+def revoke_user_tokens(user_id):
+    # Invalidates every token issued to the user so far; returns the updated user (None if not found)
+    user_id_obj = user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+    user = db.users.find_one_and_update(
+        {'_id': user_id_obj},
+        {'$inc': {'tokenVersion': 1}, '$set': {'tokenVersionChangedAt': datetime.now(timezone.utc)}},
+        projection={'password': 0}, return_document=ReturnDocument.AFTER)
+    if user is not None:
+        token_revocations.announce(user_id_obj, user['tokenVersion'])
+        invalidate_user_cache(user_id_obj)
+    return user
+
+# --- Background jobs (see job_queue.py); handlers are registered next to the code they belong to ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2)) # Worker threads per process; 0 = only enqueue
+job_queue = JobQueue(db.jobs, workers=JOB_WORKERS,
+                     visibility_timeout=int(os.getenv("JOB_VISIBILITY_TIMEOUT", 300)),
+                     max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", 5)))
+try:
+    job_queue.ensure_indexes()
+except Exception as e:
+    logger.error(f"Error ensuring job queue indexes: {e}")
+
+# --- Content-addressed upload storage (see blob_store.py) ---
+# Identical files are stored once; `sha256` on submissions / `avatarBlob` on users hold the references
+BLOB_GC_GRACE = int(os.getenv("BLOB_GC_GRACE", 3600)) # Seconds an unreferenced file is kept
+# Web renditions (small H.264 MP4 + poster JPEG) of video submissions, transcoded off the request thread
+SUBMISSION_RENDITIONS_DIR = os.path.join(UPLOAD_FOLDER_SUBMISSIONS, 'renditions')
+SUBMISSION_RENDITIONS_URL = '/uploads/submissions/renditions'
+FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT", 240)) # Per ffmpeg run; keep below JOB_VISIBILITY_TIMEOUT
+submission_blobs = BlobStore(os.path.join(UPLOAD_FOLDER_SUBMISSIONS, 'blobs'), db.blobs, 'submission',
+                             '/uploads/submissions/blobs', gc_grace=BLOB_GC_GRACE,
+                             on_delete=lambda sha256: remove_video_rendition(SUBMISSION_RENDITIONS_DIR, sha256))
+# Avatar thumbnails (48/96/192px WebP + fallback), rendered off the request thread
+AVATAR_VARIANTS_DIR = os.path.join(UPLOAD_FOLDER_AVATARS, 'variants')
+AVATAR_VARIANTS_URL = '/uploads/avatars/variants'
+avatar_blobs = BlobStore(os.path.join(UPLOAD_FOLDER_AVATARS, 'blobs'), db.blobs, 'avatar',
+                         '/uploads/avatars/blobs', gc_grace=BLOB_GC_GRACE,
+                         on_delete=lambda sha256: remove_avatar_variants(AVATAR_VARIANTS_DIR, sha256))
+submission_blobs.start_gc()
+avatar_blobs.start_gc()
+
 # --- Token Middleware ---
-def token_required(f):
+def token_required(f, claims_only=False):
     @wraps(f)
     def decorated(*args, **kwargs):
         if request.method == 'OPTIONS':
@@ -197,14 +488,28 @@ def token_required(f):
             user_id = data.get('id')
             if not user_id or not ObjectId.is_valid(user_id):
                 return jsonify({'message': 'Invalid token payload'}), 401
-
-            # Fetch user details from DB, excluding password
-            user_info = db.users.find_one({'_id': ObjectId(user_id)}, {'password': 0})
-            if not user_info:
-                return jsonify({'message': 'User not found'}), 401
-
-            # Stringify ObjectIds before attaching to request
-            request.current_user = stringify_ids(user_info)
+            if not token_revocations.is_valid(user_id, data.get('tokenVersion')):
+                return jsonify({'message': 'Token has been revoked'}), 401
+
+            if claims_only and JWT_CLAIMS and 'email' in data:
+                # Identity from the (signed, unrevoked) claims; no users lookup
+                request.current_user = {'_id': user_id, 'role': data.get('role'),
+                                        'name': data.get('name'), 'email': data.get('email')}
+                return f(*args, **kwargs)
+
+            # Use the cached user context unless it was cached before this token was issued
+            cached_user = user_context_cache.get(user_id, min_stored_at=data.get('iat'))
+            if cached_user is None:
+                # Fetch user details from DB, excluding password
+                user_info = db.users.find_one({'_id': ObjectId(user_id)}, {'password': 0})
+                if not user_info:
+                    return jsonify({'message': 'User not found'}), 401
+                # Stringify ObjectIds once, when caching
+                cached_user = stringify_ids(user_info)
+                user_context_cache.set(user_id, cached_user)
+
+            # Copy so handlers can modify request.current_user without touching the cache
+            request.current_user = dict(cached_user)
 
         except pyjwt.ExpiredSignatureError:
             return jsonify({'message': 'Token has expired'}), 401
@@ -217,6 +522,12 @@ def token_required(f):
         return f(*args, **kwargs)
     return decorated
 
+def identity_required(f):
+    # token_required for routes that only read _id, role, name and email from request.current_user:
+    # with JWT_CLAIMS those come from the token itself (name/email may lag a profile edit until the
+    # token is refreshed). Other tokens, or JWT_CLAIMS off, behave exactly like token_required.
+    return token_required(f, claims_only=True)
+
 # --- Authorization Middleware ---
 def teacher_required(f):
     @wraps(f)
@@ -235,29 +546,74 @@ def teacher_required(f):
     return decorated
 
 # --- Helper: Update Ranking ---
+# Ranking upserts are coalesced per userId and written in batches (flushed on shutdown too)
+RANKING_FLUSH_INTERVAL = float(os.getenv("RANKING_FLUSH_INTERVAL", 0.5)) # Seconds
+RANKING_ROW_PROJECTION = {'_id': 1, 'name': 1, 'avatar': 1, 'avatarVariants': 1, 'points': 1, 'level': 1}
+
+def ranking_row_fields(user_data):
+    return {
+        'points': user_data.get('points', 0),
+        'name': user_data.get('name', 'Unknown'),
+        'avatar': ranking_avatar_url(user_data), # Small thumbnail once rendered
+        'level': user_data.get('level', 1)
+        # Add any other fields relevant to ranking display
+    }
+
+def load_ranking_rows(user_id_strs):
+    # Ranking fields of these students as stored now: read at flush time, so the newest values are written
+    # even when two requests queued theirs out of order
+    user_ids = [ObjectId(user_id_str) for user_id_str in user_id_strs if ObjectId.is_valid(user_id_str)]
+    students = db.users.find({'_id': {'$in': user_ids}, 'role': 'student'}, RANKING_ROW_PROJECTION)
+    return {str(student['_id']): ranking_row_fields(student) for student in students}
+
+ranking_write_buffer = RankingWriteBuffer(db.rankings, load_rows=load_ranking_rows, flush_interval=RANKING_FLUSH_INTERVAL)
+
 def _update_user_ranking(user_id_str, user_data):
      # Only update rankings for students
+     # Any ranking-relevant change is also a change to the cached user context
+     invalidate_user_cache(user_id_str)
      if not user_data or user_data.get('role') != 'student':
          return
 
      try:
-         # Use user_id_str which should already be stringified
-         db.rankings.update_one(
-             {'userId': user_id_str}, # Filter by the string representation of the user ID
-             {'$set': {
-                 'points': user_data.get('points', 0),
-                 'name': user_data.get('name', 'Unknown'),
-                 'avatar': user_data.get('avatar', ''),
-                 'level': user_data.get('level', 1)
-                 # Add any other fields relevant to ranking display
-             }},
-             upsert=True # Create the ranking document if it doesn't exist
-         )
+         # Use user_id_str which should already be stringified; the row is re-read and upserted on flush
+         ranking_write_buffer.add(str(user_id_str), ranking_row_fields(user_data))
          # <<< MODIFIED >>>: Removed logging here, SSE polling logs changes detected
          # logger.info(f"Ranking data updated in DB for student {user_id_str}")
      except Exception as e:
           logger.error(f"Failed to update ranking for user {user_id_str}: {e}")
 
+# --- Helper: Award Points ---
+POINTS_PER_LEVEL = 100 # Same rule as update_user: level = points // 100 + 1
+# Only the fields the ranking row and callers need are returned from the award update
+AWARD_PROJECTION = {'_id': 1, 'role': 1, 'name': 1, 'avatar': 1, 'avatarVariants': 1, 'points': 1, 'level': 1, 'progress': 1}
+
+def award_points(user_id, points=0, progress=0):
+    # Atomically adds points/progress to a STUDENT, recomputes the level from the new points
+    # and returns the updated ranking fields (stringified) in a single round trip.
+    # Returns None if the user doesn't exist or isn't a student.
+    user_id_obj = user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+    updated_user = db.users.find_one_and_update(
+        {'_id': user_id_obj, 'role': 'student'},
+        [ # Update pipeline so the level can be derived from the incremented points server-side
+            {'$set': {
+                'points': {'$add': [{'$ifNull': ['$points', 0]}, points]},
+                'progress': {'$add': [{'$ifNull': ['$progress', 0]}, progress]}
+            }},
+            {'$set': {
+                'level': {'$max': [1, {'$toInt': {'$add': [{'$floor': {'$divide': ['$points', POINTS_PER_LEVEL]}}, 1]}}]}
+            }}
+        ],
+        projection=AWARD_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated_user:
+        return None
+    user_data = stringify_ids(updated_user)
+    # Also invalidates the cached user context
+    _update_user_ranking(user_data['_id'], user_data)
+    return user_data
+
 # --- Routes ---
 
 @app.route('/api/status', methods=['GET'])
@@ -273,7 +629,8 @@ def check_status():
         return jsonify({
             'status': 'Server is running',
             'mongodb_status': mongo_status,
-            'database_name': mongo_db_name
+            'database_name': mongo_db_name,
+            'ranking_write_buffer': ranking_write_buffer.stats()
         }), 200
     except Exception as e:
         logger.error(f"Status check failed: MongoDB connection error: {str(e)}")
@@ -283,55 +640,151 @@ def check_status():
             'error': str(e)
         }), 500
 
+# --- Teacher analytics ---
+ANALYTICS_SNAPSHOT_MAX_AGE = int(os.getenv("ANALYTICS_SNAPSHOT_MAX_AGE", 60)) # Seconds before the snapshot is recomputed
+ANALYTICS_SNAPSHOT_ID = 'teacher'
+
+def compute_teacher_analytics():
+    # One pass per collection instead of one scan per figure
+    user_stats = list(db.users.aggregate([
+        {'$match': {'role': 'student'}},
+        {'$group': {
+            '_id': None,
+            'studentCount': {'$sum': 1},
+            'avgPoints': {'$avg': '$points'},
+            'avgProgress': {'$avg': '$progress'}
+        }}
+    ]))
+    user_stats = user_stats[0] if user_stats else {}
+
+    submission_stats = list(db.submissions.aggregate([
+        {'$match': {'status': {'$in': ['pending', 'approved', 'rejected']}}}, # Served by the status index
+        {'$facet': {
+            'pending': [{'$match': {'status': 'pending', 'type': 'challenge'}}, {'$count': 'n'}],
+            'approved': [{'$match': {'status': 'approved'}}, {'$count': 'n'}],
+            'rejected': [{'$match': {'status': 'rejected'}}, {'$count': 'n'}]
+        }}
+    ]))[0]
+    facet_count = lambda name: submission_stats[name][0]['n'] if submission_stats[name] else 0
+
+    approved_submissions = facet_count('approved')
+    rejected_submissions = facet_count('rejected')
+    return {
+        'studentCount': user_stats.get('studentCount', 0),
+        'pendingSubmissions': facet_count('pending'),
+        'approvedCount': approved_submissions,
+        'rejectedCount': rejected_submissions,
+        'totalReviewed': approved_submissions + rejected_submissions,
+        'averagePoints': round(user_stats.get('avgPoints') or 0),
+        'averageProgress': round(user_stats.get('avgProgress') or 0)
+    }
+
+def refresh_analytics_snapshot(previous=None):
+    # Recomputes the shared snapshot from `previous` (the stored one, if any); returns the new document.
+    # Stored only if nothing expired the snapshot meanwhile: the figures may predate that change.
+    generation = previous.get('generation', 0) if previous else 0
+    snapshot = {'_id': ANALYTICS_SNAPSHOT_ID, 'data': compute_teacher_analytics(),
+                'generatedAt': datetime.now(timezone.utc), 'generation': generation}
+    if previous is None:
+        try:
+            db.analytics_snapshots.insert_one(snapshot)
+        except DuplicateKeyError:
+            pass # Another process stored one first
+    else:
+        result = db.analytics_snapshots.replace_one({'_id': ANALYTICS_SNAPSHOT_ID, 'generation': previous.get('generation')}, snapshot)
+        if result.matched_count == 0:
+            logger.info("Analytics snapshot expired during recompute; left stale for the next read")
+    return snapshot
+
+def expire_analytics_snapshot():
+    # Marks the snapshot stale after a change teachers expect to see (e.g. a review); recomputed on next read.
+    # The generation bump keeps a recompute that started before this change from storing its figures as fresh.
+    db.analytics_snapshots.update_one({'_id': ANALYTICS_SNAPSHOT_ID}, {'$set': {'stale': True}, '$inc': {'generation': 1}})
+
+def get_analytics_snapshot(force_refresh=False):
+    # Serves the materialized snapshot, recomputed on read once stale or older than ANALYTICS_SNAPSHOT_MAX_AGE.
+    # Only the holder of the refresh lease recomputes, also for `force_refresh`; the others keep serving the stored copy.
+    snapshot = db.analytics_snapshots.find_one({'_id': ANALYTICS_SNAPSHOT_ID})
+    if snapshot is not None:
+        generated_at = snapshot['generatedAt']
+        if generated_at.tzinfo is None:
+            generated_at = generated_at.replace(tzinfo=timezone.utc) # PyMongo returns naive UTC
+        snapshot['generatedAt'] = generated_at
+        age = (datetime.now(timezone.utc) - generated_at).total_seconds()
+        # Others keep serving the stale copy while the lease holder refreshes it
+        is_fresh = age < ANALYTICS_SNAPSHOT_MAX_AGE and not snapshot.get('stale') and not force_refresh
+        if is_fresh or not shared_cache.acquire_lock('analytics:refresh', ttl=30):
+            return snapshot
+        try:
+            return refresh_analytics_snapshot(snapshot)
+        finally:
+            shared_cache.release_lock('analytics:refresh')
+    return refresh_analytics_snapshot()
+
 @app.route('/api/teacher/analytics', methods=['GET'])
 @teacher_required
 def get_teacher_analytics():
     try:
-        # Count students
-        student_count = db.users.count_documents({'role': 'student'})
-
-        # Count pending submissions
-        pending_submissions = db.submissions.count_documents({'status': 'pending', 'type': 'challenge'})
-
-        # Count approved submissions
-        approved_submissions = db.submissions.count_documents({'status': 'approved'})
-
-        # Count rejected submissions
-        rejected_submissions = db.submissions.count_documents({'status': 'rejected'})
-
-        # Calculate total reviewed submissions
-        total_reviewed = approved_submissions + rejected_submissions
-
-        # Calculate average points for students
-        avg_points_result = list(db.users.aggregate([
-            {'$match': {'role': 'student'}},
-            {'$group': {'_id': None, 'avgPoints': {'$avg': '$points'}}}
-        ]))
-        avg_points = round(avg_points_result[0]['avgPoints']) if avg_points_result else 0
-
-        # Calculate average progress for students
-        avg_progress_result = list(db.users.aggregate([
-            {'$match': {'role': 'student'}},
-            {'$group': {'_id': None, 'avgProgress': {'$avg': '$progress'}}}
-        ]))
-        avg_progress = round(avg_progress_result[0]['avgProgress']) if avg_progress_result else 0
-
-        analytics_data = {
-            'studentCount': student_count,
-            'pendingSubmissions': pending_submissions,
-            'approvedCount': approved_submissions,
-            'rejectedCount': rejected_submissions,
-            'totalReviewed': total_reviewed,
-            'averagePoints': avg_points,
-            'averageProgress': avg_progress
-        }
-
-        logger.info(f"Teacher analytics fetched by {request.current_user['_id']}")
-        return jsonify(analytics_data)
+        force_refresh = request.args.get('refresh', '').lower() in ('1', 'true')
+        snapshot = get_analytics_snapshot(force_refresh=force_refresh)
+        age = max(0, int((datetime.now(timezone.utc) - snapshot['generatedAt']).total_seconds()))
+
+        logger.info(f"Teacher analytics fetched by {request.current_user['_id']} (snapshot age {age}s)")
+        response = jsonify(snapshot['data'])
+        # Staleness of the served figures
+        response.headers['Age'] = str(age)
+        response.headers['X-Analytics-Generated-At'] = snapshot['generatedAt'].isoformat()
+        return response
     except Exception as e:
         logger.error(f"Teacher analytics error: {e}", exc_info=True)
         return jsonify({'message': 'Server error fetching teacher analytics'}), 500
 
+def validate_registration(data):
+    # Registration rules shared by register and the roster import.
+    # Returns ((email, password, name, role), errors); errors is {} when the data is valid.
+    email = str(data.get('email') or '').strip().lower()
+    password = str(data.get('password') or '')
+    name = str(data.get('name') or '').strip()
+    role = str(data.get('role') or 'student').strip().lower() # Default to student
+
+    # --- Basic Validation ---
+    errors = {}
+    if not email: errors['email'] = 'Email is required'
+    elif '@' not in email or '.' not in email.split('@')[-1] or len(email.split('@')[-1].split('.')) < 2 : errors['email'] = 'Invalid email format'
+    if not password: errors['password'] = 'Password is required'
+    elif len(password) < 6: errors['password'] = 'Password must be at least 6 characters long'
+    if not name: errors['name'] = 'Name is required'
+    if role not in ['student', 'teacher']: errors['role'] = 'Invalid role specified'
+    return (email, password, name, role), errors
+
+def new_user_document(email, hashed_password, name, role):
+    # Default avatar (using ui-avatars)
+    default_avatar = f'https://ui-avatars.com/api/?name={secure_filename(name).replace("_", "+")}&background=random&color=fff&size=150'
+
+    # Create user document
+    user_doc = {
+        'email': email,
+        'password': hashed_password,
+        'name': name,
+        'role': role,
+        'progress': 0,
+        'points': 0,
+        'level': 1,
+        'badges': [],
+        'achievements': [],
+        'personalCourses': [], # Store as empty list of ObjectIds initially
+        'avatar': default_avatar,
+        'streak': 0, # Login streak
+        'lastLogin': None,
+        'createdAt': datetime.now(timezone.utc),
+        'flashcardProgress': {}, # Store flashcard progress { category: { card_id: state } }
+        'flashcardScore': 0 # Separate score for flashcards if needed
+    }
+    # Nullify student-specific fields for teachers
+    if role == 'teacher':
+        user_doc.update({k: None for k in ['progress', 'points', 'level', 'badges', 'streak', 'flashcardProgress', 'flashcardScore']})
+    return user_doc
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     try:
@@ -339,20 +792,7 @@ def register():
         if not data:
             return jsonify({'message': 'Invalid JSON payload'}), 400
 
-        email = data.get('email', '').strip().lower()
-        password = data.get('password', '')
-        name = data.get('name', '').strip()
-        role = data.get('role', 'student').lower() # Default to student
-
-        # --- Basic Validation ---
-        errors = {}
-        if not email: errors['email'] = 'Email is required'
-        elif '@' not in email or '.' not in email.split('@')[-1] or len(email.split('@')[-1].split('.')) < 2 : errors['email'] = 'Invalid email format'
-        if not password: errors['password'] = 'Password is required'
-        elif len(password) < 6: errors['password'] = 'Password must be at least 6 characters long'
-        if not name: errors['name'] = 'Name is required'
-        if role not in ['student', 'teacher']: errors['role'] = 'Invalid role specified'
-
+        (email, password, name, role), errors = validate_registration(data)
         if errors:
             return jsonify({'message': 'Validation failed', 'errors': errors}), 400
 
@@ -360,51 +800,30 @@ def register():
         if db.users.count_documents({'email': email}, limit=1) > 0:
             return jsonify({'message': 'Email already exists'}), 409 # 409 Conflict
 
-        # Hash password
-        hashed_password = generate_password_hash(password)
-
-        # Default avatar (using ui-avatars)
-        default_avatar = f'https://ui-avatars.com/api/?name={secure_filename(name).replace("_", "+")}&background=random&color=fff&size=150'
+        # Hash password (on the hashing pool)
+        with password_hash_slot(email) as admitted:
+            if not admitted:
+                return hashing_busy_response()
+            hashed_password = password_hasher.hash(password)
 
-        # Create user document
-        user_doc = {
-            'email': email,
-            'password': hashed_password,
-            'name': name,
-            'role': role,
-            'progress': 0,
-            'points': 0,
-            'level': 1,
-            'badges': [],
-            'achievements': [],
-            'personalCourses': [], # Store as empty list of ObjectIds initially
-            'avatar': default_avatar,
-            'streak': 0, # Login streak
-            'lastLogin': None,
-            'createdAt': datetime.now(timezone.utc),
-            'flashcardProgress': {}, # Store flashcard progress { category: { card_id: state } }
-            'flashcardScore': 0 # Separate score for flashcards if needed
-        }
-        # Nullify student-specific fields for teachers
-        if role == 'teacher':
-            user_doc.update({k: None for k in ['progress', 'points', 'level', 'badges', 'streak', 'flashcardProgress', 'flashcardScore']})
+        user_doc = new_user_document(email, hashed_password, name, role)
 
         # Insert user
         result = db.users.insert_one(user_doc)
         user_doc['_id'] = result.inserted_id # Keep as ObjectId for now
 
         # Generate JWT token
-        token_expiry = datetime.now(timezone.utc) + timedelta(days=7) # 7-day expiry
-        token_payload = {'id': str(user_doc['_id']), 'role': role, 'exp': token_expiry}
-        token = pyjwt.encode(token_payload, JWT_SECRET, algorithm="HS256")
+        token = issue_token(user_doc)
 
         logger.info(f"User registered: {email} (Role: {role}, ID: {user_doc['_id']})")
 
-        # Prepare user data for client (stringify IDs)
-        user_data_for_client = stringify_ids({k: v for k, v in user_doc.items() if k != 'password'})
+        # Prepare user data for client (ObjectIds are serialized by the JSON encoder)
+        user_data_for_client = {k: v for k, v in user_doc.items() if k != 'password'}
 
         return jsonify({'token': token, 'user': user_data_for_client}), 201
 
+    except HashingBusy:
+        return hashing_busy_response(queue_full=True)
     except Exception as e:
         logger.error(f"Registration error: {e}", exc_info=True)
         return jsonify({'message': 'Server error during registration'}), 500
@@ -422,8 +841,14 @@ def login():
 
         user = db.users.find_one({'email': email})
 
-        # Check user and password
-        if not user or 'password' not in user or not check_password_hash(user.get('password', ''), password):
+        # Check user and password (on the hashing pool; unknown emails cost no hash)
+        with password_hash_slot(email) as admitted:
+            if not admitted:
+                return hashing_busy_response()
+            password_ok = bool(user) and password_hasher.verify(user.get('password'), password)
+            if password_ok:
+                upgrade_password_hash(user, password)
+        if not password_ok:
             return jsonify({'message': 'Invalid email or password'}), 401
 
         # --- Login Streak Logic (only for students) ---
@@ -473,6 +898,7 @@ def login():
             db.users.update_one({'_id': user['_id']}, {'$inc': inc_updates, '$set': update_fields})
         elif update_fields: # Only update lastLogin if no points were added
              db.users.update_one({'_id': user['_id']}, {'$set': update_fields})
+        invalidate_user_cache(user['_id'])
 
 
         # Fetch updated user data
@@ -481,17 +907,17 @@ def login():
             return jsonify({'message': 'Login failed - internal error fetching updated user'}), 500
 
         # Generate JWT token
-        token_expiry = datetime.now(timezone.utc) + timedelta(days=7)
-        token_payload = {'id': str(updated_user['_id']), 'role': updated_user['role'], 'exp': token_expiry}
-        token = pyjwt.encode(token_payload, JWT_SECRET, algorithm="HS256")
+        token = issue_token(updated_user)
 
         logger.info(f"User logged in: {email}, Role: {updated_user['role']}, Streak: {updated_user.get('streak', 'N/A')}")
 
-        # Prepare user data for client (stringify IDs)
-        user_data_for_client = stringify_ids({k: v for k, v in updated_user.items() if k != 'password'})
+        # Prepare user data for client (ObjectIds are serialized by the JSON encoder)
+        user_data_for_client = {k: v for k, v in updated_user.items() if k != 'password'}
 
         return jsonify({'token': token, 'user': user_data_for_client})
 
+    except HashingBusy:
+        return hashing_busy_response(queue_full=True)
     except Exception as e:
         logger.error(f"Login error: {e}", exc_info=True)
         return jsonify({'message': 'Server error during login'}), 500
@@ -501,13 +927,10 @@ def login():
 def refresh_token():
     try:
         user_id = request.current_user['_id'] # Already stringified by decorator
-        user_role = request.current_user['role']
         user_email = request.current_user['email'] # For logging
 
-        # Generate new token with fresh expiry
-        token_expiry = datetime.now(timezone.utc) + timedelta(days=7)
-        new_token_payload = {'id': user_id, 'role': user_role, 'exp': token_expiry}
-        new_token = pyjwt.encode(new_token_payload, JWT_SECRET, algorithm="HS256")
+        # New token with fresh expiry and current claims (the user was loaded, not taken from the old token)
+        new_token = issue_token(request.current_user)
 
         logger.info(f"Token refreshed for user: {user_email} (ID: {user_id})")
         return jsonify({'token': new_token})
@@ -515,6 +938,178 @@ def refresh_token():
         logger.error(f"Token refresh error: {e}", exc_info=True)
         return jsonify({'message': 'Server error during token refresh'}), 500
 
+# --- Roster import (see roster_import.py) ---
+# Hashing thousands of passwords takes minutes, so the request only stages the file and queues a
+# users.import job; the teacher polls GET /api/users/import/<id> for progress and the report.
+# Each job run handles one batch after `resumeAfterLine` and queues the next run, so no run comes
+# near JOB_VISIBILITY_TIMEOUT and a crash repeats at most one batch. The staged file holds
+# plaintext passwords: it is deleted when the import ends, and swept at startup if left behind.
+ROSTER_IMPORT_BATCH = int(os.getenv("ROSTER_IMPORT_BATCH", 500)) # Rows hashed and inserted per job run; keep well below JOB_VISIBILITY_TIMEOUT
+ROSTER_IMPORT_MAX_ROWS = int(os.getenv("ROSTER_IMPORT_MAX_ROWS", 10000)) # Rows read per upload; the rest is reported as skipped
+ROSTER_IMPORT_DIR = os.path.join(BASE_DIR, 'uploads', 'roster_imports') # Not served
+ROSTER_IMPORT_STALE_AGE = 24 * 3600 # Staged files older than this belong to imports that died
+os.makedirs(ROSTER_IMPORT_DIR, exist_ok=True)
+remove_stale_temp_files(ROSTER_IMPORT_DIR, max_age_seconds=ROSTER_IMPORT_STALE_AGE)
+
+def insert_roster_batch(batch, report):
+    # Hashes a batch of validated rows in parallel and inserts them unordered, so one duplicate
+    # email doesn't stop the rest; duplicates come back as per-row failures
+    hashes = password_hasher.hash_many([row['password'] for row in batch])
+    docs = [new_user_document(row['email'], hashed, row['name'], row['role']) for row, hashed in zip(batch, hashes)]
+    try:
+        result = db.users.insert_many(docs, ordered=False)
+        report['inserted'] += len(result.inserted_ids)
+    except BulkWriteError as e:
+        report['inserted'] += e.details.get('nInserted', 0)
+        for write_error in e.details.get('writeErrors', []):
+            row = batch[write_error['index']]
+            message = 'Email already exists' if write_error.get('code') == 11000 else write_error.get('errmsg', 'Insert failed')
+            report['failures'].append({'line': row['line'], 'email': row['email'], 'errors': {'email': message}})
+
+def finish_roster_import(roster_import, status, fields=None, inc=None, failures=()):
+    # Final update of an import; drops the staged file
+    now = datetime.now(timezone.utc)
+    update = {'$set': dict(fields or {}, status=status, updatedAt=now, finishedAt=now)}
+    if inc:
+        update['$inc'] = inc
+    if failures:
+        update['$push'] = {'failures': {'$each': list(failures)}}
+    db.roster_imports.update_one({'_id': roster_import['_id'], 'resumeAfterLine': roster_import['resumeAfterLine']}, update)
+    try:
+        os.remove(os.path.join(ROSTER_IMPORT_DIR, roster_import['stagedFile']))
+    except FileNotFoundError:
+        pass
+
+@job_queue.register('users.import')
+def run_roster_import(payload):
+    roster_import = db.roster_imports.find_one({'_id': ObjectId(payload['importId'])})
+    if roster_import is None or roster_import['status'] in ('done', 'failed'):
+        return
+    resume_after = roster_import['resumeAfterLine']
+    path = os.path.join(ROSTER_IMPORT_DIR, roster_import['stagedFile'])
+    if not os.path.exists(path):
+        finish_roster_import(roster_import, 'failed', {'error': 'Uploaded file is no longer available'})
+        return
+
+    # This run's share of the report; added to the stored totals at the end
+    report = {'received': 0, 'inserted': 0, 'failures': []}
+    fields = {}
+    batch = []
+    last_line = resume_after
+    finished = True
+    try:
+        with open(path, 'rb') as roster_file:
+            for line, row in iter_roster_rows(roster_file, roster_import['format']):
+                if line <= resume_after:
+                    continue # Done by an earlier run
+                if len(batch) >= ROSTER_IMPORT_BATCH:
+                    finished = False
+                    break
+                if roster_import['received'] + report['received'] >= ROSTER_IMPORT_MAX_ROWS:
+                    fields['truncated'] = True
+                    break
+                report['received'] += 1
+                last_line = line
+                if row is None:
+                    report['failures'].append({'line': line, 'email': None, 'errors': {'row': 'Not a JSON object'}})
+                    continue
+                (email, password, name, role), errors = validate_registration(row)
+                if errors:
+                    report['failures'].append({'line': line, 'email': email or None, 'errors': errors})
+                    continue
+                batch.append({'line': line, 'email': email, 'password': password, 'name': name, 'role': role})
+    except RosterFormatError as e:
+        # Unreadable from here on; rows before it are still imported
+        fields['error'] = str(e)
+        finished = True
+    if batch:
+        insert_roster_batch(batch, report)
+    report['failures'].sort(key=lambda failure: failure['line']) # Insert failures are found per batch
+    inc = {'received': report['received'], 'inserted': report['inserted'], 'failed': len(report['failures'])}
+
+    if report['inserted']:
+        expire_analytics_snapshot() # Student counts changed
+    if finished:
+        status = 'failed' if 'error' in fields and not (roster_import['received'] + report['received']) else 'done'
+        finish_roster_import(roster_import, status, dict(fields, resumeAfterLine=last_line), inc, report['failures'])
+        logger.info(f"Roster import {roster_import['_id']} {status}: {roster_import['received'] + report['received']} rows, "
+                    f"{roster_import['inserted'] + report['inserted']} created{' (truncated)' if fields.get('truncated') else ''}")
+        return
+    # Only the run that still sees the old resumeAfterLine records its batch; a duplicate run of
+    # the same batch (job reclaimed after a timeout) stops here
+    result = db.roster_imports.update_one(
+        {'_id': roster_import['_id'], 'resumeAfterLine': resume_after},
+        {'$set': {'status': 'running', 'resumeAfterLine': last_line, 'updatedAt': datetime.now(timezone.utc)},
+         '$inc': inc, '$push': {'failures': {'$each': report['failures']}}}
+    )
+    if result.modified_count:
+        job_queue.enqueue('users.import', payload)
+
+@app.route('/api/users/import', methods=['POST'])
+@teacher_required
+def import_roster():
+    # Bulk account creation from a CSV (header: email,name,password[,role]) or NDJSON upload in the
+    # 'file' field; ?format=csv|ndjson overrides the file extension. Answers 202 with the import id;
+    # rows are validated like register, and the report lists every row not created, by line number.
+    try:
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({'message': 'No file part'}), 400
+        fmt = roster_format(upload.filename, request.args.get('format'))
+        if fmt is None:
+            return jsonify({'message': 'Unsupported roster format (use .csv or .ndjson, or ?format=)'}), 400
+
+        staged_path = new_temp_path(ROSTER_IMPORT_DIR)
+        upload.save(staged_path)
+        now = datetime.now(timezone.utc)
+        roster_import = {
+            'status': 'queued',
+            'format': fmt,
+            'filename': upload.filename,
+            'stagedFile': os.path.basename(staged_path),
+            'createdBy': ObjectId(request.current_user['_id']),
+            'createdAt': now,
+            'updatedAt': now,
+            'resumeAfterLine': 0,
+            'received': 0,
+            'inserted': 0,
+            'failed': 0,
+            'failures': [],
+            'truncated': False
+        }
+        try:
+            db.roster_imports.insert_one(roster_import)
+            job_id = job_queue.enqueue('users.import', {'importId': str(roster_import['_id'])})
+        except Exception:
+            os.remove(staged_path)
+            raise
+
+        logger.info(f"Roster import {roster_import['_id']} ({upload.filename}) queued by {request.current_user['email']}")
+        response = jsonify({'message': 'Roster import queued', 'importId': roster_import['_id'], 'jobId': job_id,
+                            'status': 'queued'})
+        response.status_code = 202
+        response.headers['Location'] = f"/api/users/import/{roster_import['_id']}"
+        return response
+
+    except Exception as e:
+        logger.error(f"Roster import error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error during roster import'}), 500
+
+@app.route('/api/users/import/<import_id_str>', methods=['GET'])
+@teacher_required
+def get_roster_import(import_id_str):
+    # Progress while queued/running (received/inserted/failed so far); the full report once done
+    try:
+        if not ObjectId.is_valid(import_id_str):
+            return jsonify({'message': 'Invalid import ID format'}), 400
+        roster_import = db.roster_imports.find_one({'_id': ObjectId(import_id_str)}, {'stagedFile': 0, 'resumeAfterLine': 0})
+        if roster_import is None:
+            return jsonify({'message': 'Import not found'}), 404
+        return jsonify(roster_import)
+    except Exception as e:
+        logger.error(f"Get roster import error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error fetching roster import'}), 500
+
 @app.route('/api/users/me', methods=['GET'])
 @token_required
 def get_user_profile():
@@ -527,7 +1122,7 @@ def get_user_profile():
         return jsonify({'message': 'Server error fetching profile'}), 500
 
 @app.route('/api/users/<user_id_str>', methods=['GET'])
-@token_required
+@identity_required
 def get_user_by_id(user_id_str):
     try:
         requesting_user_role = request.current_user.get('role')
@@ -547,15 +1142,15 @@ def get_user_by_id(user_id_str):
         if not user:
             return jsonify({'message': 'User not found'}), 404
 
-        # Return user data (stringified)
+        # Return user data (raw document; see json_provider)
         logger.info(f"User {user_id_str} profile fetched by {request.current_user['_id']}")
-        return jsonify(stringify_ids(user))
+        return jsonify(user)
     except Exception as e:
         logger.error(f"Get user by ID error: {e}", exc_info=True)
         return jsonify({'message': 'Server error fetching user profile'}), 500
 
 @app.route('/api/users', methods=['GET'])
-@token_required
+@identity_required
 def get_users():
     try:
         # Only teachers can list users
@@ -573,7 +1168,7 @@ def get_users():
 
         # Fetch users
         users_cursor = db.users.find(query, {'password': 0}).limit(limit)
-        users = [stringify_ids(user) for user in users_cursor]
+        users = list(users_cursor)
 
         logger.info(f"Users list fetched by {request.current_user['_id']} (Role filter: {role or 'None'})")
         return jsonify(users)
@@ -656,8 +1251,8 @@ def update_user(user_id_str):
 
         # If no valid updates, return current data
         if not updates:
-            # Stringify IDs for response
-            return jsonify(stringify_ids({k: v for k, v in target_user.items() if k != 'password'}))
+            # Return current data without the password
+            return jsonify({k: v for k, v in target_user.items() if k != 'password'})
 
         # --- Level calculation based on points ---
         level_changed_by_points = False
@@ -681,6 +1276,7 @@ def update_user(user_id_str):
 
         # Perform the update
         result = db.users.update_one({'_id': user_id_obj}, {'$set': updates})
+        invalidate_user_cache(user_id_obj)
 
         if result.matched_count == 0:
             # Should not happen if find_one succeeded, but check anyway
@@ -697,8 +1293,8 @@ def update_user(user_id_str):
 
         logger.info(f"User {user_id_str} updated successfully by {requesting_user_id}. Fields: {list(updates.keys())}")
 
-        # Return updated user data (stringified)
-        return jsonify(stringify_ids(updated_user))
+        # Return updated user data
+        return jsonify(updated_user)
 
     except Exception as e:
         logger.error(f"Update user {user_id_str} error: {e}", exc_info=True)
@@ -726,10 +1322,11 @@ def add_personal_course():
             {'_id': user_id_obj},
             {'$addToSet': {'personalCourses': course_id_obj}}
         )
+        invalidate_user_cache(user_id_obj)
 
         # Fetch updated user to return
         updated_user = db.users.find_one({'_id': user_id_obj}, {'password': 0})
-        user_data_for_client = stringify_ids(updated_user)
+        user_data_for_client = updated_user
 
         if result.modified_count > 0:
              logger.info(f"Course {course_id_str} added to favorites for user {request.current_user['_id']}")
@@ -758,10 +1355,11 @@ def remove_personal_course(course_id_str):
             {'_id': user_id_obj},
             {'$pull': {'personalCourses': course_id_obj}}
         )
+        invalidate_user_cache(user_id_obj)
 
         # Fetch updated user to return
         updated_user = db.users.find_one({'_id': user_id_obj}, {'password': 0})
-        user_data_for_client = stringify_ids(updated_user)
+        user_data_for_client = updated_user
 
         if result.modified_count > 0:
             logger.info(f"Course {course_id_str} removed from favorites for user {request.current_user['_id']}")
@@ -798,71 +1396,110 @@ def change_password():
         if 'password' not in user or not user['password']:
             return jsonify({'message': 'Cannot change password for this account'}), 400
 
-        # Verify current password
-        if not check_password_hash(user.get('password'), current_password):
-            return jsonify({'message': 'Current password incorrect'}), 401
+        with password_hash_slot(user['email']) as admitted:
+            if not admitted:
+                return hashing_busy_response()
+            # Verify current password
+            if not password_hasher.verify(user.get('password'), current_password):
+                return jsonify({'message': 'Current password incorrect'}), 401
 
-        # Prevent setting the same password
-        if check_password_hash(user.get('password'), new_password):
-            return jsonify({'message': 'New password cannot be the same as the old password'}), 400
+            # Prevent setting the same password
+            if password_hasher.verify(user.get('password'), new_password):
+                return jsonify({'message': 'New password cannot be the same as the old password'}), 400
 
-        # Hash new password and update
-        new_hashed_password = generate_password_hash(new_password)
+            # Hash new password and update
+            new_hashed_password = password_hasher.hash(new_password)
         result = db.users.update_one({'_id': user_id_obj}, {'$set': {'password': new_hashed_password}})
+        invalidate_user_cache(user_id_obj)
 
         if result.matched_count == 0:
             return jsonify({'message': 'User not found during password update'}), 404 # Should not happen
 
+        # Sign out every other session; this one continues with the returned token
+        updated_user = revoke_user_tokens(user_id_obj)
         logger.info(f"Password changed successfully for user {user_id_obj}")
-        return jsonify({'message': 'Password changed successfully'})
+        return jsonify({'message': 'Password changed successfully', 'token': issue_token(updated_user)})
 
+    except HashingBusy:
+        return hashing_busy_response(queue_full=True)
     except Exception as e:
         logger.error(f"Change password error: {e}", exc_info=True)
         return jsonify({'message': 'Server error changing password'}), 500
 
+# --- Avatar variants ---
+@job_queue.register('avatar.variants')
+def process_avatar_variants(payload):
+    # Renders the thumbnails and points the user (and their ranking row) at them.
+    # Until this succeeds (it is retried on failure) the uploaded image is served as-is.
+    user_id_str, avatar_sha256 = payload['userId'], payload['sha256']
+    source_path = os.path.join(UPLOAD_FOLDER_AVATARS, payload['avatarUrl'][len('/uploads/avatars/'):])
+    variants = render_avatar_variants(source_path, AVATAR_VARIANTS_DIR, AVATAR_VARIANTS_URL, avatar_sha256)
+    # Only if the user still has this avatar (it may have been replaced meanwhile)
+    updated_user = db.users.find_one_and_update(
+        {'_id': ObjectId(user_id_str), 'avatarBlob': avatar_sha256},
+        {'$set': {'avatarVariants': variants}},
+        projection={'password': 0}, return_document=ReturnDocument.AFTER
+    )
+    if updated_user is None:
+        return
+    _update_user_ranking(user_id_str, stringify_ids(updated_user))
+    logger.info(f"Avatar variants ready for user {user_id_str}")
+
+def schedule_avatar_variants(user_id_str, avatar_sha256, avatar_url):
+    if not images_supported():
+        logger.warning("Pillow not installed; avatar thumbnails disabled")
+        return
+    job_queue.enqueue('avatar.variants', {'userId': user_id_str, 'sha256': avatar_sha256, 'avatarUrl': avatar_url})
+
 @app.route('/api/users/change-avatar', methods=['POST'])
 @token_required
 def change_avatar():
     try:
         user_id_obj = ObjectId(request.current_user['_id']) # Need ObjectId for DB query
 
+        # Stream the file part to disk with type/size checks (see uploads.py)
+        request.upload_policy = UploadPolicy(UPLOAD_FOLDER_AVATARS, ALLOWED_AVATAR_EXTENSIONS, MAX_AVATAR_SIZE)
+
         if 'avatar' not in request.files:
             return jsonify({'message': 'No file part named "avatar"'}), 400
         file = request.files['avatar']
         if file.filename == '':
             return jsonify({'message': 'No selected file'}), 400
 
-        # Validate file type
+        # Validate file type (size already enforced while streaming)
         filename = secure_filename(file.filename)
         if not allowed_file(filename, ALLOWED_AVATAR_EXTENSIONS):
             ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else '?'
             return jsonify({'message': f'File type "{ext}" not allowed. Allowed: {", ".join(ALLOWED_AVATAR_EXTENSIONS)}'}), 400
 
-        # Validate file size
-        file.seek(0, os.SEEK_END)
-        file_length = file.tell()
-        file.seek(0) # Reset pointer
-        if file_length > MAX_AVATAR_SIZE:
-            limit_mb = MAX_AVATAR_SIZE / (1024 * 1024)
-            return jsonify({'message': f'File size exceeds limit ({limit_mb:.1f}MB)'}), 413 # Payload Too Large
-
-        # Create unique filename and path
+        # Save file (content-addressed: re-uploading the same image stores nothing new)
         file_ext = filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"avatar_{str(user_id_obj)}_{int(datetime.now(timezone.utc).timestamp())}.{file_ext}"
-        file_path = os.path.join(UPLOAD_FOLDER_AVATARS, unique_filename)
-        avatar_url = f"/uploads/avatars/{unique_filename}" # URL path for serving
-
-        # TODO: Add image processing/resizing here if needed before saving
-
-        # Save file
-        file.save(file_path)
-
-        # Update user document
-        result = db.users.update_one({'_id': user_id_obj}, {'$set': {'avatar': avatar_url}})
-        if result.matched_count == 0:
-            # Clean up saved file if user not found
-            if os.path.exists(file_path): os.remove(file_path)
+        temp_path = new_temp_path(UPLOAD_FOLDER_AVATARS)
+        file_sha256, file_size = commit_upload(file, temp_path)
+        if images_supported():
+            # The stored file is public: re-encode it without EXIF/GPS and refuse what doesn't decode
+            try:
+                file_sha256, file_size = sanitize_avatar(temp_path, file_ext)
+            except AvatarImageError as e:
+                os.remove(temp_path)
+                logger.info(f"Avatar upload from {user_id_obj} rejected: {e}")
+                return jsonify({'message': 'The file is not a valid image'}), 400
+        avatar_url, _ = avatar_blobs.put(temp_path, file_sha256, file_size, file_ext)
+
+        # Update user document; the previous avatar's reference is released below
+        previous_user = db.users.find_one_and_update(
+            {'_id': user_id_obj},
+            # Thumbnails of the previous image no longer apply; set again by the variant worker
+            {'$set': {'avatar': avatar_url, 'avatarBlob': file_sha256}, '$unset': {'avatarVariants': ''}},
+            projection={'avatarBlob': 1}
+        )
+        invalidate_user_cache(user_id_obj)
+        if previous_user is None:
+            avatar_blobs.release(file_sha256) # Nobody references the new file
             return jsonify({'message': 'User not found'}), 404
+        if previous_user.get('avatarBlob'):
+            avatar_blobs.release(previous_user['avatarBlob'])
+        schedule_avatar_variants(str(user_id_obj), file_sha256, avatar_url)
 
         # Fetch updated user data for ranking update and response
         updated_user = db.users.find_one({'_id': user_id_obj}, {'password': 0})
@@ -876,8 +1513,11 @@ def change_avatar():
         logger.info(f"Avatar changed for user {user_id_obj}, URL: {avatar_url}")
         return jsonify({'message': 'Avatar changed successfully', 'avatarUrl': avatar_url, 'user': updated_user_data})
 
+    except UploadRejected as e:
+        # Refused while streaming (type/size); the partial file is already gone
+        return jsonify({'message': e.message}), e.status_code
     except Exception as e:
-        # Clean up potential partial file uploads on error? Difficult.
+        # Partial uploads are removed with the request (or by the startup sweep)
         logger.error(f"Change avatar error: {e}", exc_info=True)
         return jsonify({'message': 'Server error changing avatar'}), 500
 
@@ -890,9 +1530,11 @@ def get_courses():
         if category:
             query['category'] = category
 
-        courses_cursor = db.courses.find(query)
-        # Convert ObjectIds to strings for JSON response
-        courses = [stringify_ids(c) for c in courses_cursor]
+        # Convert ObjectIds to strings for JSON response (cached per category)
+        courses = get_cached_catalog(
+            f"courses:{category or 'all'}",
+            lambda: [stringify_ids(c) for c in db.courses.find(query)]
+        )
 
         user_id = request.current_user.get('_id', 'public') if hasattr(request, 'current_user') else 'public'
         logger.info(f"Courses fetched (Category: {category or 'All'}) for user/requester {user_id}")
@@ -904,74 +1546,361 @@ def get_courses():
 
 
 # <<< ADDED: Global variables for SSE ranking cache >>>
-last_rankings_state = None
 last_check_time = 0
 RANKING_CHECK_INTERVAL = 5 # Check database for ranking changes every 5 seconds
+RANKING_LIMIT = 50 # Size of the leaderboard tracked for snapshots, deltas and the stream
+# Previous ordered ranking indexed by userId; each change gets a new monotonic version
+ranking_ledger = RankingLedger(key='userId')
+ranking_refresh_lock = threading.Lock()
+
+
+def _load_shared_ranking_state(limit):
+    # One process per interval queries MongoDB and publishes the rows (with a shared version)
+    # through the shared cache; every other process just reads them
+    state = shared_cache.get('ranking:state')
+    if state is not None and time.time() - state['fetchedAt'] < RANKING_CHECK_INTERVAL:
+        return state
+    if not shared_cache.acquire_lock('ranking:refresh', RANKING_CHECK_INTERVAL):
+        return state # Another process is refreshing; use what we have
+
+    logger.debug(f"Ranking cache expired or empty. Querying DB at {time.time():.2f}")
+    rows = list(db.rankings.find(
+        {},
+        {'_id': 0, 'userId': 1, 'name': 1, 'points': 1, 'avatar': 1, 'level': 1} # Exclude MongoDB _id
+    ).sort('points', -1).limit(limit))
+    if state is not None and state['rows'] == rows:
+        version = state['version']
+    else:
+        # Seeded with the current time (ms) so versions keep increasing even if the counter is lost
+        version = shared_cache.incr('ranking:version', initial=int(time.time() * 1000))
+    state = {'rows': rows, 'version': version, 'fetchedAt': time.time()}
+    shared_cache.set('ranking:state', state, ttl=RANKING_CHECK_INTERVAL * 12)
+    return state
 
 
 # <<< ADDED: Helper function to get current ranking state (cached) >>>
-def get_current_ranking_state(limit=50):
-    """Fetches current ranking state, using a cache to reduce DB load."""
-    global last_rankings_state, last_check_time
+def get_current_ranking_state(limit=RANKING_LIMIT):
+    """Refreshes the ranking ledger from the shared state (at most once per interval); returns (version, delta) if it changed.
+
+    Every change is published to the SSE clients here, whichever caller (REST read, stream
+    catch-up or the watcher) advanced the ledger, so no delta is skipped by the stream.
+    """
+    global last_check_time
     current_time = time.time()
 
     # Check cache validity
-    if last_rankings_state is None or (current_time - last_check_time > RANKING_CHECK_INTERVAL):
-        logger.debug(f"Ranking cache expired or empty. Querying DB at {current_time:.2f}")
-        try:
-            rankings_cursor = db.rankings.find(
-                {},
-                {'_id': 0, 'userId': 1, 'name': 1, 'points': 1, 'avatar': 1, 'level': 1} # Exclude MongoDB _id
-            ).sort('points', -1).limit(limit)
-            current_state_list = list(rankings_cursor) # Convert cursor to list
-            # Store as JSON string for easy comparison
-            current_state_json = json.dumps(current_state_list)
-
-            # Update cache only if data actually changed to avoid unnecessary downstream processing
-            if current_state_json != last_rankings_state:
-                 last_rankings_state = current_state_json
-                 logger.info(f"Ranking state updated in cache. {len(current_state_list)} users.")
-            else:
-                 logger.debug("Ranking state unchanged since last DB check.")
-
-
-            last_check_time = current_time # Update last check time regardless of change
-            return last_rankings_state # Return the potentially updated state
-
-        except Exception as e:
-            logger.error(f"Error fetching current ranking state from DB: {e}")
-            # Return the old cached state on error to avoid breaking SSE stream if possible
-            return last_rankings_state
-    else:
-        # Return cached state if interval hasn't passed
-        logger.debug(f"Returning cached ranking state (checked {current_time - last_check_time:.2f}s ago)")
-        return last_rankings_state
+    if current_time - last_check_time < RANKING_CHECK_INTERVAL:
+        return None
+    # Only one thread queries the DB; concurrent callers keep using the current ledger
+    if not ranking_refresh_lock.acquire(blocking=False):
+        return None
+    try:
+        state = _load_shared_ranking_state(limit)
+        if state is None:
+            return None
+        change = ranking_ledger.update(state['rows'], version=state['version'])
+        last_check_time = current_time # Update last check time regardless of change
+
+        if change:
+            version, delta = change
+            logger.info(f"Ranking state updated to version {version}. Changed: {len(delta['changed'])}, Removed: {len(delta['removed'])}")
+            ranking_broadcaster.publish(version, 'delta', json.dumps(delta))
+        else:
+            logger.debug("Ranking state unchanged since last DB check.")
+        return change
+    except Exception as e:
+        # Keep serving the previous ledger on error to avoid breaking SSE streams
+        logger.error(f"Error fetching current ranking state from DB: {e}")
+        return None
+    finally:
+        ranking_refresh_lock.release()
 
 
 @app.route('/api/rankings', methods=['GET'])
-@token_required # Keep token required for standard GET request
+@identity_required # Keep token required for standard GET request
 def get_rankings():
-    # This route provides a snapshot, mainly for initial load or fallback
+    # Without `since` this returns a full snapshot (initial load/fallback);
+    # with `since=<version>` only the rows that changed after that version
     try:
-        limit = int(request.args.get('limit', 50))
-        # Use the cached state function to potentially avoid DB query
-        rankings_json = get_current_ranking_state(limit=limit)
-        rankings_list = json.loads(rankings_json) if rankings_json else []
+        try: limit = int(request.args.get('limit', RANKING_LIMIT))
+        except ValueError: limit = RANKING_LIMIT
+        limit = max(1, min(limit, RANKING_LIMIT))
+        since = request.args.get('since')
+
+        # Refreshes the ledger from the DB only if the cache interval has passed
+        get_current_ranking_state()
+
+        if since is not None:
+            try: since_version = int(since)
+            except ValueError: return jsonify({'message': 'Invalid since version'}), 400
+            delta = ranking_ledger.delta_since(since_version)
+            if delta is not None:
+                # Rows pushed below the requested limit count as removed for this client
+                delta['removed'] += [row['userId'] for row in delta['changed'] if row['rank'] > limit]
+                delta['changed'] = [row for row in delta['changed'] if row['rank'] <= limit]
+                return jsonify(dict(delta, full=False))
+            # Version too old (or from another process): fall back to a full snapshot
+            version, rows = ranking_ledger.snapshot(limit)
+            logger.info(f"Rankings delta since {since_version} unavailable, sent snapshot v{version} to user {request.current_user['_id']}")
+            return jsonify({'version': version, 'full': True, 'rankings': rows})
+
+        if limit == RANKING_LIMIT:
+            # Serialized once per version and shared by all requests
+            version, rankings_json = ranking_ledger.snapshot_json()
+            response = Response(rankings_json, mimetype='application/json')
+        else:
+            version, rows = ranking_ledger.snapshot(limit)
+            response = jsonify(rows)
+        response.headers['X-Ranking-Version'] = str(version)
 
-        logger.info(f"Rankings fetched on demand (Snapshot, Top {limit}) for user {request.current_user['_id']}")
-        return jsonify(rankings_list)
+        logger.info(f"Rankings fetched on demand (Snapshot v{version}, Top {limit}) for user {request.current_user['_id']}")
+        return response
     except Exception as e:
         logger.error(f"Rankings fetch (snapshot) error: {str(e)}", exc_info=True)
         return jsonify({'message': 'Server error fetching rankings snapshot', 'error': str(e)}), 500
 
 
+def _poll_ranking_changes():
+    # Called by the broadcaster's watcher; a change is published by get_current_ranking_state itself
+    get_current_ranking_state()
+    return None
+
+
+def _ranking_catch_up(version):
+    # Frames that bring an SSE client at `version` (None = new client) up to date
+    get_current_ranking_state()
+    if version is not None:
+        delta = ranking_ledger.delta_since(version)
+        if delta is not None:
+            if not delta['changed'] and not delta['removed']:
+                return []
+            return [(delta['version'], 'delta', json.dumps(delta))]
+    # New client or version outside the kept history: full list as an 'update' event
+    version, rankings_json = ranking_ledger.snapshot_json()
+    return [(version, 'update', rankings_json)]
+
+
+# --- Server-Sent Events capacity ---
+# Every open stream (/api/events/stream, /api/rankings/stream) holds a request thread (see
+# WAITRESS_THREADS). SSE_MAX_STREAMS caps them per process so the REST endpoints always keep the
+# remaining threads; extra clients get 503 with Retry-After and the frontend falls back to polling.
+# For more tabs, raise WAITRESS_THREADS (SSE_MAX_STREAMS follows) or run more processes with REDIS_URL set.
+SSE_BUSY_RETRY_AFTER = 60 # Seconds a rejected client should wait before opening a stream again
+sse_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+def sse_response(open_stream):
+    # Streams open_stream() as text/event-stream if a stream slot is free, else answers 503.
+    # The slot is released when the WSGI server closes the response (client gone or stream ended).
+    if not sse_stream_slots.acquire(blocking=False):
+        logger.warning(f"SSE stream rejected: all {SSE_MAX_STREAMS} stream slots in use")
+        response = jsonify({'message': 'Too many live connections; falling back to polling'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_BUSY_RETRY_AFTER)
+        return response
+    try:
+        response = Response(open_stream(), mimetype='text/event-stream')
+    except Exception:
+        sse_stream_slots.release()
+        raise
+    response.call_on_close(sse_stream_slots.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    return response
+
+# Single shared watcher for all SSE clients: one DB poll per interval regardless of client count
+ranking_broadcaster = RankingBroadcaster(_poll_ranking_changes, _ranking_catch_up, poll_interval=RANKING_CHECK_INTERVAL)
+
+
 # <<< ADDED: SSE Endpoint for Real-time Ranking Updates >>>
 @app.route('/api/rankings/stream')
 def stream_rankings():
-    def generate():
-        yield 'data: {"event": "connected", "rankings": []}\n\n'
-    return Response(generate(), mimetype='text/event-stream')
-
+    # EventSource sends Last-Event-ID on automatic reconnects; allow a query param for manual resumes
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    return sse_response(lambda: ranking_broadcaster.stream(last_event_id))
+
+
+def challenge_limit_reached(user_id_obj, user_role, submission_type):
+    # Students may submit one challenge per day (UTC) unless the earlier one was rejected
+    if submission_type != 'challenge' or user_role != 'student':
+        return False
+    # Get today's date in UTC
+    today = datetime.now(timezone.utc).date()
+    today_start = datetime.combine(today, datetime.min.time()).replace(tzinfo=timezone.utc)
+    today_end = datetime.combine(today, datetime.max.time()).replace(tzinfo=timezone.utc)
+
+    # Find if there's a submission for today by this user
+    existing_submission = db.submissions.find_one({
+        'userId': user_id_obj,
+        'type': 'challenge',
+        'createdAt': {'$gte': today_start, '$lte': today_end}
+    })
+    # Check if the existing submission was rejected
+    return existing_submission is not None and existing_submission.get('status') != 'rejected'
+
+CHALLENGE_LIMIT_MESSAGE = 'Bạn chỉ được nộp một thử thách mỗi ngày. Vui lòng thử lại vào ngày mai.'
+
+@job_queue.register('submission.process')
+def process_submission(payload):
+    # Post-upload work for a new submission: related title lookup, points award and ranking update
+    submission_id = ObjectId(payload['submissionId'])
+    submission = db.submissions.find_one({'_id': submission_id})
+    if submission is None:
+        return
+
+    # Resolve the related title when the client didn't send one
+    related_id = submission.get('relatedId')
+    if isinstance(related_id, ObjectId) and submission.get('relatedTitle') in (None, '', 'N/A'):
+        collection_to_check = None
+        if submission['type'] == 'challenge':
+            collection_to_check = db.challenges
+        elif submission['type'] in ['practice', 'practice_video']: # Assuming practice relates to courses
+            collection_to_check = db.courses
+        related_doc = collection_to_check.find_one({'_id': related_id}, {'title': 1}) if collection_to_check is not None else None
+        if related_doc:
+            db.submissions.update_one({'_id': submission_id}, {'$set': {'relatedTitle': related_doc.get('title', 'Unknown Title')}})
+        else:
+            logger.warning(f"Related document not found for ID: {related_id} (submission {submission_id})")
+
+    # Award points once, even if the job is retried (the flag is taken before awarding)
+    points, progress = payload.get('points', 0), payload.get('progress', 0)
+    if points > 0 or progress > 0:
+        claimed = db.submissions.update_one({'_id': submission_id, 'pointsApplied': {'$ne': True}},
+                                            {'$set': {'pointsApplied': True}})
+        if claimed.modified_count:
+            try:
+                if award_points(submission['userId'], points, progress):
+                    logger.info(f"Auto-awarded {points} points, {progress}% progress for submission {submission_id} by {submission.get('userEmail')}.")
+                    expire_analytics_snapshot() # Average points changed
+            except Exception:
+                db.submissions.update_one({'_id': submission_id}, {'$unset': {'pointsApplied': ''}})
+                raise
+
+# --- Video renditions ---
+@job_queue.register('submission.transcode')
+def process_video_rendition(payload):
+    # Transcodes an uploaded video and records the rendition on every submission of that file.
+    # Until this succeeds (it is retried on timeouts) the original is served.
+    file_sha256 = payload['sha256']
+    source_path = os.path.join(UPLOAD_FOLDER_SUBMISSIONS, payload['url'][len('/uploads/submissions/'):])
+    try:
+        rendition = render_video_rendition(source_path, SUBMISSION_RENDITIONS_DIR, SUBMISSION_RENDITIONS_URL,
+                                           file_sha256, timeout=FFMPEG_TIMEOUT)
+    except TranscodeError as e:
+        # Unreadable video: keep serving the original, don't retry
+        logger.warning(f"Video rendition failed for blob {file_sha256[:12]}: {e}")
+        db.submissions.update_many({'sha256': file_sha256}, {'$set': {'rendition': {'status': 'failed'}}})
+        return
+    if rendition['size'] >= payload.get('size', 0):
+        # Already a small web video: the original is the better file
+        remove_video_rendition(SUBMISSION_RENDITIONS_DIR, file_sha256)
+        rendition = {'status': 'skipped'}
+    else:
+        rendition['status'] = 'ready'
+    rendition['updatedAt'] = datetime.now(timezone.utc)
+    result = db.submissions.update_many({'sha256': file_sha256}, {'$set': {'rendition': rendition}})
+    submission_access_cache.clear() # Serve the rendition right away here; other processes within the cache TTL
+    logger.info(f"Video rendition {rendition['status']} for blob {file_sha256[:12]} ({result.modified_count} submissions)")
+
+def schedule_video_rendition(submission_doc, file_ext, deduplicated):
+    # Sets submission_doc['rendition'] before insert; the job is enqueued by the caller after it
+    if file_ext not in VIDEO_EXTENSIONS or not transcoding_supported():
+        return False
+    if deduplicated:
+        # Same video uploaded before: share its rendition (a pending job updates every submission of the file)
+        existing = db.submissions.find_one({'sha256': submission_doc['sha256'], 'rendition': {'$exists': True}},
+                                           {'rendition': 1})
+        if existing:
+            submission_doc['rendition'] = existing['rendition']
+            return False
+    submission_doc['rendition'] = {'status': 'pending'}
+    return True
+
+def create_submission(current_user, fields, filename, store_file):
+    # Shared by the multipart and resumable upload paths.
+    # `fields`: note/type/relatedId/relatedTitle; `store_file(file_path)` moves the upload to file_path and returns (sha256, size).
+    # Returns (submission_doc, response_message).
+    user_id_obj = ObjectId(current_user['_id'])
+    user_email = current_user['email']
+    user_name = current_user.get('name', 'Unknown')
+    user_role = current_user['role']
+    note = fields.get('note', '')
+    submission_type = fields.get('type', 'practice')
+    related_id_str = fields.get('relatedId')
+    related_title = fields.get('relatedTitle', 'N/A')
+
+    # --- Process Related ID (title lookup, if needed, happens in the submission.process job) ---
+    if related_id_str and ObjectId.is_valid(related_id_str):
+        related_object_id = ObjectId(related_id_str)
+    else:
+        # Handle cases where relatedId might be a string identifier (like 'daily')
+        related_object_id = related_id_str or None # Store as string
+
+    # Practice uploads by students are approved automatically
+    auto_approve = user_role == 'student' and submission_type in ['practice', 'practice_video']
+    points_to_add = 10 if auto_approve else 0 # Example points for practice
+    progress_to_add = 2 if auto_approve else 0 # Example progress
+
+    # --- Save File (content-addressed: identical bytes are stored once) ---
+    file_ext = filename.rsplit('.', 1)[1].lower()
+    temp_path = new_temp_path(UPLOAD_FOLDER_SUBMISSIONS)
+    file_sha256, file_size = store_file(temp_path)
+    file_url, deduplicated = submission_blobs.put(temp_path, file_sha256, file_size, file_ext)
+    if deduplicated:
+        logger.info(f"Submission file from {user_email} matches stored blob {file_sha256[:12]}; not stored again")
+
+    # --- Create Submission Document ---
+    submission_doc = {
+        'userId': user_id_obj,
+        'userEmail': user_email,
+        'userName': user_name,
+        'type': submission_type,
+        'relatedId': related_object_id, # Can be ObjectId or string
+        'relatedTitle': related_title,
+        'url': file_url,
+        'note': note,
+        'teacherComment': '',
+        'status': 'approved' if auto_approve else 'pending', # Default status
+        'pointsAwarded': points_to_add,
+        'createdAt': datetime.now(timezone.utc),
+        'reviewedAt': None,
+        'reviewerId': None,
+        'originalFilename': filename, # Store original filename for reference
+        'sha256': file_sha256, # Blob reference (counted in db.blobs)
+        'size': file_size
+    }
+
+    needs_rendition = schedule_video_rendition(submission_doc, file_ext, deduplicated)
+
+    # --- Insert Submission ---
+    try:
+        result = db.submissions.insert_one(submission_doc)
+    except Exception:
+        submission_blobs.release(file_sha256) # No document holds the reference
+        raise
+    inserted_id = result.inserted_id
+    submission_doc['_id'] = inserted_id # Keep as ObjectId internally
+    expire_analytics_snapshot() # Submission counts changed (multipart and resumable uploads both end here)
+
+    # --- Points, ranking and title lookup run in the background (see process_submission) ---
+    job_queue.enqueue('submission.process', {
+        'submissionId': str(inserted_id), 'points': points_to_add, 'progress': progress_to_add
+    })
+    if needs_rendition:
+        job_queue.enqueue('submission.transcode', {'sha256': file_sha256, 'url': file_url, 'size': file_size})
+
+    response_message = 'Submission received.'
+    if auto_approve:
+        response_message = f'Practice submission received, +{points_to_add} points!'
+    elif submission_type == 'challenge':
+         # Get potential points from the challenge document
+         challenge_points = 15 # Default if challenge not found or no points defined
+         if isinstance(related_object_id, ObjectId): # Only if it's a valid ID
+             challenge = db.challenges.find_one({'_id': related_object_id}, {'points': 1})
+             if challenge:
+                 challenge_points = challenge.get('points', 15)
+         response_message = f'Challenge submission received. Waiting for review (potential +{challenge_points} points).'
+
+    return submission_doc, response_message
 
 @app.route('/api/submissions', methods=['POST'])
 @token_required
@@ -980,9 +1909,17 @@ def upload_submission():
     try:
         user_id_obj = ObjectId(request.current_user['_id']) # Need ObjectId for DB query
         user_email = request.current_user['email']
-        user_name = request.current_user.get('name', 'Unknown')
         user_role = request.current_user['role']
 
+        # Refuse oversize bodies from the declared length, before reading anything
+        if request.content_length and request.content_length > MAX_SUBMISSION_SIZE + UPLOAD_FORM_OVERHEAD:
+            limit_mb = MAX_SUBMISSION_SIZE / (1024 * 1024)
+            return jsonify({'message': f'File size exceeds limit ({limit_mb:.1f}MB)'}), 413
+
+        # File parts are streamed into the submissions folder while the body is parsed:
+        # type and size are checked on the fly and the SHA-256 is computed on the way in
+        request.upload_policy = UploadPolicy(UPLOAD_FOLDER_SUBMISSIONS, ALLOWED_SUBMISSION_EXTENSIONS, MAX_SUBMISSION_SIZE)
+
         # Check for file part
         if 'file' not in request.files:
             return jsonify({'message': 'No file part named "file"'}), 400
@@ -991,177 +1928,200 @@ def upload_submission():
             return jsonify({'message': 'No selected file'}), 400
 
         # Get form data
-        note = request.form.get('note', '').strip()
-        # Determine submission type (default to 'practice' if not specified)
-        submission_type = request.form.get('type', 'practice').lower()
-        related_id_str = request.form.get('relatedId') # e.g., courseId or challengeId
-        related_title = request.form.get('relatedTitle', 'N/A')
+        fields = {
+            'note': request.form.get('note', '').strip(),
+            # Determine submission type (default to 'practice' if not specified)
+            'type': request.form.get('type', 'practice').lower(),
+            'relatedId': request.form.get('relatedId'), # e.g., courseId or challengeId
+            'relatedTitle': request.form.get('relatedTitle', 'N/A')
+        }
 
         # Log received data for debugging
-        logger.info(f"Submission data received: type={submission_type}, relatedId={related_id_str}, relatedTitle={related_title}")
+        logger.info(f"Submission data received: type={fields['type']}, relatedId={fields['relatedId']}, relatedTitle={fields['relatedTitle']}")
 
         # Check if this is a challenge submission and if the student has already submitted today
-        if submission_type == 'challenge' and user_role == 'student':
-            # Get today's date in UTC
-            today = datetime.now(timezone.utc).date()
-            today_start = datetime.combine(today, datetime.min.time()).replace(tzinfo=timezone.utc)
-            today_end = datetime.combine(today, datetime.max.time()).replace(tzinfo=timezone.utc)
-
-            # Find if there's a submission for today by this user
-            existing_submission = db.submissions.find_one({
-                'userId': user_id_obj,
-                'type': 'challenge',
-                'createdAt': {'$gte': today_start, '$lte': today_end}
-            })
-
-            if existing_submission:
-                # Check if the existing submission was rejected
-                if existing_submission.get('status') != 'rejected':
-                    return jsonify({
-                        'message': 'Bạn chỉ được nộp một thử thách mỗi ngày. Vui lòng thử lại vào ngày mai.'
-                    }), 400
+        if challenge_limit_reached(user_id_obj, user_role, fields['type']):
+            return jsonify({'message': CHALLENGE_LIMIT_MESSAGE}), 400
 
-        # --- File Validation ---
+        # --- File Validation (size already enforced while streaming) ---
         filename = secure_filename(file.filename)
         if not allowed_file(filename, ALLOWED_SUBMISSION_EXTENSIONS):
             ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else '?'
             return jsonify({'message': f'File type "{ext}" not allowed. Allowed: {", ".join(ALLOWED_SUBMISSION_EXTENSIONS)}'}), 400
 
-        file.seek(0, os.SEEK_END)
-        file_length = file.tell()
-        file.seek(0)
-        if file_length > MAX_SUBMISSION_SIZE:
-            limit_mb = MAX_SUBMISSION_SIZE / (1024 * 1024)
-            return jsonify({'message': f'File size exceeds limit ({limit_mb:.1f}MB)'}), 413
-
-        # --- Process Related ID ---
-        related_object_id = None
-        collection_to_check = None
+        # Atomic rename of the streamed temp file (same folder, no second copy)
+        submission_doc, response_message = create_submission(
+            request.current_user, fields, filename, lambda file_path: commit_upload(file, file_path)
+        )
 
-        try:
-            if related_id_str and ObjectId.is_valid(related_id_str):
-                related_object_id = ObjectId(related_id_str)
-                # Determine which collection to check for the title based on type
-                if submission_type == 'challenge':
-                    collection_to_check = db.challenges
-                elif submission_type in ['practice', 'practice_video']: # Assuming practice relates to courses
-                    collection_to_check = db.courses
-                # Add other types if necessary (e.g., lessonId)
-
-                if collection_to_check:
-                    related_doc = collection_to_check.find_one({'_id': related_object_id}, {'title': 1})
-                    if related_doc:
-                        # If we found the document, use its title, otherwise use the provided title
-                        if not related_title or related_title == 'N/A':
-                            related_title = related_doc.get('title', 'Unknown Title')
-                    else:
-                        logger.warning(f"Related document not found for ID: {related_id_str} in collection {collection_to_check.name}")
-                        # Keep the provided title if the document wasn't found
-            elif related_id_str:
-                # Handle cases where relatedId might be a string identifier (like 'daily')
-                related_object_id = related_id_str # Store as string
-                # Keep the provided title
-
-            logger.info(f"Processed related ID: {related_id_str} -> {related_object_id}, Title: {related_title}")
-        except Exception as e:
-            logger.error(f"Error processing related ID: {e}")
-            # If there's an error, use the string version of the ID and keep the provided title
-            related_object_id = related_id_str
+        logger.info(f"Submission type '{fields['type']}' received from {user_email}. ID: {submission_doc['_id']}. Status: {submission_doc['status']}.")
+        return jsonify({'submission': submission_doc, 'message': response_message}), 201
 
+    except UploadRejected as e:
+        # Refused while streaming (type/size); the partial file is already gone
+        logger.info(f"Submission upload rejected: {e.message}")
+        return jsonify({'message': e.message}), e.status_code
+    except RequestEntityTooLarge:
+        limit_mb = MAX_SUBMISSION_SIZE / (1024 * 1024)
+        return jsonify({'message': f'File size exceeds limit ({limit_mb:.1f}MB)'}), 413
+    except Exception as e:
+        logger.error(f"Submission upload error: {e}", exc_info=True)
+        # Return more detailed error message for debugging
+        error_message = str(e)
+        return jsonify({
+            'message': 'Server error during submission upload',
+            'error': error_message
+        }), 500
 
-        # --- Save File ---
-        file_ext = filename.rsplit('.', 1)[1].lower()
-        timestamp = int(datetime.now(timezone.utc).timestamp())
-        unique_filename = f"{submission_type}_{str(user_id_obj)}_{timestamp}.{file_ext}"
-        file_path = os.path.join(UPLOAD_FOLDER_SUBMISSIONS, unique_filename)
-        file_url = f"/uploads/submissions/{unique_filename}"
+# --- Resumable submission uploads (tus-style) ---
+# 1. POST /api/uploads {filename, size, type, relatedId, relatedTitle, note} -> uploadId
+# 2. PATCH /api/uploads/<id> with header Upload-Offset and raw bytes (repeat; HEAD gives the offset after a drop)
+# 3. POST /api/uploads/<id>/complete -> creates the submission exactly like POST /api/submissions
+def _get_own_upload(upload_id):
+    # Returns the upload record if it exists and belongs to the current user, else None
+    record = resumable_uploads.get(upload_id)
+    if record is None or record.get('userId') != request.current_user['_id']:
+        return None
+    return record
+
+def _upload_offset_headers(response, record):
+    response.headers['Upload-Offset'] = str(record['offset'])
+    response.headers['Upload-Length'] = str(record['size'])
+    response.headers['Upload-Expires'] = datetime.fromtimestamp(record['expiresAt'], timezone.utc).isoformat()
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
-        file.save(file_path)
+@app.route('/api/uploads', methods=['POST'])
+@identity_required
+def create_resumable_upload():
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'message': 'Invalid JSON payload'}), 400
 
-        # --- Create Submission Document ---
-        submission_doc = {
-            'userId': user_id_obj,
-            'userEmail': user_email,
-            'userName': user_name,
-            'type': submission_type,
-            'relatedId': related_object_id, # Can be ObjectId or string
-            'relatedTitle': related_title,
-            'url': file_url,
-            'note': note,
-            'teacherComment': '',
-            'status': 'pending', # Default status
-            'pointsAwarded': 0,
-            'createdAt': datetime.now(timezone.utc),
-            'reviewedAt': None,
-            'reviewerId': None,
-            'originalFilename': filename # Store original filename for reference
+        user_id_obj = ObjectId(request.current_user['_id'])
+        filename = secure_filename(str(data.get('filename', '')))
+        try:
+            size = int(data.get('size', 0))
+        except (ValueError, TypeError):
+            size = 0
+        fields = {
+            'note': str(data.get('note', '')).strip(),
+            'type': str(data.get('type', 'practice')).lower(),
+            'relatedId': data.get('relatedId'),
+            'relatedTitle': data.get('relatedTitle', 'N/A')
         }
 
-        # --- Insert Submission ---
-        result = db.submissions.insert_one(submission_doc)
-        inserted_id = result.inserted_id
-        submission_doc['_id'] = inserted_id # Keep as ObjectId internally
-
-        # --- Auto-approve practice & Award points ---
-        points_to_add = 0
-        progress_to_add = 0
-        response_message = 'Submission received.'
+        # --- Same validation as POST /api/submissions, before any byte is sent ---
+        if not filename:
+            return jsonify({'message': 'No selected file'}), 400
+        if not allowed_file(filename, ALLOWED_SUBMISSION_EXTENSIONS):
+            ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else '?'
+            return jsonify({'message': f'File type "{ext}" not allowed. Allowed: {", ".join(ALLOWED_SUBMISSION_EXTENSIONS)}'}), 400
+        if size <= 0:
+            return jsonify({'message': 'File size required'}), 400
+        if size > MAX_SUBMISSION_SIZE:
+            limit_mb = MAX_SUBMISSION_SIZE / (1024 * 1024)
+            return jsonify({'message': f'File size exceeds limit ({limit_mb:.1f}MB)'}), 413
+        if challenge_limit_reached(user_id_obj, request.current_user['role'], fields['type']):
+            return jsonify({'message': CHALLENGE_LIMIT_MESSAGE}), 400
 
-        if user_role == 'student' and submission_type in ['practice', 'practice_video']:
-            points_to_add = 10 # Example points for practice
-            progress_to_add = 2 # Example progress
-            submission_doc['status'] = 'approved'
-            submission_doc['pointsAwarded'] = points_to_add
-            # Update status and points immediately in DB for auto-approved items
-            db.submissions.update_one(
-                {'_id': inserted_id},
-                {'$set': {'status': 'approved', 'pointsAwarded': points_to_add}}
-            )
-            response_message = f'Practice submission received, +{points_to_add} points!'
-        elif submission_type == 'challenge':
-             # Get potential points from the challenge document
-             challenge_points = 15 # Default if challenge not found or no points defined
-             if isinstance(related_object_id, ObjectId): # Only if it's a valid ID
-                 challenge = db.challenges.find_one({'_id': related_object_id})
-                 if challenge:
-                     challenge_points = challenge.get('points', 15)
-             elif related_object_id == 'daily': # Example handling for 'daily' identifier
-                 # Fetch the actual daily challenge to get points (more complex)
-                 # For simplicity, assume a default or handle based on frontend knowledge
-                 pass
+        upload_id = resumable_uploads.create(size, {'userId': request.current_user['_id'], 'filename': filename, 'fields': fields})
+        record = resumable_uploads.get(upload_id)
 
-             response_message = f'Challenge submission received. Waiting for review (potential +{challenge_points} points).'
+        logger.info(f"Resumable upload {upload_id} created by {request.current_user['email']} ({filename}, {size} bytes)")
+        response = jsonify({'uploadId': upload_id, 'offset': 0, 'size': size, 'expiresAt': record['expiresAt']})
+        response.headers['Location'] = f"/api/uploads/{upload_id}"
+        return _upload_offset_headers(response, record), 201
+    except Exception as e:
+        logger.error(f"Create resumable upload error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error creating upload'}), 500
 
+@app.route('/api/uploads/<upload_id>', methods=['HEAD', 'GET'])
+@identity_required
+def get_resumable_upload(upload_id):
+    try:
+        record = _get_own_upload(upload_id)
+        if record is None:
+            return jsonify({'message': 'Upload not found or expired'}), 404
+        response = jsonify({'uploadId': upload_id, 'offset': record['offset'], 'size': record['size'], 'expiresAt': record['expiresAt']})
+        return _upload_offset_headers(response, record)
+    except Exception as e:
+        logger.error(f"Get resumable upload error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error fetching upload'}), 500
 
-        # Update user points/progress if awarded automatically
-        if points_to_add > 0 or progress_to_add > 0:
-            update_result = db.users.update_one(
-                {'_id': user_id_obj},
-                {'$inc': {'points': points_to_add, 'progress': progress_to_add}}
-            )
-            if update_result.modified_count > 0:
-                # Fetch updated user data for ranking update
-                updated_user = db.users.find_one({'_id': user_id_obj})
-                _update_user_ranking(str(user_id_obj), stringify_ids(updated_user))
-                logger.info(f"Auto-awarded {points_to_add} points, {progress_to_add}% progress for submission {inserted_id} by {user_email}.")
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+@identity_required
+def patch_resumable_upload(upload_id):
+    try:
+        record = _get_own_upload(upload_id)
+        if record is None:
+            return jsonify({'message': 'Upload not found or expired'}), 404
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return jsonify({'message': 'Upload-Offset header required'}), 400
+
+        # Raw body streamed straight onto the partial file (no form parsing)
+        new_offset = resumable_uploads.append(upload_id, offset, request.stream)
+        record['offset'] = new_offset
+
+        response = make_response('', 204)
+        return _upload_offset_headers(response, record)
+    except UploadRejected as e:
+        response = jsonify({'message': e.message})
+        current = resumable_uploads.get(upload_id)
+        if current is not None:
+            _upload_offset_headers(response, current) # Lets the client resync after a 409
+        return response, e.status_code
+    except Exception as e:
+        logger.error(f"Patch resumable upload error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error writing upload chunk'}), 500
 
-        # Prepare response (stringify IDs)
-        response_submission = stringify_ids(submission_doc)
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@token_required
+def complete_resumable_upload(upload_id):
+    try:
+        record = _get_own_upload(upload_id)
+        if record is None:
+            return jsonify({'message': 'Upload not found or expired'}), 404
+        if record['offset'] != record['size']:
+            return jsonify({'message': f"Upload incomplete ({record['offset']}/{record['size']} bytes)", 'offset': record['offset']}), 409
+
+        fields = record['fields']
+        # Re-checked: another submission may have been made while this one was uploading
+        if challenge_limit_reached(ObjectId(request.current_user['_id']), request.current_user['role'], fields['type']):
+            resumable_uploads.delete(upload_id)
+            return jsonify({'message': CHALLENGE_LIMIT_MESSAGE}), 400
+
+        submission_doc, response_message = create_submission(
+            request.current_user, fields, record['filename'],
+            lambda file_path: resumable_uploads.finish(upload_id, file_path)
+        )
 
-        logger.info(f"Submission type '{submission_type}' received from {user_email}. ID: {inserted_id}. Status: {response_submission['status']}.")
-        return jsonify({'submission': response_submission, 'message': response_message}), 201
+        logger.info(f"Resumable upload {upload_id} completed as submission {submission_doc['_id']} by {request.current_user['email']}")
+        return jsonify({'submission': submission_doc, 'message': response_message}), 201
+    except UploadRejected as e:
+        return jsonify({'message': e.message}), e.status_code
+    except Exception as e:
+        logger.error(f"Complete resumable upload error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error completing upload'}), 500
 
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@identity_required
+def delete_resumable_upload(upload_id):
+    try:
+        if _get_own_upload(upload_id) is None:
+            return jsonify({'message': 'Upload not found or expired'}), 404
+        resumable_uploads.delete(upload_id)
+        logger.info(f"Resumable upload {upload_id} cancelled by {request.current_user['email']}")
+        return jsonify({'message': 'Upload cancelled'})
     except Exception as e:
-        logger.error(f"Submission upload error: {e}", exc_info=True)
-        # Return more detailed error message for debugging
-        error_message = str(e)
-        return jsonify({
-            'message': 'Server error during submission upload',
-            'error': error_message
-        }), 500
+        logger.error(f"Delete resumable upload error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error cancelling upload'}), 500
 
 @app.route('/api/submissions', methods=['GET', 'OPTIONS'])
-@token_required
+@identity_required
 def get_submissions():
     if request.method == 'OPTIONS':
         response = make_response()
@@ -1197,38 +2157,22 @@ def get_submissions():
         if status:
             query['status'] = status.lower()
 
-        # --- Pagination ---
-        try: page = int(request.args.get('page', 1))
-        except ValueError: page = 1
-        try: limit = int(request.args.get('limit', 10))
-        except ValueError: limit = 10
-        limit = max(1, min(limit, 100)) # Clamp limit
-        page = max(1, page)
-        skip = (page - 1) * limit
-
-        # --- Fetch Data ---
-        submissions_cursor = db.submissions.find(query).sort('createdAt', -1).skip(skip).limit(limit)
-        submissions = [stringify_ids(sub) for sub in submissions_cursor] # Stringify results
-
-        # Get total count for pagination info
-        total_submissions = db.submissions.count_documents(query)
-        total_pages = (total_submissions + limit - 1) // limit if limit > 0 else 0
+        # --- Fetch Data (cursor or page mode, see paginate_listing) ---
+        try:
+            page_data = paginate_listing(db.submissions, query, default_limit=10, max_limit=100)
+        except InvalidCursor:
+            return jsonify({'message': 'Invalid pagination cursor'}), 400
+        submissions = page_data.pop('rows') # Raw documents; ObjectIds/dates encoded by the JSON provider
 
-        logger.info(f"Submissions fetched by {request.current_user['email']} ({user_role}). Query: {query}, Page {page}, Limit {limit}. Found: {len(submissions)}/{total_submissions}")
-        return jsonify({
-            'submissions': submissions,
-            'total': total_submissions,
-            'page': page,
-            'limit': limit,
-            'totalPages': total_pages
-        })
+        logger.info(f"Submissions fetched by {request.current_user['email']} ({user_role}). Query: {query}, Page {page_data.get('page', 'cursor')}, Limit {page_data['limit']}. Found: {len(submissions)}/{page_data.get('total', '?')}")
+        return jsonify(dict(page_data, submissions=submissions))
 
     except Exception as e:
         logger.error(f"Submissions fetch error: {e}", exc_info=True)
         return jsonify({'message': 'Server error fetching submissions'}), 500
 
 @app.route('/api/submissions/user/<user_id>', methods=['GET'])
-@token_required
+@identity_required
 def get_user_submissions(user_id):
     try:
         # Check if the requesting user is the same as the user_id or is a teacher
@@ -1256,15 +2200,77 @@ def get_user_submissions(user_id):
         # Fetch submissions
         submissions = list(db.submissions.find(query).sort('createdAt', -1).limit(limit))
 
-        # Stringify ObjectIds
-        submissions = stringify_ids(submissions)
-
         logger.info(f"Fetched {len(submissions)} submissions for user {user_id}")
         return jsonify(submissions)
     except Exception as e:
         logger.error(f"Error fetching user submissions: {e}", exc_info=True)
         return jsonify({'message': 'Server error fetching user submissions'}), 500
 
+def submission_status_event(submission):
+    # Payload of the 'submission' user event: what the student UI needs to update a history row
+    reviewed_at = submission.get('reviewedAt')
+    related_id = submission.get('relatedId')
+    return {
+        '_id': str(submission['_id']),
+        'type': submission.get('type'),
+        'status': submission.get('status'),
+        'relatedId': str(related_id) if related_id is not None else None,
+        'relatedTitle': submission.get('relatedTitle'),
+        'pointsAwarded': submission.get('pointsAwarded', 0),
+        'teacherComment': submission.get('teacherComment', ''),
+        'reviewedAt': reviewed_at.isoformat() if isinstance(reviewed_at, datetime) else None
+    }
+
+# EventSource can't send headers, so the stream is authorized by a ticket in the URL. URLs end up in
+# proxy and access logs, so the ticket is not the session token: a JWT for the 'event-stream' audience
+# only (token_required rejects it) that expires STREAM_TICKET_TTL seconds after it was issued. It is
+# checked when the stream opens; the frontend fetches a new one for every (re)connect.
+STREAM_TICKET_AUDIENCE = 'event-stream'
+STREAM_TICKET_TTL = 60
+
+@app.route('/api/events/ticket', methods=['POST'])
+@token_required
+def issue_stream_ticket():
+    now = datetime.now(timezone.utc)
+    ticket = pyjwt.encode({'id': request.current_user['_id'], 'tokenVersion': request.current_user.get('tokenVersion') or 0,
+                           'aud': STREAM_TICKET_AUDIENCE, 'iat': now, 'exp': now + timedelta(seconds=STREAM_TICKET_TTL)},
+                          JWT_SECRET, algorithm="HS256")
+    return jsonify({'ticket': ticket, 'expiresIn': STREAM_TICKET_TTL})
+
+@app.route('/api/events/stream')
+def stream_user_events():
+    # One stream per tab: the signed-in user's events ('submission' reviewed, 'feedback' replied,
+    # 'notification') and, with ?rankings=1, the leaderboard 'update'/'delta' events as well.
+    # Authorized by ?ticket= from POST /api/events/ticket.
+    ticket = request.args.get('ticket')
+    if not ticket:
+        return jsonify({'message': 'Stream ticket missing'}), 401
+    try:
+        data = pyjwt.decode(ticket, JWT_SECRET, algorithms=["HS256"], audience=STREAM_TICKET_AUDIENCE,
+                            options={"verify_exp": True})
+    except pyjwt.ExpiredSignatureError:
+        return jsonify({'message': 'Stream ticket has expired'}), 401
+    except pyjwt.InvalidTokenError as e:
+        logger.warning(f"Event stream auth failed: {e}")
+        return jsonify({'message': 'Invalid stream ticket'}), 401
+    user_id = data.get('id')
+    if not user_id or not ObjectId.is_valid(user_id):
+        return jsonify({'message': 'Invalid token payload'}), 401
+    if not token_revocations.is_valid(user_id, data.get('tokenVersion')):
+        return jsonify({'message': 'Token has been revoked'}), 401
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    if request.args.get('rankings', '').lower() not in ('1', 'true', 'yes'):
+        return sse_response(lambda: user_events.stream(user_id, last_event_id))
+
+    def live_events():
+        # Ids are '<ranking version>:<user event id>', so a reconnect resumes both
+        ranking_version, user_event_id = parse_event_ids(last_event_id, 2)
+        wakeup = threading.Event()
+        sources = [ranking_broadcaster.subscribe(ranking_version, wakeup), user_events.subscribe(user_id, user_event_id, wakeup)]
+        yield from stream_sources(sources, wakeup)
+    return sse_response(live_events)
+
 @app.route('/api/submissions/<submission_id_str>/review', methods=['PUT'])
 @teacher_required
 def review_submission(submission_id_str):
@@ -1325,26 +2331,28 @@ def review_submission(submission_id_str):
         # --- Update Student Points/Progress if Approved ---
         student_id_obj = submission.get('userId')
         if status == 'approved' and points_awarded > 0 and student_id_obj and isinstance(student_id_obj, ObjectId):
-            student = db.users.find_one({'_id': student_id_obj})
-            if student and student.get('role') == 'student':
-                # Define progress increase (e.g., based on points or fixed)
-                progress_to_add = 5 # Example: 5% progress for approved submission
-                update_student_result = db.users.update_one(
-                    {'_id': student_id_obj},
-                    {'$inc': {'points': points_awarded, 'progress': progress_to_add}}
-                )
-                if update_student_result.modified_count > 0:
-                    # Fetch updated student data for ranking update
-                    updated_student = db.users.find_one({'_id': student_id_obj})
-                    _update_user_ranking(str(student_id_obj), stringify_ids(updated_student))
-                    logger.info(f"Awarded {points_awarded} points, {progress_to_add}% progress to student {student_id_obj} for submission {submission_id_str}")
-                else:
-                     logger.warning(f"Failed to update points/progress for student {student_id_obj} after reviewing {submission_id_str}")
+            # Define progress increase (e.g., based on points or fixed)
+            progress_to_add = 5 # Example: 5% progress for approved submission
+            # award_points only matches students, so no separate role lookup is needed
+            if award_points(student_id_obj, points_awarded, progress_to_add):
+                logger.info(f"Awarded {points_awarded} points, {progress_to_add}% progress to student {student_id_obj} for submission {submission_id_str}")
+            else:
+                logger.warning(f"Failed to update points/progress for student {student_id_obj} after reviewing {submission_id_str} (not found or not a student)")
 
+        expire_analytics_snapshot() # Pending/approved/rejected counts changed
 
         # --- Prepare and Return Response ---
         updated_submission = db.submissions.find_one({'_id': submission_id_obj})
-        response_data = stringify_ids(updated_submission) # Stringify all ObjectIds
+        response_data = updated_submission
+        # Tell the student's open tabs right away (replaces their status polling)
+        if student_id_obj:
+            user_events.publish(student_id_obj, 'submission', submission_status_event(updated_submission))
+        if isinstance(student_id_obj, ObjectId):
+            title = submission.get('relatedTitle') or submission.get('type', 'submission')
+            message = f"Your submission \"{title}\" has been {status}" + \
+                      (f" with {points_awarded} points!" if status == 'approved' else f". Teacher comment: {teacher_comment}")
+            create_notification(student_id_obj, f"{submission.get('type', 'submission')}_review", message,
+                                relatedId=submission_id_obj, status=status)
 
         logger.info(f"Submission {submission_id_str} reviewed by {reviewer_email}. Status: {status}, Points: {points_awarded}")
         return jsonify(response_data)
@@ -1359,8 +2367,29 @@ def get_flashcards(category):
         return '', 200
     return jsonify([{'_id': '1', 'question': 'Sample', 'answer': 'Answer'}])
 
+@app.route('/api/flashcards', methods=['GET'])
+@identity_required # Usually requires login to access learning materials
+def get_flashcards_by_query():
+    # /api/flashcards?category=<name>, as called by the flashcard page
+    try:
+        category = request.args.get('category', 'sao') # Default category if none provided
+        allowed_categories = ['sao', 'dan-tranh', 'dan-nguyet', 'vovinam']
+        if category not in allowed_categories:
+            return jsonify({'message': 'Invalid flashcard category'}), 400
+
+        # Cached per category in the shared cache (see get_cached_catalog)
+        flashcards = get_cached_catalog(
+            f"flashcards:{category}",
+            lambda: [stringify_ids(card) for card in db.flashcards.find({'category': category})]
+        )
+        logger.info(f"Flashcards fetched for category '{category}' for user {request.current_user['_id']}")
+        return jsonify(flashcards)
+    except Exception as e:
+        logger.error(f"Flashcards fetch error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error fetching flashcards'}), 500
+
 @app.route('/api/flashcards/progress', methods=['POST'])
-@token_required
+@identity_required
 def save_flashcard_progress():
     # This endpoint saves the *state* of flashcards (e.g., learned, reviewed count)
     # Points/score updates should happen via a separate "test complete" endpoint
@@ -1399,6 +2428,7 @@ def save_flashcard_progress():
 
         # Apply updates to the user document
         result = db.users.update_one({'_id': user_id_obj}, {'$set': update_ops})
+        invalidate_user_cache(user_id_obj)
 
         if result.matched_count > 0:
             logger.info(f"Flashcard progress saved for category '{category}' for user {user_id_obj}")
@@ -1442,26 +2472,20 @@ def complete_flashcard_test():
         # Define progress gain for completing a test
         progress_earned = 5 # Example: 5% progress boost
 
-        # Update user points and progress
-        update_result = db.users.update_one(
-            {'_id': user_id_obj},
-            {'$inc': {'points': points_earned, 'progress': progress_earned}}
-        )
+        # Update user points and progress (also updates level and ranking)
+        awarded_fields = award_points(user_id_obj, points_earned, progress_earned)
 
-        if update_result.modified_count > 0:
-            # Fetch updated user data for ranking update and response
-            updated_user = db.users.find_one({'_id': user_id_obj})
-            _update_user_ranking(str(user_id_obj), stringify_ids(updated_user)) # Update ranking
+        if awarded_fields:
             logger.info(f"Flashcard test recorded for student {user_id_obj}. Points: +{points_earned}, Progress: +{progress_earned}%")
-            # Return updated user data (stringified)
-            user_data_for_client = stringify_ids({k: v for k, v in updated_user.items() if k != 'password'})
+            # Return the request's user context with the freshly updated fields (no extra fetch)
+            user_data_for_client = dict(request.current_user, **awarded_fields)
             return jsonify({'message': f'Test completed! +{points_earned} points.', 'user': user_data_for_client})
         else:
             # User found but no change occurred (highly unlikely with $inc > 0)
             logger.warning(f"Flashcard test completion recorded for {user_id_obj}, but points/progress did not update.")
             # Return current user data
             current_user_data = db.users.find_one({'_id': user_id_obj}, {'password': 0})
-            user_data_for_client = stringify_ids(current_user_data)
+            user_data_for_client = current_user_data
             return jsonify({'message': 'Test recorded, but no change in points/progress.', 'user': user_data_for_client}), 200
 
     except Exception as e:
@@ -1469,34 +2493,18 @@ def complete_flashcard_test():
         return jsonify({'message': 'Server error processing flashcard test completion'}), 500
 
 @app.route('/api/challenges', methods=['GET'])
-@token_required # Usually requires login
+@identity_required # Usually requires login
 def get_challenges():
     try:
-        # --- Pagination ---
-        try: page = int(request.args.get('page', 1))
-        except ValueError: page = 1
-        try: limit = int(request.args.get('limit', 10))
-        except ValueError: limit = 10
-        limit = max(1, min(limit, 50)) # Clamp limit
-        page = max(1, page)
-        skip = (page - 1) * limit
-
-        # --- Fetch Data ---
-        challenges_cursor = db.challenges.find({}).sort('createdAt', -1).skip(skip).limit(limit)
-        # <<< MODIFIED >>> Ensure _id is stringified correctly
-        challenges = [stringify_ids(c) for c in challenges_cursor]
-
-        total_challenges = db.challenges.count_documents({})
-        total_pages = (total_challenges + limit - 1) // limit if limit > 0 else 0
+        # --- Fetch Data (cursor or page mode, see paginate_listing) ---
+        try:
+            page_data = paginate_listing(db.challenges, {}, default_limit=10, max_limit=50)
+        except InvalidCursor:
+            return jsonify({'message': 'Invalid pagination cursor'}), 400
+        challenges = page_data.pop('rows') # _id is stringified by the JSON provider
 
-        logger.info(f"Challenges fetched by user {request.current_user['_id']}. Page {page}, Limit {limit}. Found: {len(challenges)}/{total_challenges}")
-        return jsonify({
-            'challenges': challenges,
-            'total': total_challenges,
-            'page': page,
-            'limit': limit,
-            'totalPages': total_pages
-        })
+        logger.info(f"Challenges fetched by user {request.current_user['_id']}. Page {page_data.get('page', 'cursor')}, Limit {page_data['limit']}. Found: {len(challenges)}/{page_data.get('total', '?')}")
+        return jsonify(dict(page_data, challenges=challenges))
     except Exception as e:
         logger.error(f"Challenges fetch error: {e}", exc_info=True)
         return jsonify({'message': 'Server error fetching challenges'}), 500
@@ -1504,7 +2512,7 @@ def get_challenges():
 
 
 @app.route('/api/challenges/daily', methods=['GET'])
-@token_required
+@identity_required
 def get_daily_challenge():
     try:
         # Get today's date in UTC
@@ -1568,20 +2576,20 @@ def get_daily_challenge():
             logger.warning("No daily challenge found in MongoDB.")
             return jsonify({'message': 'No daily challenge found in database'}), 404
 
-        # Return the challenge (stringify ObjectIds)
+        # Return the challenge
         logger.info(f"Daily challenge fetched by user {request.current_user['_id']}")
-        return jsonify(stringify_ids(daily_challenge))
+        return jsonify(daily_challenge)
     except Exception as e:
         logger.error(f"Daily challenge fetch error: {e}", exc_info=True)
         return jsonify({'message': 'Server error fetching daily challenge'}), 500
 
 @app.route('/api/learning-path', methods=['GET'])
-@token_required # Usually requires login
+@identity_required # Usually requires login
 def get_learning_path():
     try:
         # Fetch items sorted by 'order' field
         learning_path_cursor = db.learning_path.find().sort('order', 1)
-        learning_path = [stringify_ids(item) for item in learning_path_cursor]
+        learning_path = list(learning_path_cursor)
 
         logger.info(f"Learning path fetched for user {request.current_user['_id']}")
         return jsonify(learning_path)
@@ -1702,7 +2710,7 @@ game_questions_lookup = {q['id']: q for type_list in game_questions_db_mock.valu
 # END MOCK
 
 @app.route('/api/mini-game/start', methods=['GET'])
-@token_required
+@identity_required
 def start_mini_game():
      try:
          user_id_obj = ObjectId(request.current_user['_id']) # Need ObjectId for DB query
@@ -1755,7 +2763,7 @@ def start_mini_game():
          return jsonify({'message': 'Server error starting mini-game'}), 500
 
 @app.route('/api/mini-game/submit', methods=['POST'])
-@token_required
+@identity_required
 def submit_mini_game_answer():
     try:
         user_id_obj = ObjectId(request.current_user['_id']) # Need ObjectId for DB query
@@ -1792,14 +2800,7 @@ def submit_mini_game_answer():
         # Award points and update ranking if correct and user is a student
         if is_correct and user_role == 'student':
             response_data['pointsAwarded'] = points_to_award
-            update_result = db.users.update_one(
-                {'_id': user_id_obj},
-                {'$inc': {'points': points_to_award}}
-            )
-            if update_result.modified_count > 0:
-                # Fetch updated user data for ranking update
-                updated_user = db.users.find_one({'_id': user_id_obj})
-                _update_user_ranking(str(user_id_obj), stringify_ids(updated_user))
+            if award_points(user_id_obj, points_to_award):
                 logger.info(f"Mini-game {game_id} correct for student {user_id_obj}. Points: +{points_to_award}")
             else:
                  logger.warning(f"Mini-game {game_id} correct, but failed to update points for student {user_id_obj}.")
@@ -1815,6 +2816,93 @@ def submit_mini_game_answer():
         logger.error(f"Submit mini-game answer error: {e}", exc_info=True)
         return jsonify({'message': 'Server error submitting mini-game answer'}), 500
 
+def build_gemini_payload(data):
+    # generateContent request body for an /api/chat JSON body ({question, history}); None without a question
+    # Get question (which includes context/prompt from frontend)
+    question_with_context = (data.get('question') or '').strip()
+    # Get optional chat history from frontend for context
+    chat_history = data.get('history', [])
+    if not question_with_context:
+        return None
+
+    # --- Prepare payload for Gemini API ---
+    contents = []
+    # Add validated history (basic check)
+    if isinstance(chat_history, list):
+        valid_history = [
+            msg for msg in chat_history
+            if isinstance(msg, dict) and
+               msg.get('role') in ['user', 'model'] and # Valid roles
+               isinstance(msg.get('parts'), list) and len(msg['parts']) > 0 and
+               isinstance(msg['parts'][0].get('text'), str) # Basic text part check
+        ]
+        contents.extend(valid_history)
+    # Add the current user question
+    contents.append({"role": "user", "parts": [{"text": question_with_context}]})
+
+    # API Payload
+    return {
+        "contents": contents,
+        "generationConfig": {
+            "temperature": 0.7, # Controls randomness (0=deterministic, 1=creative)
+            "topK": 40,         # Considers top K tokens
+            "topP": 0.95,       # Considers tokens with cumulative probability >= P
+            "maxOutputTokens": 1500, # Limit response length
+            # "stopSequences": ["\n\n"] # Optional sequences to stop generation
+        },
+        "safetySettings": [ # Configure safety filters
+            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+        ]
+    }
+
+def gemini_blocked_reply(response_data, user_id):
+    # Message for a response without candidates (prompt blocked), else None
+    if response_data.get('candidates'):
+        return None
+    block_reason = response_data.get('promptFeedback', {}).get('blockReason', 'Unknown')
+    safety_ratings = response_data.get('promptFeedback', {}).get('safetyRatings', [])
+    logger.warning(f"Gemini response blocked or empty for user {user_id}. Reason: {block_reason}, Ratings: {safety_ratings}")
+    # Provide a user-friendly message based on reason if possible
+    if block_reason == 'SAFETY':
+        return "My safety filters prevented generating a response for this topic."
+    return "I cannot provide a response due to content restrictions."
+
+def gemini_finish_note(finish_reason):
+    # Note appended to a reply that stopped for another reason than STOP, else None
+    if finish_reason == 'MAX_TOKENS':
+        return "\n(Note: My response might have been cut short.)"
+    elif finish_reason == 'SAFETY':
+        return "\n(Note: The generated response was partially blocked due to safety filters.)"
+    elif finish_reason == 'RECITATION':
+        return "\n(Note: Response might contain recited content.)"
+    return None
+
+def gemini_error_response(e, user_id):
+    # JSON error reply for a failed Gemini call (busy, HTTP error, timeout, network)
+    if isinstance(e, GeminiBusy):
+        logger.warning(f"Chat request from user {user_id} rejected: {e}")
+        return jsonify({'reply': 'The chatbot is experiencing high traffic right now. Please try again in a moment.'}), 503
+    if isinstance(e, requests.exceptions.HTTPError):
+        status_code = e.response.status_code
+        error_detail = e.response.text
+        logger.error(f"Gemini API HTTP error ({status_code}) for user {user_id}: {error_detail}")
+        reply = f"Sorry, the AI service encountered an error ({status_code}). Please try again later."
+        if status_code == 429: # Too Many Requests
+            reply = "The chatbot is experiencing high traffic right now. Please try again in a moment."
+        elif status_code >= 500: # Server errors
+            reply = "The AI service is temporarily unavailable. Please try again later."
+        # Return the appropriate status code from the API if possible
+        return jsonify({'reply': reply}), status_code if status_code in [429, 500, 503] else 502 # Bad Gateway
+    if isinstance(e, requests.exceptions.Timeout):
+        logger.error(f"Gemini API request timed out for user {user_id}")
+        return jsonify({'reply': 'The AI assistant took too long to respond. Please try again.'}), 504 # Gateway Timeout
+    # Other network-related errors (DNS, connection refused, etc.)
+    logger.error(f"Network error calling Gemini API: {e}")
+    return jsonify({'reply': 'There was a network problem connecting to the AI assistant.'}), 504 # Gateway Timeout
+
 @app.route('/api/chat', methods=['POST'])
 @token_required
 def chat_with_gemini():
@@ -1828,70 +2916,19 @@ def chat_with_gemini():
         data = request.get_json()
         if not data:
             return jsonify({'message': 'Invalid JSON payload'}), 400
-
-        # Get question (which includes context/prompt from frontend)
-        question_with_context = data.get('question', '').strip()
-        # Get optional chat history from frontend for context
-        chat_history = data.get('history', [])
-
-        if not question_with_context:
+        payload = build_gemini_payload(data)
+        if payload is None:
             return jsonify({'message': 'Question required'}), 400
 
-        # --- Prepare payload for Gemini API ---
-        contents = []
-        # Add validated history (basic check)
-        if isinstance(chat_history, list):
-            valid_history = [
-                msg for msg in chat_history
-                if isinstance(msg, dict) and
-                   msg.get('role') in ['user', 'model'] and # Valid roles
-                   isinstance(msg.get('parts'), list) and len(msg['parts']) > 0 and
-                   isinstance(msg['parts'][0].get('text'), str) # Basic text part check
-            ]
-            contents.extend(valid_history)
-        # Add the current user question
-        contents.append({"role": "user", "parts": [{"text": question_with_context}]})
-
-        # API Payload
-        payload = {
-            "contents": contents,
-            "generationConfig": {
-                "temperature": 0.7, # Controls randomness (0=deterministic, 1=creative)
-                "topK": 40,         # Considers top K tokens
-                "topP": 0.95,       # Considers tokens with cumulative probability >= P
-                "maxOutputTokens": 1500, # Limit response length
-                # "stopSequences": ["\n\n"] # Optional sequences to stop generation
-            },
-            "safetySettings": [ # Configure safety filters
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            ]
-        }
-
-        # --- Make API Call ---
-        api_url_with_key = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
-        headers = {"Content-Type": "application/json"}
-
+        # --- Make API Call (pooled connection, bounded concurrency; see gemini_client.py) ---
         logger.info(f"Sending chat request to Gemini for user {user_info['_id']}...")
-        # Set a reasonable timeout (e.g., 45 seconds)
-        response = requests.post(api_url_with_key, headers=headers, json=payload, timeout=45)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        response_data = response.json()
+        response_data = gemini.generate(payload)
 
         # --- Process Response ---
         # Check for blocked content or missing candidates
-        if not response_data.get('candidates'):
-             block_reason = response_data.get('promptFeedback', {}).get('blockReason', 'Unknown')
-             safety_ratings = response_data.get('promptFeedback', {}).get('safetyRatings', [])
-             logger.warning(f"Gemini response blocked or empty for user {user_info['_id']}. Reason: {block_reason}, Ratings: {safety_ratings}")
-             # Provide a user-friendly message based on reason if possible
-             reply_message = "I cannot provide a response due to content restrictions."
-             if block_reason == 'SAFETY':
-                 reply_message = "My safety filters prevented generating a response for this topic."
-             return jsonify({'reply': reply_message})
+        blocked_reply = gemini_blocked_reply(response_data, user_info['_id'])
+        if blocked_reply:
+            return jsonify({'reply': blocked_reply})
 
         # Extract reply text
         try:
@@ -1900,48 +2937,179 @@ def chat_with_gemini():
              logger.error(f"Error parsing Gemini response structure for user {user_info['_id']}: {e}. Response: {response_data}")
              return jsonify({'reply': 'Sorry, I encountered an issue processing the response.'})
 
-
         # Check finish reason (optional, but informative)
         finish_reason = response_data['candidates'][0].get('finishReason', 'STOP')
         if finish_reason != 'STOP':
             logger.warning(f"Gemini generation finished with reason: {finish_reason} for user {user_info['_id']}")
-            if finish_reason == 'MAX_TOKENS':
-                reply += "\n(Note: My response might have been cut short.)"
-            elif finish_reason == 'SAFETY':
+            if finish_reason == 'SAFETY':
                 # This case might be handled by the 'candidates' check earlier, but double-check
                 reply = "The generated response was partially blocked due to safety filters."
-            elif finish_reason == 'RECITATION':
-                 reply += "\n(Note: Response might contain recited content.)"
-
+            else:
+                reply += gemini_finish_note(finish_reason) or ''
 
         logger.info(f"Chatbot reply generated successfully for user {user_info['_id']}")
         return jsonify({'reply': reply.strip()})
 
     # --- Error Handling for API Call ---
-    except requests.exceptions.HTTPError as e:
-         status_code = e.response.status_code
-         error_detail = e.response.text
-         logger.error(f"Gemini API HTTP error ({status_code}) for user {request.current_user['_id']}: {error_detail}")
-         reply = f"Sorry, the AI service encountered an error ({status_code}). Please try again later."
-         if status_code == 429: # Too Many Requests
-             reply = "The chatbot is experiencing high traffic right now. Please try again in a moment."
-         elif status_code >= 500: # Server errors
-              reply = "The AI service is temporarily unavailable. Please try again later."
-         # Return the appropriate status code from the API if possible
-         return jsonify({'reply': reply}), status_code if status_code in [429, 500, 503] else 502 # Bad Gateway
-    except requests.exceptions.Timeout:
-        logger.error(f"Gemini API request timed out for user {request.current_user['_id']}")
-        return jsonify({'reply': 'The AI assistant took too long to respond. Please try again.'}), 504 # Gateway Timeout
-    except requests.exceptions.RequestException as e:
-        # Catch other network-related errors (DNS, connection refused, etc.)
-        logger.error(f"Network error calling Gemini API: {e}")
-        return jsonify({'reply': 'There was a network problem connecting to the AI assistant.'}), 504 # Gateway Timeout
+    except (GeminiBusy, requests.exceptions.RequestException) as e:
+        return gemini_error_response(e, request.current_user['_id'])
     except Exception as e:
         # Catch-all for unexpected errors during processing
         logger.error(f"Chat processing error: {e}", exc_info=True)
         return jsonify({'message': 'Server error processing chat request'}), 500
 
+def _sse_event(data, event=None):
+    return (f"event: {event}\n" if event else '') + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/chat/stream', methods=['POST'])
+@identity_required
+def chat_with_gemini_stream():
+    # Same request as /api/chat; the reply is relayed as Server-Sent Events while Gemini writes it:
+    #   data: {"text": "..."}                                  one per chunk, in order
+    #   event: done   data: {"finishReason": ..., "note": ...}
+    #   event: error  data: {"reply": "..."}                   failure after the stream started
+    # Failures before the first chunk (busy, HTTP error, timeout) are answered like /api/chat.
+    if not GEMINI_API_KEY:
+        logger.error("Chatbot request received but GEMINI_API_KEY is not configured.")
+        return jsonify({'reply': 'Sorry, the chatbot is currently unavailable (Configuration Error).'}), 503
+
+    user_id = request.current_user['_id']
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'message': 'Invalid JSON payload'}), 400
+        payload = build_gemini_payload(data)
+        if payload is None:
+            return jsonify({'message': 'Question required'}), 400
+        chunks = gemini.stream(payload)
+        first_chunk = next(chunks, None) # Sends the request; errors still get a normal HTTP status
+    except (GeminiBusy, requests.exceptions.RequestException) as e:
+        return gemini_error_response(e, user_id)
+    except Exception as e:
+        logger.error(f"Chat stream error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error processing chat request'}), 500
+
+    def generate():
+        finish_reason = None
+        try:
+            chunk = first_chunk
+            blocked_reply = gemini_blocked_reply(chunk, user_id) if chunk is not None else None
+            if blocked_reply:
+                yield _sse_event({'text': blocked_reply})
+                finish_reason, chunk = 'BLOCKED', None
+            while chunk is not None:
+                text = chunk_text(chunk)
+                if text:
+                    yield _sse_event({'text': text})
+                finish_reason = (chunk.get('candidates') or [{}])[0].get('finishReason') or finish_reason
+                chunk = next(chunks, None)
+            if finish_reason not in (None, 'STOP', 'BLOCKED'):
+                logger.warning(f"Gemini generation finished with reason: {finish_reason} for user {user_id}")
+            yield _sse_event({'finishReason': finish_reason or 'STOP', 'note': gemini_finish_note(finish_reason)}, 'done')
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Gemini stream interrupted for user {user_id}: {e}")
+            yield _sse_event({'reply': 'The connection to the AI assistant was interrupted. Please try again.'}, 'error')
+        except Exception as e: # e.g. ValueError from a malformed "data:" line; the client still gets an end event
+            logger.error(f"Gemini stream error for user {user_id}: {e}", exc_info=True)
+            yield _sse_event({'reply': 'Sorry, something went wrong while generating the reply. Please try again.'}, 'error')
+        finally:
+            chunks.close() # Releases the Gemini connection and chat slot if the browser disconnected
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    response.call_on_close(chunks.close) # Also when the body is never iterated
+    return response
+
 # --- Static File Serving (Uploads) ---
+# Upload URLs never change content: blobs, variants and renditions are named by SHA-256 and
+# legacy files by user + timestamp. Browsers may keep them for a year without revalidating;
+# send_from_directory answers If-None-Match/If-Modified-Since with 304 and Range with 206.
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600
+
+def _is_sha256(value):
+    return len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def content_etag(relative_path):
+    # Strong ETag from the hash in content-addressed paths (blobs/ab/cd/<sha>.<ext>,
+    # variants|renditions/<sha>/<name>); None lets Werkzeug use mtime-size for legacy names
+    parts = relative_path.split('/')
+    if len(parts) >= 2 and _is_sha256(parts[-2]):
+        return f"{parts[-2]}-{parts[-1]}"
+    stem = parts[-1].split('.', 1)[0]
+    return stem if _is_sha256(stem) else None
+
+def send_upload(directory, relative_path, scope='public', immutable=True, **kwargs):
+    # send_from_directory with a strong ETag and Cache-Control for `scope` ('public', or 'private'
+    # for files behind a login). Mutable URLs are cached too but revalidated on every use.
+    if file_offload.enabled:
+        # The proxy handles ETag, 304 and Range itself; the headers set below are passed through
+        response = file_offload.response(directory, relative_path, **kwargs)
+    else:
+        response = send_from_directory(directory, relative_path, etag=content_etag(relative_path) or True,
+                                       conditional=True, **kwargs)
+    if immutable:
+        response.headers['Cache-Control'] = f"{scope}, max-age={UPLOAD_CACHE_MAX_AGE}, immutable"
+    else:
+        response.headers['Cache-Control'] = f"{scope}, no-cache"
+    response.headers.pop('Expires', None)
+    response.headers['Accept-Ranges'] = 'bytes' # Lets video players seek with Range requests from the first response
+    return response
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    # Frontend assets: fingerprinted names (from the build manifest) are cached for a year,
+    # logical names revalidated. No per-request logging: a page load fetches dozens of these.
+    try:
+        if '..' in filename or filename.startswith('/'):
+            raise ValueError("Invalid path pattern")
+        entry, fingerprinted = asset_manifest.resolve(filename)
+        if entry is None:
+            # Not part of the build (or no build yet): the file as-is
+            return send_upload(ASSETS_DIR, filename, immutable=False)
+        # A proxy that offloads the bytes does its own compression (gzip_static/brotli_static)
+        encoding = None if file_offload.enabled else choose_encoding(entry, request.accept_encodings)
+        build_path = entry['path'] + (ENCODING_SUFFIXES[encoding] if encoding else '')
+        response = send_upload(ASSET_BUILD_DIR, build_path, immutable=fingerprinted,
+                               mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if entry['encodings']:
+            response.vary.add('Accept-Encoding')
+        return response
+    except (FileNotFoundError, NotFound):
+        return jsonify({'message': 'Asset not found'}), 404
+    except RequestedRangeNotSatisfiable as e:
+        return e
+    except ValueError as e:
+        logger.warning(f"Invalid asset request: {filename}. Error: {e}")
+        return jsonify({'message': 'Invalid filename'}), 400
+    except Exception as e:
+        logger.error(f"Serve asset error for {filename}: {e}", exc_info=True)
+        return jsonify({'message': 'Server error serving asset'}), 500
+
+_index_html_cache = {} # index.html mtime -> page with fingerprinted asset URLs
+
+@app.route('/')
+@app.route('/index.html')
+def serve_index():
+    # The SPA shell, pointing at fingerprinted assets; small and revalidated on every load
+    index_path = os.path.join(app.static_folder, 'index.html')
+    try:
+        mtime = os.path.getmtime(index_path)
+    except FileNotFoundError:
+        return jsonify({'message': 'Frontend not found'}), 404
+    html = _index_html_cache.get(mtime)
+    if html is None:
+        with open(index_path, encoding='utf-8') as f:
+            html = asset_manifest.rewrite_html(f.read())
+        _index_html_cache.clear()
+        _index_html_cache[mtime] = html
+    response = make_response(html)
+    response.mimetype = 'text/html'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route('/uploads/avatars/<path:filename>')
 def serve_avatar(filename):
@@ -1950,12 +3118,14 @@ def serve_avatar(filename):
         # Basic security check
         if '..' in filename or filename.startswith('/'):
             raise ValueError("Invalid filename pattern")
-        return send_from_directory(UPLOAD_FOLDER_AVATARS, filename)
-    except FileNotFoundError:
+        return send_upload(UPLOAD_FOLDER_AVATARS, filename)
+    except (FileNotFoundError, NotFound):
         logger.warning(f"Avatar file not found: {filename}")
         # Return a default avatar or 404
         # return send_from_directory('path/to/defaults', 'default_avatar.png')
         return jsonify({'message': 'Avatar not found'}), 404
+    except RequestedRangeNotSatisfiable as e:
+        return e # 416 with Content-Range: bytes */size
     except ValueError as e:
         logger.warning(f"Invalid avatar filename request: {filename}. Error: {e}")
         return jsonify({'message': 'Invalid filename'}), 400
@@ -1963,8 +3133,35 @@ def serve_avatar(filename):
         logger.error(f"Serve avatar error: {e}")
         return jsonify({'message': 'Server error serving avatar'}), 500
 
+# Lookups behind serve_submission: a video is fetched as many Range requests, so the file's
+# submission (owner + rendition) is remembered per file and requester for a short while
+SUBMISSION_ACCESS_TTL = int(os.getenv("SUBMISSION_ACCESS_TTL", 60)) # Seconds a file -> submission lookup is reused
+submission_access_cache = TTLCache(max_size=int(os.getenv("SUBMISSION_ACCESS_CACHE_SIZE", 2000)),
+                                   ttl=SUBMISSION_ACCESS_TTL, name='submission_access')
+
+def find_submission_for_file(filename, current_user):
+    # The submission that lets current_user read /uploads/submissions/<filename>, or None.
+    # Teachers may read any submission; deduplicated files are shared by several submissions,
+    # so students look for one of their own.
+    is_teacher = current_user['role'] == 'teacher'
+    cache_key = (filename, 'teacher' if is_teacher else current_user['_id'])
+    submission = submission_access_cache.get(cache_key)
+    if submission is not None:
+        return submission
+    path_parts = filename.split('/')
+    if path_parts[0] == 'renditions' and len(path_parts) == 3:
+        query = {'sha256': path_parts[1], 'rendition.status': 'ready'} # Renditions: by the source hash in their path
+    else:
+        query = {'url': f"/uploads/submissions/{filename}"} # Indexed (submission_url_user)
+    if not is_teacher:
+        query['userId'] = ObjectId(current_user['_id'])
+    submission = db.submissions.find_one(query, {'userId': 1, 'url': 1, 'rendition': 1})
+    if submission is not None:
+        submission_access_cache.set(cache_key, submission)
+    return submission
+
 @app.route('/uploads/submissions/<path:filename>')
-@token_required # Require login to access submission files
+@identity_required # Require login to access submission files
 def serve_submission(filename):
     # Serve submission files, requires authentication and authorization
     try:
@@ -1976,14 +3173,10 @@ def serve_submission(filename):
         file_url_path = f"/uploads/submissions/{filename}"
 
         # Find the submission document by its URL
-        submission = db.submissions.find_one({'url': file_url_path})
+        submission = find_submission_for_file(filename, request.current_user)
         if not submission:
-             # Try finding by just filename if URL storage might be inconsistent
-             alt_submission = db.submissions.find_one({'originalFilename': filename}) # Less reliable
-             if alt_submission: submission = alt_submission
-             else:
-                logger.warning(f"Submission file or record not found for filename: {filename} (URL Path: {file_url_path})")
-                return jsonify({'message': 'Submission record not found or file path mismatch'}), 404
+            logger.warning(f"Submission file or record not found for filename: {filename} (URL Path: {file_url_path})")
+            return jsonify({'message': 'Submission record not found or file path mismatch'}), 404
 
 
         # --- Authorization Check ---
@@ -1994,17 +3187,28 @@ def serve_submission(filename):
         # Allow access if user is the owner OR if user is a teacher
         if user_id_str == submission_owner_id_str or user_role == 'teacher':
             logger.info(f"Serving submission '{filename}' to user {user_id_str} (Role: {user_role})")
+            rendition = submission.get('rendition') or {}
+            if (rendition.get('status') == 'ready' and submission.get('url') == file_url_path
+                    and request.args.get('original') != '1'):
+                # Video with a web rendition: serve the small MP4 (?original=1 downloads the upload as-is)
+                return send_upload(UPLOAD_FOLDER_SUBMISSIONS, rendition['url'][len('/uploads/submissions/'):],
+                                   scope='private', mimetype='video/mp4', as_attachment=False)
+            # A video whose rendition is still pending will be served as the rendition later: revalidate
+            immutable = rendition.get('status') != 'pending' or request.args.get('original') == '1'
             # Send the file from the correct directory
-            return send_from_directory(UPLOAD_FOLDER_SUBMISSIONS, filename, as_attachment=False) # Display inline if possible
+            return send_upload(UPLOAD_FOLDER_SUBMISSIONS, filename, scope='private', immutable=immutable,
+                               as_attachment=False) # Display inline if possible
         else:
             # User is neither the owner nor a teacher
             logger.warning(f"Unauthorized attempt to access submission '{filename}' by user {user_id_str}")
             return jsonify({'message': 'Unauthorized access to this submission'}), 403
 
-    except FileNotFoundError:
+    except (FileNotFoundError, NotFound):
         # This means the file exists in DB record but not on disk
         logger.error(f"Submission file missing on disk: {filename}. DB record exists for URL: {file_url_path}")
         return jsonify({'message': 'Submission file data missing on server'}), 404
+    except RequestedRangeNotSatisfiable as e:
+        return e # 416 with Content-Range: bytes */size
     except ValueError as e:
         logger.warning(f"Invalid submission filename request: {filename}. Error: {e}")
         return jsonify({'message': 'Invalid filename'}), 400
@@ -2045,8 +3249,8 @@ def submit_feedback():
         }
 
         result = db.feedback.insert_one(feedback_doc)
-        # Prepare response data (stringify IDs)
-        response_data = stringify_ids(feedback_doc)
+        # Prepare response data
+        response_data = feedback_doc
         response_data['_id'] = str(result.inserted_id) # Ensure _id from insert result is used
 
         logger.info(f"Feedback received from user {request.current_user['_id']} (Name: {response_data['userName']})")
@@ -2057,15 +3261,13 @@ def submit_feedback():
         return jsonify({'message': 'Server error submitting feedback'}), 500
 
 @app.route('/api/feedback', methods=['GET'])
-@token_required
+@identity_required
 def get_feedback():
     # Get feedback: Teachers see all, students see their own
     try:
         user_id_str = request.current_user['_id'] # Already string
         user_role = request.current_user['role']
         query = {}
-        limit = int(request.args.get('limit', 20)) # Paginate results
-        limit = max(1, min(limit, 100))
 
         if user_role != 'teacher':
             # Students only see their feedback
@@ -2076,12 +3278,27 @@ def get_feedback():
         if status_filter:
             query['status'] = status_filter.lower()
 
-
-        feedback_cursor = db.feedback.find(query).sort('createdAt', -1).limit(limit)
-        feedback_list = [stringify_ids(fb) for fb in feedback_cursor] # Stringify results
+        if 'cursor' in request.args:
+            # Keyset mode: paginated object with nextCursor (and total when ?count= is given)
+            try:
+                page_data = paginate_listing(db.feedback, query, default_limit=20, max_limit=100)
+            except InvalidCursor:
+                return jsonify({'message': 'Invalid pagination cursor'}), 400
+            feedback_list = page_data.pop('rows')
+            logger.info(f"Feedback page fetched by user {user_id_str} ({user_role}). Filter: {query}, Limit: {page_data['limit']}")
+            return jsonify(dict(page_data, feedback=feedback_list))
+
+        # Legacy mode: plain list of the newest `limit` entries
+        try: limit = int(request.args.get('limit', 20))
+        except ValueError: limit = 20
+        limit = max(1, min(limit, 100))
+        feedback_list, next_cursor = fetch_keyset_page(db.feedback, query, limit)
 
         logger.info(f"Feedback list fetched by user {user_id_str} ({user_role}). Filter: {query}, Limit: {limit}")
-        return jsonify(feedback_list)
+        response = jsonify(feedback_list)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor # Continue with ?cursor=<value>
+        return response
 
     except Exception as e:
         logger.error(f"Get feedback error: {e}", exc_info=True)
@@ -2127,10 +3344,11 @@ def reply_to_feedback(feedback_id_str):
 
         # --- Fetch and Return Updated Feedback ---
         updated_feedback = db.feedback.find_one({'_id': feedback_id_obj})
-        response_data = stringify_ids(updated_feedback) # Stringify ObjectIds
+        response_data = updated_feedback
 
         logger.info(f"Feedback {feedback_id_str} replied/status updated by teacher {request.current_user['_id']}. New Status: {new_status}")
-        # TODO: Optionally notify the student who submitted the feedback
+        # Notify the student who submitted the feedback (outside the request)
+        job_queue.enqueue('feedback.notify', {'feedbackId': feedback_id_str})
         return jsonify({'message': 'Feedback updated successfully', 'feedback': response_data})
 
      except Exception as e:
@@ -2138,6 +3356,201 @@ def reply_to_feedback(feedback_id_str):
         return jsonify({'message': 'Server error replying to feedback'}), 500
 
 
+@job_queue.register('feedback.notify')
+def notify_feedback_reply(payload):
+    # Records that the student was told about the reply; delivery channels hook in here
+    feedback = db.feedback.find_one({'_id': ObjectId(payload['feedbackId'])},
+                                    {'userId': 1, 'status': 1, 'reply': 1, 'repliedAt': 1, 'studentNotifiedAt': 1})
+    if feedback is None:
+        return
+    replied_at = feedback.get('repliedAt')
+    if replied_at and feedback.get('studentNotifiedAt') and feedback['studentNotifiedAt'] >= replied_at:
+        return # Retried job: this reply was already delivered
+    if isinstance(feedback.get('userId'), ObjectId):
+        create_notification(feedback['userId'], 'feedback_reply', 'Your feedback has a new reply.',
+                            relatedId=feedback['_id'], title='New Response to Your Feedback')
+        user_events.publish(feedback['userId'], 'feedback', {
+            '_id': str(feedback['_id']), 'status': feedback.get('status'), 'reply': feedback.get('reply', ''),
+            'repliedAt': replied_at.isoformat() if isinstance(replied_at, datetime) else None
+        })
+    db.feedback.update_one({'_id': feedback['_id']}, {'$set': {'studentNotifiedAt': datetime.now(timezone.utc)}})
+    logger.info(f"Feedback {payload['feedbackId']} reply notification recorded for user {feedback.get('userId')}")
+
+@app.route('/api/feedback/<feedback_id_str>/notify', methods=['POST'])
+@teacher_required # Only teachers can send notifications
+def notify_feedback_user(feedback_id_str):
+    # Manual "Notify" button: sends the student a notification about the reply right away
+    try:
+        if not ObjectId.is_valid(feedback_id_str):
+            return jsonify({'message': 'Invalid feedback ID format'}), 400
+        feedback_id_obj = ObjectId(feedback_id_str)
+        teacher_id_obj = ObjectId(request.current_user['_id'])
+        teacher_name = request.current_user.get('name', 'Teacher')
+
+        feedback = db.feedback.find_one({'_id': feedback_id_obj}, {'userId': 1, 'reply': 1})
+        if not feedback:
+            return jsonify({'message': 'Feedback item not found'}), 404
+        if not feedback.get('reply'):
+            return jsonify({'message': 'Cannot notify user about a feedback without a reply'}), 400
+        if not isinstance(feedback.get('userId'), ObjectId):
+            return jsonify({'message': 'Feedback has no associated user ID'}), 400
+
+        notification = create_notification(feedback['userId'], 'feedback_reply',
+                                           f"{teacher_name} has responded to your feedback.",
+                                           relatedId=feedback_id_obj, title='New Response to Your Feedback',
+                                           createdBy=teacher_id_obj)
+        now = datetime.now(timezone.utc)
+        # studentNotifiedAt also makes a still-queued feedback.notify job skip this reply
+        db.feedback.update_one({'_id': feedback_id_obj}, {'$set': {
+            'notified': True, 'notifiedAt': now, 'notifiedBy': teacher_id_obj, 'studentNotifiedAt': now
+        }})
+
+        logger.info(f"Notification sent for feedback {feedback_id_str} by teacher {request.current_user['_id']} to user {feedback['userId']}")
+        return jsonify({
+            'success': True,
+            'message': 'Notification sent successfully',
+            'notificationId': str(notification['_id'])
+        })
+    except Exception as e:
+        logger.error(f"Notify feedback user error: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Server error sending notification'}), 500
+
+
+# --- Notifications inbox ---
+# Unread totals are kept per user in notification_counts ({_id: userId, unread: n}) and adjusted
+# by every insert/mark-read, so the badge is one _id lookup instead of a count per page load.
+def create_notification(user_id, notification_type, message, **fields):
+    # Adds an unread notification for `user_id` and pushes it to their open tabs
+    notification = dict(fields, userId=user_id, type=notification_type, message=message,
+                        read=False, createdAt=datetime.now(timezone.utc))
+    db.notifications.insert_one(notification)
+    counts = db.notification_counts.find_one_and_update(
+        {'_id': user_id}, {'$inc': {'unread': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    user_events.publish(user_id, 'notification', {'notification': stringify_ids(notification),
+                                                  'unreadCount': counts['unread']})
+    return notification
+
+def adjust_unread_notifications(user_id, delta):
+    # Applies `delta` to the stored unread total and returns the new value
+    counts = db.notification_counts.find_one_and_update(
+        {'_id': user_id}, {'$inc': {'unread': delta}}, upsert=True, return_document=ReturnDocument.AFTER)
+    if counts['unread'] < 0:
+        return reset_unread_notifications(user_id)
+    return counts['unread']
+
+def reset_unread_notifications(user_id):
+    # Recounts from the notifications themselves (first use, or a drifted total)
+    unread = db.notifications.count_documents({'userId': user_id, 'read': False})
+    db.notification_counts.update_one({'_id': user_id}, {'$set': {'unread': unread}}, upsert=True)
+    return unread
+
+def get_unread_notification_count(user_id):
+    counts = db.notification_counts.find_one({'_id': user_id})
+    if counts is None:
+        return reset_unread_notifications(user_id)
+    return max(0, counts.get('unread', 0))
+
+@app.route('/api/notifications', methods=['GET'])
+@identity_required
+def get_notifications():
+    # Newest-first keyset pages: ?cursor=<nextCursor from the previous page>, ?limit=, ?unread=1 for unread only
+    try:
+        user_id_obj = ObjectId(request.current_user['_id'])
+        try: limit = int(request.args.get('limit', 20))
+        except ValueError: limit = 20
+        limit = max(1, min(limit, 100))
+        unread_only = request.args.get('unread', '').lower() in ('1', 'true', 'yes')
+        # read: {$in: [false, true]} lets the (userId, read, createdAt, _id) index serve the
+        # full inbox too, merging its two sorted ranges instead of sorting in memory
+        query = {'userId': user_id_obj, 'read': False if unread_only else {'$in': [False, True]}}
+        try:
+            notifications, next_cursor = fetch_keyset_page(db.notifications, query, limit,
+                                                            request.args.get('cursor') or None)
+        except InvalidCursor:
+            return jsonify({'message': 'Invalid pagination cursor'}), 400
+        return jsonify({
+            'notifications': notifications,
+            'nextCursor': next_cursor,
+            'hasMore': next_cursor is not None,
+            'unreadCount': get_unread_notification_count(user_id_obj)
+        })
+    except Exception as e:
+        logger.error(f"Get notifications error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error fetching notifications'}), 500
+
+@app.route('/api/notifications/unread-count', methods=['GET'])
+@identity_required
+def get_notifications_unread_count():
+    try:
+        return jsonify({'unreadCount': get_unread_notification_count(ObjectId(request.current_user['_id']))})
+    except Exception as e:
+        logger.error(f"Unread notification count error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error fetching unread count'}), 500
+
+@app.route('/api/notifications/read', methods=['POST'])
+@identity_required
+def mark_notifications_read():
+    # Body: {"ids": [...]} marks those notifications read, {"all": true} marks the whole inbox read
+    try:
+        user_id_obj = ObjectId(request.current_user['_id'])
+        data = request.get_json(silent=True) or {}
+        query = {'userId': user_id_obj, 'read': False}
+        if not data.get('all'):
+            ids = data.get('ids')
+            if not isinstance(ids, list) or not ids:
+                return jsonify({'message': 'Provide "ids" (list) or "all": true'}), 400
+            if len(ids) > 500:
+                return jsonify({'message': 'At most 500 ids per request'}), 400
+            if not all(isinstance(i, str) and ObjectId.is_valid(i) for i in ids):
+                return jsonify({'message': 'Invalid notification ID format'}), 400
+            query['_id'] = {'$in': [ObjectId(i) for i in ids]}
+
+        # Only unread ones match, so modified_count is exactly how far the unread total drops
+        result = db.notifications.update_many(query, {'$set': {'read': True, 'readAt': datetime.now(timezone.utc)}})
+        if result.modified_count:
+            unread = adjust_unread_notifications(user_id_obj, -result.modified_count)
+        else:
+            unread = get_unread_notification_count(user_id_obj)
+        return jsonify({'updated': result.modified_count, 'unreadCount': unread})
+    except Exception as e:
+        logger.error(f"Mark notifications read error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error marking notifications read'}), 500
+
+
+# --- Job Queue Admin ---
+@app.route('/api/admin/jobs', methods=['GET'])
+@teacher_required
+def get_jobs():
+    try:
+        status = request.args.get('status')
+        if status and status not in ('queued', 'running', 'done', 'failed'):
+            return jsonify({'message': f'Invalid status: {status}'}), 400
+        try: limit = int(request.args.get('limit', 50))
+        except ValueError: limit = 50
+        limit = max(1, min(limit, 200))
+        jobs = job_queue.list_jobs(status=status, name=request.args.get('name'), limit=limit)
+        return jsonify({'stats': job_queue.stats(), 'jobs': jobs})
+    except Exception as e:
+        logger.error(f"Get jobs error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error fetching jobs'}), 500
+
+@app.route('/api/admin/jobs/<job_id_str>/retry', methods=['POST'])
+@teacher_required
+def retry_job(job_id_str):
+    try:
+        if not ObjectId.is_valid(job_id_str):
+            return jsonify({'message': 'Invalid job ID format'}), 400
+        if not job_queue.retry(ObjectId(job_id_str)):
+            return jsonify({'message': 'Job not found or not failed'}), 404
+        logger.info(f"Job {job_id_str} re-queued by {request.current_user['_id']}")
+        return jsonify({'message': 'Job re-queued'})
+    except Exception as e:
+        logger.error(f"Retry job error: {e}", exc_info=True)
+        return jsonify({'message': 'Server error retrying job'}), 500
+
+# All handlers are registered above: start this process's workers
+job_queue.start()
+
 # --- Main Execution ---
 if __name__ == '__main__':
     print(f"--- Attempting to start server on port {PORT} ---")
@@ -2147,8 +3560,8 @@ if __name__ == '__main__':
         from waitress import serve
         logger.info(f"Starting server with Waitress on http://0.0.0.0:{PORT}")
         print(f"--- Production Server (Waitress) running on http://0.0.0.0:{PORT} ---")
-        # Adjust threads as needed based on expected load and server cores
-        serve(app, host='0.0.0.0', port=PORT, threads=8)
+        # WAITRESS_THREADS also sizes SSE_MAX_STREAMS and the password hashing slots (see the top of this file)
+        serve(app, host='0.0.0.0', port=PORT, threads=WAITRESS_THREADS)
     except ImportError:
         logger.warning("Waitress not found, using Flask development server (NOT FOR PRODUCTION).")
         print(f"--- Development Server (Flask) running on http://0.0.0.0:{PORT} ---")
@@ -0,0 +1,152 @@
+# backend/avatar_images.py
+# Fixed-size avatar thumbnails.
+# An uploaded avatar is decoded once, auto-rotated, stripped of metadata (EXIF/GPS,
+# ICC, comments are simply not written back), center-cropped to a square and saved
+# at each size in AVATAR_VARIANT_SIZES as WebP plus a JPEG (or PNG when the image
+# has transparency) fallback. Variants are keyed by the source file's SHA-256, so
+# identical uploads share them.
+# The uploaded file itself is public too (the user's `avatar` URL until the variants are
+# ready), so sanitize_avatar() re-encodes it in the request, before it is stored: files
+# Pillow can't decode are refused, metadata is dropped and large photos are scaled down.
+# Pillow is optional: without it avatars are served as uploaded.
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+AVATAR_VARIANT_SIZES = (192, 96, 48) # Largest first: each size is resized from the square master
+RANKING_AVATAR_SIZE = 96 # Leaderboard shows 70px avatars; 96px stays sharp on most screens
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+AVATAR_MAX_SIDE = 1024 # Stored originals are scaled down to fit; the largest thumbnail is 192px
+AVATAR_MAX_PIXELS = 40_000_000 # Refuse larger images (a small compressed file can decode to gigabytes)
+AVATAR_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF', 'webp': 'WEBP'} # Upload extension -> format written
+
+# Older mimetypes tables don't know .webp, which would be served as application/octet-stream
+mimetypes.add_type('image/webp', '.webp')
+
+
+def images_supported():
+    return Image is not None
+
+
+class AvatarImageError(ValueError):
+    """The upload is not an image Pillow can decode."""
+
+
+def _save_atomic(image, path, **save_args):
+    temp_path = f"{path}.tmp"
+    image.save(temp_path, **save_args)
+    os.replace(temp_path, path)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sanitize_avatar(path, ext):
+    """Re-encodes the upload at `path` in place (format from `ext`) without metadata; returns (sha256, size).
+
+    Animated images keep their first frame. Raises AvatarImageError if the file doesn't decode.
+    """
+    if Image is None:
+        raise RuntimeError('Pillow is not installed')
+    image_format = AVATAR_FORMATS[ext]
+    try:
+        with Image.open(path) as source:
+            width, height = source.size
+            if width * height > AVATAR_MAX_PIXELS:
+                raise AvatarImageError(f"Image too large ({width}x{height})")
+            source.draft('RGB', (AVATAR_MAX_SIDE, AVATAR_MAX_SIDE)) # JPEG: decode at a reduced scale
+            image = ImageOps.exif_transpose(source) # Apply camera rotation before the EXIF is dropped
+            image.load() # Full decode: truncated or corrupt data fails here
+    except AvatarImageError:
+        raise
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise AvatarImageError(f"Not a decodable image: {e}") from e
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    image.thumbnail((AVATAR_MAX_SIDE, AVATAR_MAX_SIDE), Image.LANCZOS)
+    # EXIF/GPS, XMP, ICC and comments live in .info and some writers copy them from there
+    image.info = {key: value for key, value in image.info.items() if key == 'transparency'}
+
+    save_args = {'format': image_format}
+    if image_format == 'JPEG':
+        save_args.update(quality=90, optimize=True)
+    elif image_format == 'WEBP':
+        save_args.update(quality=90)
+    _save_atomic(image, path, **save_args)
+    return _file_sha256(path), os.path.getsize(path)
+
+
+def render_avatar_variants(source_path, variants_dir, url_prefix, key):
+    """Writes every size/format for `key` (the source SHA-256) and returns their URLs.
+
+    Result: {'48': {'webp': url, 'fallback': url}, '96': {...}, '192': {...}}.
+    Files that already exist (same source uploaded before) are not rendered again.
+    """
+    if Image is None:
+        raise RuntimeError('Pillow is not installed')
+    target_dir = os.path.join(variants_dir, key)
+    os.makedirs(target_dir, exist_ok=True)
+
+    with Image.open(source_path) as source:
+        has_alpha = source.mode in ('RGBA', 'LA') or (source.mode == 'P' and 'transparency' in source.info)
+        fallback_ext = 'png' if has_alpha else 'jpg'
+        variants = {}
+        names = {}
+        for size in AVATAR_VARIANT_SIZES:
+            names[size] = (f"{size}.webp", f"{size}.{fallback_ext}")
+            variants[str(size)] = {
+                'webp': f"{url_prefix}/{key}/{names[size][0]}",
+                'fallback': f"{url_prefix}/{key}/{names[size][1]}"
+            }
+        if all(os.path.exists(os.path.join(target_dir, name)) for pair in names.values() for name in pair):
+            return variants
+
+        largest = AVATAR_VARIANT_SIZES[0]
+        # JPEG can decode at a reduced scale directly; far cheaper than decoding a 12MP photo fully
+        source.draft('RGB', (largest * 2, largest * 2))
+        image = ImageOps.exif_transpose(source) # Apply camera rotation before the EXIF is dropped
+        image = image.convert('RGBA' if has_alpha else 'RGB') # Also takes the first frame of a GIF
+        master = ImageOps.fit(image, (largest, largest), method=Image.LANCZOS)
+
+    for size in AVATAR_VARIANT_SIZES:
+        variant = master if size == largest else master.resize((size, size), Image.LANCZOS)
+        webp_name, fallback_name = names[size]
+        _save_atomic(variant, os.path.join(target_dir, webp_name), format='WEBP', quality=WEBP_QUALITY, method=4)
+        if has_alpha:
+            _save_atomic(variant, os.path.join(target_dir, fallback_name), format='PNG', optimize=True)
+        else:
+            _save_atomic(variant, os.path.join(target_dir, fallback_name), format='JPEG', quality=JPEG_QUALITY,
+                         optimize=True, progressive=True)
+    return variants
+
+
+def remove_avatar_variants(variants_dir, key):
+    """Deletes the variants rendered for `key` (called when the source blob is garbage collected)."""
+    shutil.rmtree(os.path.join(variants_dir, key), ignore_errors=True)
+
+
+def ranking_avatar_url(user_data):
+    """Small avatar for leaderboard rows: the WebP variant when rendered, else the uploaded image."""
+    variant = (user_data.get('avatarVariants') or {}).get(str(RANKING_AVATAR_SIZE)) or {}
+    return variant.get('webp') or user_data.get('avatar', '')
@@ -0,0 +1,75 @@
+# backend/bench_json.py
+# Micro-benchmark for list responses: the old stringify_ids() copy + jsonify versus
+# jsonify of raw PyMongo documents with the Mongo-aware JSON encoding (json_provider).
+# Usage: python bench_json.py [documents] [rounds]
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from flask import Flask, jsonify
+
+from json_provider import describe_json_encoding, init_json
+
+
+def stringify_ids(data):
+    # Copy of the recursive walk the handlers used before json_provider
+    if isinstance(data, list):
+        return [stringify_ids(item) for item in data]
+    if isinstance(data, dict):
+        return {key: stringify_ids(value) for key, value in data.items()}
+    if isinstance(data, ObjectId):
+        return str(data)
+    return data
+
+
+def make_submissions(count):
+    """Synthetic documents shaped like db.submissions rows."""
+    now = datetime.now(timezone.utc)
+    return [{
+        '_id': ObjectId(),
+        'userId': ObjectId(),
+        'title': f"Submission {i}",
+        'description': 'Performance practice recording ' * 3,
+        'type': 'video' if i % 2 else 'image',
+        'url': f"/uploads/{ObjectId()}.mp4",
+        'status': 'pending' if i % 3 else 'reviewed',
+        'feedback': [{'teacherId': ObjectId(), 'comment': 'Good tempo', 'createdAt': now}],
+        'tags': ['piano', 'week-3'],
+        'points': i % 50,
+        'createdAt': now - timedelta(minutes=i),
+        'updatedAt': now,
+    } for i in range(count)]
+
+
+def bench(label, func, rounds):
+    func() # Warm up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        size = len(func())
+    elapsed = (time.perf_counter() - start) / rounds * 1000
+    print(f"{label:<32} {elapsed:8.2f} ms/response  ({size} bytes)")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    docs = make_submissions(count)
+
+    legacy_app = Flask('legacy')
+    fast_app = Flask('fast')
+    init_json(fast_app)
+
+    print(f"{count} documents, {rounds} rounds")
+    print(f"Legacy encoder: {describe_json_encoding(legacy_app)}")
+    print(f"Fast encoder:   {describe_json_encoding(fast_app)}")
+    with legacy_app.app_context():
+        before = bench('stringify_ids + jsonify', lambda: jsonify(stringify_ids(docs)).get_data(), rounds)
+    with fast_app.app_context():
+        after = bench('jsonify (Mongo JSON encoding)', lambda: jsonify(docs).get_data(), rounds)
+    print(f"Speedup: {before / after:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# backend/blob_store.py
+# Content-addressed storage for uploaded files.
+# Files are stored once per SHA-256 under sharded folders (<root>/ab/cd/<sha256>.<ext>)
+# and a `blobs` document per hash counts the submissions/users referencing it.
+# Uploading identical bytes again only bumps the counter; the new copy is discarded.
+# Blobs whose count drops to zero are deleted by a garbage collector after a grace
+# period, so a re-upload right after a release simply revives the existing file.
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """SHA-256 keyed file store with reference counts kept in MongoDB."""
+
+    def __init__(self, root_dir, collection, namespace, url_prefix, gc_grace=3600, on_delete=None):
+        self.root = root_dir
+        self._collection = collection
+        self.namespace = namespace # Several stores share one collection ('submission', 'avatar')
+        self.url_prefix = url_prefix.rstrip('/')
+        self.gc_grace = gc_grace # Seconds an unreferenced blob is kept before deletion
+        self.on_delete = on_delete # Optional callback(sha256) to drop files derived from a deleted blob
+        self._gc_thread = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def _blob_id(self, sha256):
+        return f"{self.namespace}:{sha256}"
+
+    @staticmethod
+    def relative_path(sha256, ext):
+        return os.path.join(sha256[:2], sha256[2:4], f"{sha256}.{ext}")
+
+    def url_for(self, relative_path):
+        return f"{self.url_prefix}/{relative_path.replace(os.sep, '/')}"
+
+    def put(self, temp_path, sha256, size, ext):
+        """Stores the file at `temp_path` (consumed) and adds a reference; returns (url, deduplicated)."""
+        blob = self._collection.find_one_and_update(
+            {'_id': self._blob_id(sha256)},
+            {
+                '$inc': {'refs': 1},
+                '$unset': {'releasedAt': ''},
+                '$setOnInsert': {'path': self.relative_path(sha256, ext), 'size': size,
+                                 'namespace': self.namespace, 'createdAt': datetime.now(timezone.utc)}
+            },
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        blob_path = os.path.join(self.root, blob['path'])
+        if os.path.exists(blob_path):
+            os.remove(temp_path) # Same bytes already stored
+            return self.url_for(blob['path']), True
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(temp_path, blob_path) # Same filesystem: atomic, no copy
+        return self.url_for(blob['path']), False
+
+    def release(self, sha256):
+        """Drops one reference; the file is removed by collect_garbage() once unreferenced."""
+        self._collection.update_one(
+            {'_id': self._blob_id(sha256), 'refs': {'$gt': 0}},
+            {'$inc': {'refs': -1}, '$set': {'releasedAt': datetime.now(timezone.utc)}}
+        )
+
+    def collect_garbage(self):
+        """Deletes blobs unreferenced for longer than the grace period; returns how many were removed."""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.gc_grace)
+        query = {'namespace': self.namespace, 'refs': {'$lte': 0}, 'releasedAt': {'$lt': cutoff}}
+        removed = 0
+        for blob in self._collection.find(query, {'path': 1}):
+            # Conditional delete: skipped if the blob was referenced again meanwhile
+            if self._collection.delete_one(dict(query, _id=blob['_id'])).deleted_count:
+                if self._remove_file(blob):
+                    if self.on_delete is not None:
+                        self.on_delete(blob['_id'].split(':', 1)[1])
+                    removed += 1
+        return removed
+
+    def _remove_file(self, blob):
+        # A put() right after the delete_one above recreates the document and, if it still sees the
+        # file, keeps it as a duplicate. So the file is first moved aside (atomic) and only removed
+        # if no document came back; otherwise it is put back. Returns False if it was kept.
+        blob_path = os.path.join(self.root, blob['path'])
+        doomed_path = f"{blob_path}.deleting"
+        try:
+            os.replace(blob_path, doomed_path)
+        except FileNotFoundError:
+            return self._collection.find_one({'_id': blob['_id']}, {'_id': 1}) is None
+        if self._collection.find_one({'_id': blob['_id']}, {'_id': 1}) is not None:
+            if not os.path.exists(blob_path): # Unless a put() that found it missing already stored its own copy
+                os.replace(doomed_path, blob_path)
+            else:
+                os.remove(doomed_path)
+            logger.info(f"Blob GC ({self.namespace}): {blob['_id']} was referenced again, file kept")
+            return False
+        os.remove(doomed_path)
+        return True
+
+    def start_gc(self, interval=3600):
+        """Runs collect_garbage() every `interval` seconds in a daemon thread (once per process)."""
+        if self._gc_thread is not None:
+            return
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.collect_garbage()
+                    if removed:
+                        logger.info(f"Blob GC ({self.namespace}): removed {removed} unreferenced files")
+                except Exception as e:
+                    logger.error(f"Blob GC ({self.namespace}) error: {e}", exc_info=True)
+        self._gc_thread = threading.Thread(target=run, name=f"blob-gc-{self.namespace}", daemon=True)
+        self._gc_thread.start()
@@ -0,0 +1,244 @@
+# backend/cache.py
+# Small in-process caches shared by the API handlers.
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_size=1000, ttl=60, name='cache'):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (value, stored_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None, min_stored_at=None):
+        """Returns the cached value, or `default` if missing, expired or stored before `min_stored_at`."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if now - stored_at < self.ttl and (min_stored_at is None or stored_at >= min_stored_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False) # Evict least recently used
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'name': self.name, 'size': len(self._entries), 'maxSize': self.max_size,
+                    'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+# --- Shared cache + invalidation bus ---
+# With REDIS_URL set, all Waitress processes/hosts share one cache and receive each
+# other's invalidations over Redis pub/sub. Without it (or if Redis is unreachable)
+# the same API is served from process memory, which is what a single worker needs.
+INVALIDATION_CHANNEL = 'fpt:invalidate'
+
+
+class MemorySharedCache:
+    """In-process implementation of the shared cache API (no Redis required)."""
+
+    distributed = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {} # key -> (value, expires_at or None)
+        self._subscribers = []
+
+    def _live_entry(self, key, now):
+        # Caller holds the lock
+        entry = self._values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live_entry(key, time.time())
+            return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None, nx=False):
+        """Stores `value`; with nx=True only if the key is absent. Returns True if stored."""
+        now = time.time()
+        with self._lock:
+            if nx and self._live_entry(key, now) is not None:
+                return False
+            self._values[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def incr(self, key, initial=0):
+        """Atomically increments an integer counter, starting from `initial` when missing."""
+        with self._lock:
+            entry = self._live_entry(key, time.time())
+            value = (entry[0] if entry is not None else initial) + 1
+            self._values[key] = (value, None)
+            return value
+
+    def acquire_lock(self, key, ttl):
+        # Best-effort lease: only one caller gets it until it expires
+        return self.set(f"lock:{key}", 1, ttl=ttl, nx=True)
+
+    def release_lock(self, key):
+        self.delete(f"lock:{key}")
+
+    def subscribe(self, callback):
+        """Registers callback(namespace, key) for invalidation messages."""
+        self._subscribers.append(callback)
+
+    def publish(self, namespace, key=''):
+        for callback in list(self._subscribers):
+            try:
+                callback(namespace, key)
+            except Exception as e:
+                logger.error(f"Invalidation callback error ({namespace}:{key}): {e}", exc_info=True)
+
+
+class RedisSharedCache(MemorySharedCache):
+    """Redis implementation: values are BSON-encoded, invalidations go over pub/sub."""
+
+    distributed = True
+
+    def __init__(self, redis_client, key_prefix='fpt:'):
+        super().__init__()
+        from bson import encode, decode
+        from bson.codec_options import CodecOptions
+        self._encode = encode
+        self._decode = decode
+        self._codec_options = CodecOptions(tz_aware=True)
+        self._redis = redis_client
+        self._prefix = key_prefix
+        self._listener = None
+
+    def _key(self, key):
+        return f"{self._prefix}{key}"
+
+    def _dumps(self, value):
+        # BSON keeps datetimes and ObjectIds intact; wrap so any value type can be stored
+        return self._encode({'v': value})
+
+    def _loads(self, raw):
+        return self._decode(raw, codec_options=self._codec_options)['v']
+
+    def get(self, key, default=None):
+        try:
+            raw = self._redis.get(self._key(key))
+        except Exception as e:
+            logger.warning(f"Shared cache get failed for '{key}': {e}")
+            return default
+        return default if raw is None else self._loads(raw)
+
+    def set(self, key, value, ttl=None, nx=False):
+        try:
+            ex = max(1, int(ttl)) if ttl else None
+            return bool(self._redis.set(self._key(key), self._dumps(value), ex=ex, nx=nx))
+        except Exception as e:
+            logger.warning(f"Shared cache set failed for '{key}': {e}")
+            return False
+
+    def delete(self, key):
+        try:
+            self._redis.delete(self._key(key))
+        except Exception as e:
+            logger.warning(f"Shared cache delete failed for '{key}': {e}")
+
+    def incr(self, key, initial=0):
+        redis_key = self._key(key)
+        try:
+            self._redis.set(redis_key, initial, nx=True)
+            return int(self._redis.incr(redis_key))
+        except Exception as e:
+            # Count in this process instead; callers seed `initial` so values keep increasing
+            logger.warning(f"Shared cache incr failed for '{key}': {e}")
+            return super().incr(key, initial=initial)
+
+    def acquire_lock(self, key, ttl):
+        try:
+            return bool(self._redis.set(self._key(f"lock:{key}"), 1, px=max(1, int(ttl * 1000)), nx=True))
+        except Exception as e:
+            # If Redis is down, let this process do the work itself rather than nobody doing it
+            logger.warning(f"Shared cache lock failed for '{key}': {e}")
+            return True
+
+    def subscribe(self, callback):
+        super().subscribe(callback)
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, name='cache-invalidation-listener', daemon=True)
+            self._listener.start()
+
+    def publish(self, namespace, key=''):
+        try:
+            self._redis.publish(self._key(INVALIDATION_CHANNEL), f"{namespace}:{key}")
+        except Exception as e:
+            # Still invalidate locally so this process never serves its own stale data
+            logger.warning(f"Invalidation publish failed ({namespace}:{key}): {e}")
+            super().publish(namespace, key)
+
+    def _listen(self):
+        channel = self._key(INVALIDATION_CHANNEL)
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                logger.info(f"Listening for cache invalidations on '{channel}'")
+                while True:
+                    # Short polls keep this loop within the client's socket timeout
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message:
+                        continue
+                    data = message.get('data')
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    namespace, _, key = str(data).partition(':')
+                    super().publish(namespace, key)
+            except Exception as e:
+                logger.error(f"Cache invalidation listener error: {e}. Reconnecting in 5s")
+                time.sleep(5)
+
+
+def create_shared_cache(redis_url=None):
+    """Returns a Redis-backed shared cache if `redis_url` is usable, else the in-memory fallback."""
+    if not redis_url:
+        logger.info("REDIS_URL not set. Using in-memory cache (per process).")
+        return MemorySharedCache()
+    try:
+        import redis
+        redis_client = redis.Redis.from_url(redis_url, socket_timeout=2, socket_connect_timeout=2, health_check_interval=30)
+        redis_client.ping()
+        logger.info("Connected to Redis. Using shared cache and invalidation bus.")
+        return RedisSharedCache(redis_client)
+    except Exception as e:
+        logger.warning(f"Redis unavailable ({e}). Falling back to in-memory cache (per process).")
+        return MemorySharedCache()
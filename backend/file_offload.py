@@ -0,0 +1,59 @@
+# backend/file_offload.py
+# Hands file downloads over to the fronting web server.
+# With an offload mode set, a view still runs its lookups and authorization checks but
+# answers with an empty response carrying X-Accel-Redirect (nginx) or X-Sendfile (Apache
+# mod_xsendfile, lighttpd). The proxy then streams the file itself, Range and conditional
+# requests included, and the Waitress thread is free again as soon as the headers are out.
+#
+# nginx: X-Accel-Redirect points into an internal location mapped onto the project root
+#     location /_protected/ {
+#         internal;
+#         alias /srv/fpt-learning-hub/;   # folder holding backend/ and frontend/
+#     }
+# Apache: XSendFile On
+#         XSendFilePath /srv/fpt-learning-hub
+import mimetypes
+import os
+from urllib.parse import quote
+
+from flask import Response
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import safe_join
+
+OFFLOAD_MODES = ('x-accel', 'x-sendfile')
+
+
+class FileOffload:
+    """Builds X-Accel-Redirect/X-Sendfile responses for files under `root_dir`; mode None = disabled."""
+
+    def __init__(self, mode, root_dir, accel_prefix='/_protected/'):
+        mode = (mode or '').strip().lower() or None
+        if mode is not None and mode not in OFFLOAD_MODES:
+            raise ValueError(f"Unknown file offload mode '{mode}' (expected one of {', '.join(OFFLOAD_MODES)})")
+        self.mode = mode
+        self.root = os.path.abspath(root_dir)
+        self.accel_prefix = '/' + accel_prefix.strip('/') + '/' # Internal nginx location
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def response(self, directory, relative_path, mimetype=None, as_attachment=False, download_name=None):
+        """Offloaded equivalent of send_from_directory(directory, relative_path); raises NotFound."""
+        path = safe_join(directory, relative_path)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+        path = os.path.abspath(path)
+        response = Response(mimetype=mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.automatically_set_content_length = False # The proxy sends the real length
+        if as_attachment or download_name:
+            response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                                 filename=download_name or os.path.basename(path))
+        if self.mode == 'x-sendfile':
+            response.headers['X-Sendfile'] = path
+        else:
+            relative = os.path.relpath(path, self.root)
+            if relative.startswith('..'):
+                raise RuntimeError(f"{path} is outside the offload root {self.root}")
+            response.headers['X-Accel-Redirect'] = self.accel_prefix + quote(relative.replace(os.sep, '/'))
+        return response
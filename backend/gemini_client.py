@@ -0,0 +1,89 @@
+# backend/gemini_client.py
+# Pooled, concurrency-bounded client for the Gemini generateContent API.
+# - One requests.Session per process keeps TLS connections alive between chat calls
+#   instead of a new handshake per question.
+# - At most `max_concurrent` calls are in flight per process; further callers get
+#   GeminiBusy at once, so slow model responses can't hold every Waitress thread.
+# - stream() relays streamGenerateContent (SSE) so replies can be shown as they arrive.
+# `base_url` is configurable, which also lets a local stub stand in for the real API.
+import json
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = 'https://generativelanguage.googleapis.com/v1beta'
+
+
+class GeminiBusy(Exception):
+    """Raised when all chat slots of this process are taken."""
+
+
+class GeminiClient:
+    """generate()/stream() over a keep-alive session, with a per-process concurrency cap."""
+
+    def __init__(self, api_key, model, base_url=DEFAULT_BASE_URL, max_concurrent=3, pool_size=None,
+                 connect_timeout=5, read_timeout=45, acquire_timeout=2):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrent = max_concurrent
+        self.timeout = (connect_timeout, read_timeout) # read_timeout applies between received bytes when streaming
+        self.acquire_timeout = acquire_timeout # Seconds a caller waits for a free slot before GeminiBusy
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or max_concurrent)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Key in a header rather than the query string, so it never shows up in URL logs
+        self.session.headers.update({'Content-Type': 'application/json', 'x-goog-api-key': api_key or ''})
+
+    def _url(self, method):
+        return f"{self.base_url}/models/{self.model}:{method}"
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise GeminiBusy(f"All {self.max_concurrent} chat slots are busy")
+
+    def generate(self, payload):
+        """Returns the generateContent JSON; raises requests exceptions like requests.post would."""
+        self._acquire()
+        try:
+            response = self.session.post(self._url('generateContent'), json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        finally:
+            self._slots.release()
+
+    def stream(self, payload):
+        """Yields each streamGenerateContent chunk (same shape as a generateContent response).
+
+        The slot is taken before the request is sent, so GeminiBusy and HTTP errors surface on
+        the first next(); it is released when the generator finishes or is closed.
+        """
+        self._acquire()
+        try:
+            with self.session.post(self._url('streamGenerateContent'), params={'alt': 'sse'}, json=payload,
+                                   timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=False):
+                    # SSE: one JSON document per "data:" line; blank lines separate events
+                    if not line.startswith(b'data:'):
+                        continue
+                    data = line[len(b'data:'):].strip()
+                    if data:
+                        yield json.loads(data)
+        finally:
+            self._slots.release()
+
+
+def chunk_text(chunk):
+    """Text of the first candidate in a generateContent(-stream) response, '' if none."""
+    try:
+        parts = chunk['candidates'][0]['content']['parts']
+    except (IndexError, KeyError, TypeError):
+        return ''
+    return ''.join(part.get('text', '') for part in parts if isinstance(part, dict))
@@ -0,0 +1,174 @@
+# backend/job_queue.py
+# Small durable job queue on a MongoDB collection.
+# Handlers enqueue work that doesn't need to finish before the response (post-upload
+# processing, thumbnails, notifications). Every web process runs a few worker threads
+# that claim jobs atomically with find_one_and_update:
+# - a claimed job is invisible to other workers until its visibility timeout expires,
+#   so a job whose worker died is picked up again,
+# - failures are retried with exponential backoff up to `maxAttempts`, then kept as 'failed',
+# - finished jobs are removed by a TTL index after JOB_RETENTION_SECONDS.
+# Jobs run at least once: handlers must tolerate being run again.
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+JOB_RETENTION_SECONDS = 7 * 24 * 3600 # Done/failed jobs are kept this long for /api/admin/jobs
+
+
+class JobQueue:
+    """MongoDB-backed job queue with an in-process worker pool."""
+
+    def __init__(self, collection, workers=2, poll_interval=1.0, visibility_timeout=300,
+                 max_attempts=5, retry_base_delay=5):
+        self._collection = collection
+        self.workers = workers
+        self.poll_interval = poll_interval # Idle workers re-check this often (enqueue wakes local ones at once)
+        self.visibility_timeout = visibility_timeout # Seconds before a claimed job counts as abandoned
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay # Retry n waits retry_base_delay * 2**(n-1) seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._handlers = {}
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        self._collection.create_index([('status', ASCENDING), ('runAt', ASCENDING)], name='job_status_runat')
+        self._collection.create_index([('status', ASCENDING), ('lockedUntil', ASCENDING)], name='job_status_locked')
+        self._collection.create_index([('finishedAt', ASCENDING)], expireAfterSeconds=JOB_RETENTION_SECONDS,
+                                      name='job_finished_ttl')
+
+    def register(self, name, handler=None):
+        """Registers handler(payload) for jobs called `name`; usable as a decorator."""
+        if handler is None:
+            return lambda func: self.register(name, func)
+        self._handlers[name] = handler
+        return handler
+
+    def enqueue(self, name, payload=None, delay=0, max_attempts=None):
+        """Stores a job and returns its id; it runs in this or any other process with workers."""
+        now = datetime.now(timezone.utc)
+        result = self._collection.insert_one({
+            'name': name,
+            'payload': payload or {},
+            'status': 'queued',
+            'attempts': 0,
+            'maxAttempts': max_attempts or self.max_attempts,
+            'runAt': now + timedelta(seconds=delay),
+            'createdAt': now,
+            'updatedAt': now,
+            'lockedUntil': None,
+            'lastError': None
+        })
+        self._wakeup.set()
+        return result.inserted_id
+
+    # --- Workers ---
+    def start(self):
+        """Starts the worker threads (no-op when workers=0, e.g. for enqueue-only processes)."""
+        with self._lock:
+            if self._threads or self.workers <= 0:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"Job queue started with {self.workers} workers ({self.worker_id}); handlers: {sorted(self._handlers)}")
+
+    def _claim(self):
+        now = datetime.now(timezone.utc)
+        return self._collection.find_one_and_update(
+            {
+                'name': {'$in': list(self._handlers)},
+                '$or': [
+                    {'status': 'queued', 'runAt': {'$lte': now}},
+                    {'status': 'running', 'lockedUntil': {'$lt': now}} # Worker died or timed out
+                ]
+            },
+            {
+                '$set': {'status': 'running', 'lockedUntil': now + timedelta(seconds=self.visibility_timeout),
+                         'workerId': self.worker_id, 'startedAt': now, 'updatedAt': now},
+                '$inc': {'attempts': 1}
+            },
+            sort=[('runAt', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Job claim failed: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._execute(job)
+
+    def _execute(self, job):
+        now = datetime.now(timezone.utc)
+        if job['attempts'] > job['maxAttempts']:
+            # Reclaimed after its last attempt crashed the worker: don't run it again
+            self._finish(job, 'failed', job.get('lastError') or 'Visibility timeout exceeded on last attempt')
+            return
+        try:
+            self._handlers[job['name']](job['payload'])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job['attempts'] >= job['maxAttempts']:
+                logger.error(f"Job {job['_id']} ({job['name']}) failed permanently after {job['attempts']} attempts: {error}\n{traceback.format_exc()}")
+                self._finish(job, 'failed', error)
+            else:
+                delay = self.retry_base_delay * 2 ** (job['attempts'] - 1)
+                logger.warning(f"Job {job['_id']} ({job['name']}) attempt {job['attempts']} failed: {error}. Retrying in {delay}s")
+                self._collection.update_one(
+                    {'_id': job['_id'], 'workerId': self.worker_id},
+                    {'$set': {'status': 'queued', 'runAt': now + timedelta(seconds=delay), 'lockedUntil': None,
+                              'lastError': error, 'updatedAt': datetime.now(timezone.utc)}}
+                )
+            return
+        self._finish(job, 'done')
+
+    def _finish(self, job, status, error=None):
+        now = datetime.now(timezone.utc)
+        fields = {'status': status, 'lockedUntil': None, 'finishedAt': now, 'updatedAt': now}
+        if error is not None:
+            fields['lastError'] = error
+        self._collection.update_one({'_id': job['_id']}, {'$set': fields})
+
+    # --- Status ---
+    def stats(self):
+        counts = {status: 0 for status in JOB_STATUSES}
+        for row in self._collection.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[row['_id']] = row['count']
+        return {'counts': counts, 'workers': len(self._threads), 'workerId': self.worker_id,
+                'handlers': sorted(self._handlers)}
+
+    def list_jobs(self, status=None, name=None, limit=50):
+        query = {}
+        if status:
+            query['status'] = status
+        if name:
+            query['name'] = name
+        return list(self._collection.find(query).sort('updatedAt', -1).limit(limit))
+
+    def retry(self, job_id):
+        """Re-queues a failed job now; returns True if it was failed."""
+        result = self._collection.update_one(
+            {'_id': job_id, 'status': 'failed'},
+            {'$set': {'status': 'queued', 'runAt': datetime.now(timezone.utc), 'attempts': 0, 'updatedAt': datetime.now(timezone.utc)},
+             '$unset': {'finishedAt': ''}}
+        )
+        if result.modified_count:
+            self._wakeup.set()
+        return bool(result.modified_count)
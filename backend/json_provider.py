@@ -0,0 +1,83 @@
+# backend/json_provider.py
+# JSON encoding that understands PyMongo documents, so handlers can jsonify() raw
+# documents without first copying them through stringify_ids().
+# - ObjectId -> str (same output as stringify_ids)
+# - datetime/date -> HTTP date string (Flask's existing format, unchanged for clients)
+# On Flask >= 2.2 a JSON provider is installed and uses orjson when it is installed;
+# on older Flask (the pinned 2.0.x) the app's JSONEncoder is replaced instead.
+import logging
+from datetime import date
+
+from bson import ObjectId
+from werkzeug.http import http_date
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from flask.json.provider import DefaultJSONProvider # Flask >= 2.2
+    JSONEncoder = None
+except ImportError:
+    from flask.json import JSONEncoder # Flask < 2.2 (removed in 2.3)
+    DefaultJSONProvider = None
+
+
+def mongo_json_default(o):
+    """`default` hook for json encoders: handles the BSON/Python types PyMongo returns."""
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, date):
+        return http_date(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+if DefaultJSONProvider is not None:
+    class MongoJSONProvider(DefaultJSONProvider):
+        """Flask >= 2.2 provider: ObjectId/datetime handled natively, orjson when available."""
+
+        default = staticmethod(mongo_json_default)
+        sort_keys = False # Keep document field order (and lets orjson handle the common case)
+
+        def dumps(self, obj, **kwargs):
+            # orjson only produces compact, unsorted output; pretty/sorted requests use the stdlib path
+            if orjson is not None and not kwargs.get('indent') and not kwargs.get('sort_keys', self.sort_keys):
+                return orjson.dumps(
+                    obj, default=mongo_json_default,
+                    option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+                ).decode('utf-8')
+            return super().dumps(obj, **kwargs)
+
+    MongoJSONEncoder = None
+else:
+    class MongoJSONEncoder(JSONEncoder):
+        """Flask 2.0/2.1 encoder: ObjectIds become strings during encoding."""
+
+        def default(self, o):
+            if isinstance(o, ObjectId):
+                return str(o)
+            return super().default(o)
+
+    MongoJSONProvider = None
+
+
+def init_json(app):
+    """Installs the Mongo-aware JSON encoding on `app`."""
+    if MongoJSONProvider is not None:
+        app.json_provider_class = MongoJSONProvider
+        app.json = MongoJSONProvider(app)
+    else:
+        app.json_encoder = MongoJSONEncoder
+    logger.info(f"JSON encoding installed: {describe_json_encoding(app)}")
+
+
+def describe_json_encoding(app):
+    """Which encoder jsonify() on `app` actually uses (orjson only with a Flask >= 2.2 provider)."""
+    if MongoJSONProvider is not None and isinstance(getattr(app, 'json', None), MongoJSONProvider):
+        return 'orjson via MongoJSONProvider' if orjson is not None else 'stdlib json via MongoJSONProvider'
+    if MongoJSONEncoder is not None and getattr(app, 'json_encoder', None) is MongoJSONEncoder:
+        return 'stdlib json via MongoJSONEncoder (Flask < 2.2, orjson unused)'
+    return "Flask's default JSON encoding"
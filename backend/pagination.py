@@ -0,0 +1,69 @@
+# backend/pagination.py
+# Keyset ("seek") pagination helpers for newest-first lists.
+# Pages are read as "createdAt/_id strictly before the last row of the previous page",
+# which an index on (createdAt, _id) serves directly, instead of .skip() which walks
+# every earlier row. The position is handed to clients as an opaque cursor token.
+import base64
+import binascii
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+# Newest first; _id breaks ties between rows created in the same millisecond
+KEYSET_SORT = [('createdAt', -1), ('_id', -1)]
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor token cannot be decoded."""
+
+
+def encode_cursor(doc):
+    """Opaque token pointing just after `doc` (needs its createdAt and _id)."""
+    created_at = doc.get('createdAt')
+    if isinstance(created_at, datetime):
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc) # PyMongo returns naive UTC
+        created_at = created_at.isoformat()
+    payload = json.dumps({'t': created_at, 'id': str(doc['_id'])}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Returns (createdAt, _id) from a token produced by encode_cursor."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        created_at = payload['t']
+        if created_at is not None:
+            created_at = datetime.fromisoformat(created_at)
+        return created_at, ObjectId(payload['id'])
+    except (ValueError, KeyError, TypeError, binascii.Error) as e:
+        raise InvalidCursor(f"Invalid cursor: {e}") from e
+
+
+def keyset_filter(query, token):
+    """Returns `query` narrowed to the rows after the cursor `token` (KEYSET_SORT order)."""
+    created_at, last_id = decode_cursor(token)
+    if created_at is None:
+        # Rows without createdAt sort last; continue among them by _id only
+        after = {'createdAt': None, '_id': {'$lt': last_id}}
+    else:
+        after = {'$or': [
+            {'createdAt': {'$lt': created_at}},
+            {'createdAt': created_at, '_id': {'$lt': last_id}},
+            {'createdAt': None}, # Legacy rows without a timestamp come after all dated ones
+        ]}
+    return {'$and': [query, after]} if query else after
+
+
+def fetch_keyset_page(collection, query, limit, token=None, projection=None):
+    """Reads one page; returns (rows, next cursor or None when this is the last page)."""
+    if token:
+        query = keyset_filter(query, token)
+    # One extra row tells us whether another page exists without counting
+    rows = list(collection.find(query, projection).sort(KEYSET_SORT).limit(limit + 1))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
@@ -0,0 +1,128 @@
+# backend/password_hashing.py
+# Password hashing off the request threads.
+# PBKDF2 is deliberately slow (~0.1-0.3 s of CPU per call). Run directly in the views,
+# a class logging in at once keeps all Waitress threads busy hashing and every other
+# endpoint stalls. PasswordHasher runs hashes on a fixed pool of `workers` threads
+# (hashlib.pbkdf2_hmac releases the GIL, so they use separate cores) behind a bounded
+# queue. The request thread still waits for its hash, so `workers + max_pending` is the
+# number of request threads hashing may hold: keep it well below the server's thread
+# count. Callers beyond it wait at most `wait_timeout` seconds for admission, and an
+# admitted caller waits at most `result_timeout` for its hash; both then get HashingBusy,
+# which the views turn into a 503 with Retry-After.
+# KeyedLimiter caps concurrent hashes per account and per client IP, so one client
+# retrying in a loop can't take the whole queue.
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METHOD = f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}"
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+def _normalize_method(method):
+    # 'pbkdf2:sha256' means Werkzeug's default iteration count; spell it out so methods compare
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2' and len(parts) == 2:
+        parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return ':'.join(parts)
+
+
+class PasswordHasher:
+    """hash()/verify() on a bounded worker pool; workers=0 hashes on the calling thread."""
+
+    def __init__(self, method=DEFAULT_METHOD, workers=2, max_pending=2, wait_timeout=0.5, result_timeout=5):
+        self.method = _normalize_method(method)
+        self.workers = workers
+        self.wait_timeout = wait_timeout # Seconds a caller waits for a queue slot before HashingBusy
+        self.result_timeout = result_timeout # Seconds an admitted caller waits for its hash before HashingBusy
+        self._slots = threading.BoundedSemaphore(max(1, workers) + max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pwhash') if workers > 0 else None
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise HashingBusy('Password hashing queue is full')
+        if self._executor is None:
+            try:
+                return function(*args)
+            finally:
+                self._slots.release()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash is done (or cancelled), even if the caller stops waiting
+        future.add_done_callback(lambda _future: self._slots.release())
+        try:
+            return future.result(timeout=self.result_timeout)
+        except FutureTimeout:
+            future.cancel() # Drops it if no worker has started it yet
+            raise HashingBusy('Password hashing took too long')
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords):
+        """Hashes a batch (bulk import) on the pool; returns hashes in order.
+
+        Waits for queue slots instead of raising HashingBusy, and keeps at most `workers`
+        of its hashes in flight so logins arriving meanwhile still get their turn.
+        """
+        if self._executor is None:
+            return [generate_password_hash(password, self.method) for password in passwords]
+        window = threading.BoundedSemaphore(self.workers)
+
+        def release(_future):
+            self._slots.release()
+            window.release()
+
+        futures = []
+        for password in passwords:
+            window.acquire()
+            self._slots.acquire()
+            future = self._executor.submit(generate_password_hash, password, self.method)
+            future.add_done_callback(release)
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def verify(self, password_hash, password):
+        if not password_hash:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if `password_hash` was made with another method or cost than the configured one."""
+        return _normalize_method(password_hash.split('$', 1)[0]) != self.method
+
+
+class KeyedLimiter:
+    """Caps concurrent operations per key (account, client IP) within this process."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._active = {}
+
+    def acquire(self, key):
+        """Takes a slot for `key`; returns False (nothing taken) if `key` is at its limit."""
+        with self._lock:
+            count = self._active.get(key, 0)
+            if count >= self.limit:
+                return False
+            self._active[key] = count + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            count = self._active.get(key, 0) - 1
+            if count > 0:
+                self._active[key] = count
+            else:
+                self._active.pop(key, None)
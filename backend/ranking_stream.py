@@ -0,0 +1,295 @@
+# backend/ranking_stream.py
+# Leaderboard change tracking and Server-Sent Events fan-out.
+# - RankingLedger keeps the last ordered ranking indexed by user and turns each
+#   refresh into a small change set (moved/updated/inserted rows + removals)
+#   under a monotonic version number.
+# - RankingBroadcaster runs ONE background watcher for all connected SSE clients
+#   and pushes only those change sets, instead of every stream polling MongoDB.
+# - stream_sources() writes one SSE response from several subscriptions (rankings plus
+#   a user's own events, see user_events.py), so a browser tab needs only one stream.
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# --- Defaults (can be overridden per instance) ---
+SSE_HEARTBEAT_INTERVAL = 15 # Seconds between keep-alive comments on an idle stream
+SSE_CLIENT_QUEUE_SIZE = 16 # Max pending events per client before it is resynced
+SSE_RETRY_MS = 3000 # Reconnect delay suggested to EventSource clients
+RANKING_HISTORY_SIZE = 256 # Versions kept for `since=` / Last-Event-ID catch-up
+
+# Marker put on a client's queue when it fell behind and must be caught up from its last version
+_RESYNC = object()
+
+
+class WakeupQueue(queue.Queue):
+    """Client queue that also sets `wakeup` on every put, so one stream can wait on several queues."""
+
+    def __init__(self, maxsize, wakeup):
+        super().__init__(maxsize)
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self.wakeup.set()
+
+
+def parse_event_ids(last_event_id, count):
+    """Splits a Last-Event-ID into `count` positions (int or None), one per source of a stream."""
+    parts = str(last_event_id or '').strip().split(':')
+    if len(parts) != count:
+        parts = [''] * count
+    return [int(part) if part.isdigit() else None for part in parts]
+
+
+def stream_sources(sources, wakeup, heartbeat_interval=SSE_HEARTBEAT_INTERVAL):
+    """Generator of SSE frames from subscriptions that share `wakeup`; closes them when it ends.
+
+    Each source has `last_id`, `catch_up()` and `pending()` (both yield (event, data) and advance
+    `last_id`) and `close()`. The frame id joins every source's `last_id` with ':', so one
+    Last-Event-ID resumes all of them (parse_event_ids splits it again).
+    """
+    def event_id():
+        return ':'.join('' if source.last_id is None else str(source.last_id) for source in sources)
+
+    try:
+        yield format_sse('connected', event='connected', retry=SSE_RETRY_MS)
+        for source in sources:
+            for event, data in source.catch_up():
+                yield format_sse(data, event=event, event_id=event_id())
+        while True:
+            if not wakeup.wait(heartbeat_interval):
+                yield ': heartbeat\n\n'
+                continue
+            wakeup.clear() # Before draining: a put after this sets it again
+            for source in sources:
+                for event, data in source.pending():
+                    yield format_sse(data, event=event, event_id=event_id())
+    finally:
+        for source in sources:
+            source.close()
+
+
+def format_sse(data, event=None, event_id=None, retry=None):
+    """Formats one Server-Sent Events frame."""
+    lines = []
+    if retry is not None:
+        lines.append(f"retry: {retry}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    for line in str(data).splitlines() or ['']:
+        lines.append(f"data: {line}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class RankingLedger:
+    """Ordered leaderboard indexed by `key`, versioned per change."""
+
+    def __init__(self, key='userId', history_size=RANKING_HISTORY_SIZE):
+        self.key = key
+        self._lock = threading.Lock()
+        # Versions start from the process start time (ms) so a version issued by an
+        # earlier process is older than our history and simply triggers a full snapshot
+        self.version = int(time.time() * 1000)
+        self._rows = [] # Ordered rows, each including its 'rank'
+        self._index = {} # key -> row (with 'rank')
+        # (version, previous version, frozenset of touched keys); versions may skip numbers
+        # when they come from a shared counter, so each entry records what it was diffed from
+        self._history = deque(maxlen=history_size)
+        self._snapshot_json = None # (version, serialized rows) cache
+
+    def update(self, rows, version=None):
+        """Replaces the ranking with `rows` (already ordered); returns (version, delta) or None if unchanged.
+
+        `version` lets several processes share one version sequence; by default the local one is incremented.
+        """
+        new_rows = []
+        new_index = {}
+        for rank, row in enumerate(rows, start=1):
+            ranked_row = dict(row, rank=rank)
+            new_rows.append(ranked_row)
+            new_index[ranked_row.get(self.key)] = ranked_row
+
+        with self._lock:
+            touched = {k for k, row in new_index.items() if self._index.get(k) != row}
+            touched.update(k for k in self._index if k not in new_index)
+            if not touched:
+                return None
+            if version is not None and self._history and version <= self.version:
+                return None # Stale state from another process; we already hold a newer one
+            previous_version = self.version
+            self.version = self.version + 1 if version is None else version
+            self._rows, self._index = new_rows, new_index
+            self._history.append((self.version, previous_version, frozenset(touched)))
+            return self.version, self._build_delta(touched)
+
+    def _build_delta(self, touched):
+        # Caller holds the lock
+        changed = sorted((self._index[k] for k in touched if k in self._index), key=lambda r: r['rank'])
+        removed = [k for k in touched if k not in self._index]
+        return {'version': self.version, 'changed': changed, 'removed': removed}
+
+    def delta_since(self, version):
+        """Merged change set from `version` to now, or None if `version` is outside the kept history."""
+        with self._lock:
+            if version == self.version:
+                return {'version': self.version, 'changed': [], 'removed': []}
+            # We can only diff from a state this process actually held: versions from a shared
+            # sequence skip numbers, and one issued by another process may hide changes we never saw
+            held = {entry_version for entry_version, _, _ in self._history}
+            held.update(previous for _, previous, _ in self._history)
+            if version not in held:
+                return None
+            touched = set()
+            for entry_version, _, keys in self._history:
+                if entry_version > version:
+                    touched.update(keys)
+            return self._build_delta(touched)
+
+    def snapshot(self, limit=None):
+        """Returns (version, rows) for the current ranking."""
+        with self._lock:
+            rows = self._rows if limit is None else self._rows[:limit]
+            return self.version, list(rows)
+
+    def snapshot_json(self):
+        """Returns (version, JSON array of rows), serialized at most once per version."""
+        with self._lock:
+            if self._snapshot_json is None or self._snapshot_json[0] != self.version:
+                self._snapshot_json = (self.version, json.dumps(self._rows))
+            return self._snapshot_json
+
+
+class RankingBroadcaster:
+    """Runs one watcher while clients are connected and pushes its events to every client.
+
+    `poll_changes()` returns (version, event, payload) when something changed, else None.
+    `catch_up(version)` returns the frames that bring a client at `version` (None = new
+    client) up to date: nothing, a merged delta, or a full snapshot.
+    """
+
+    def __init__(self, poll_changes, catch_up, poll_interval=5, heartbeat_interval=SSE_HEARTBEAT_INTERVAL,
+                 queue_size=SSE_CLIENT_QUEUE_SIZE):
+        self._poll_changes = poll_changes
+        self._catch_up = catch_up
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._watcher = None
+
+    # --- Subscriber management ---
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _subscribe(self, client_queue):
+        with self._lock:
+            self._subscribers.add(client_queue)
+            # Start the shared watcher lazily; it exits again once the last client leaves
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch, name='ranking-sse-watcher', daemon=True)
+                self._watcher.start()
+        logger.info(f"Ranking SSE client connected ({self.subscriber_count()} active)")
+        return client_queue
+
+    def _unsubscribe(self, client_queue):
+        with self._lock:
+            self._subscribers.discard(client_queue)
+            remaining = len(self._subscribers)
+        logger.info(f"Ranking SSE client disconnected ({remaining} active)")
+
+    # --- Watcher / publishing ---
+    def _watch(self):
+        logger.info("Ranking SSE watcher started")
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._watcher = None
+                    break
+            try:
+                event = self._poll_changes()
+                if event is not None:
+                    self.publish(*event)
+            except Exception as e:
+                logger.error(f"Ranking SSE watcher error: {e}", exc_info=True)
+            time.sleep(self.poll_interval)
+        logger.info("Ranking SSE watcher stopped (no clients)")
+
+    def publish(self, version, event, payload):
+        """Pushes one event to every connected client."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for client_queue in subscribers:
+            try:
+                client_queue.put_nowait((version, event, payload))
+            except queue.Full:
+                # Slow client: drop its backlog and let it catch up with one merged delta
+                self._drain(client_queue)
+                try:
+                    client_queue.put_nowait(_RESYNC)
+                except queue.Full:
+                    pass
+        logger.debug(f"Ranking SSE event {version} ({event}) published to {len(subscribers)} clients")
+
+    @staticmethod
+    def _drain(client_queue):
+        try:
+            while True:
+                client_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    @staticmethod
+    def _parse_event_id(last_event_id):
+        last_event_id = str(last_event_id or '').strip()
+        return int(last_event_id) if last_event_id.isdigit() else None
+
+    # --- Per-client stream ---
+    def subscribe(self, last_version, wakeup):
+        """Ranking source for stream_sources(), resuming after `last_version` (None = new client)."""
+        return RankingSubscription(self, last_version, wakeup)
+
+    def stream(self, last_event_id=None):
+        """Generator of SSE frames for one client; resumes from `last_event_id` when possible."""
+        wakeup = threading.Event()
+        yield from stream_sources([self.subscribe(self._parse_event_id(last_event_id), wakeup)], wakeup,
+                                  self.heartbeat_interval)
+
+
+class RankingSubscription:
+    """One client's place in the ranking event sequence."""
+
+    def __init__(self, broadcaster, last_version, wakeup):
+        self._broadcaster = broadcaster
+        self.last_id = last_version
+        self._queue = broadcaster._subscribe(WakeupQueue(broadcaster.queue_size, wakeup))
+
+    def catch_up(self):
+        for version, event, payload in self._broadcaster._catch_up(self.last_id):
+            self.last_id = version
+            yield event, payload
+
+    def pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            frames = self._broadcaster._catch_up(self.last_id) if item is _RESYNC else [item]
+            for version, event, payload in frames:
+                if self.last_id is not None and version <= self.last_id:
+                    continue # Already delivered during catch-up
+                self.last_id = version
+                yield event, payload
+
+    def close(self):
+        self._broadcaster._unsubscribe(self._queue)
@@ -0,0 +1,160 @@
+# backend/ranking_writer.py
+# Write-behind buffer for db.rankings.
+# Point changes arrive in bursts (class-wide mini-games) for the same few students;
+# instead of one upsert per change, the latest values per userId are kept for a short
+# window and written with a single unordered bulk_write.
+# Buffered values can arrive out of order (two requests updating the same student), so
+# with `load_rows` the rows are re-read from their source at flush time and the newest
+# values win. A failing write is retried with exponential backoff; rows that still fail
+# after `max_attempts` flushes are dropped (the users collection stays the source of
+# truth, and the student's next change queues the row again).
+import atexit
+import logging
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class RankingWriteBuffer:
+    """Coalesces ranking upserts per userId and flushes them in batches."""
+
+    def __init__(self, collection, load_rows=None, flush_interval=0.5, max_pending=500,
+                 max_retry_delay=30, max_attempts=8):
+        """`load_rows(user_ids)` returns {userId: fields} as they are now; ids it leaves out are not written."""
+        self._collection = collection
+        self._load_rows = load_rows
+        self.flush_interval = flush_interval # Max seconds a change waits before being written
+        self.max_pending = max_pending # Flush early once this many users are pending
+        self.max_retry_delay = max_retry_delay # Cap (seconds) of the backoff after failed flushes
+        self.max_attempts = max_attempts # Failed flushes before a row is dropped
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # One flush at a time (thread + shutdown hook)
+        self._pending = {} # userId -> fields to $set (latest added; replaced by load_rows at flush)
+        self._attempts = {} # userId -> failed flushes in a row
+        self._retry_delay = 0 # Current backoff; 0 while writes succeed
+        self._retry_at = 0 # time.monotonic() before which the flusher doesn't retry
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._stats = {'buffered': 0, 'coalesced': 0, 'flushed': 0, 'batches': 0, 'errors': 0, 'dropped': 0}
+        self._thread = threading.Thread(target=self._run, name='ranking-write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, user_id_str, fields):
+        """Queues `fields` to be $set on the ranking row of `user_id_str` (upserted)."""
+        if self._stopped.is_set():
+            # After shutdown there is no flusher any more: write through
+            self._write({user_id_str: fields})
+            return
+        with self._lock:
+            if user_id_str in self._pending:
+                self._stats['coalesced'] += 1
+            self._pending[user_id_str] = fields
+            self._stats['buffered'] += 1
+            pending_count = len(self._pending)
+        if pending_count >= self.max_pending:
+            self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), retryDelay=self._retry_delay)
+
+    def flush(self, force=False):
+        """Writes all pending rows now; returns the number of rows written.
+
+        While backing off after a failure nothing is written unless `force` is set.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not force and time.monotonic() < self._retry_at:
+                    return 0
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            failed = self._write(batch)
+            self._record_result(batch, failed)
+            return len(batch) - len(failed)
+
+    def _record_result(self, batch, failed):
+        with self._lock:
+            for user_id_str in batch:
+                if user_id_str not in failed:
+                    self._attempts.pop(user_id_str, None)
+            if not failed:
+                self._retry_delay = self._retry_at = 0
+                return
+            self._retry_delay = min(self.max_retry_delay, max(self.flush_interval, self._retry_delay * 2))
+            self._retry_at = time.monotonic() + self._retry_delay
+            dropped = []
+            for user_id_str in failed:
+                attempts = self._attempts[user_id_str] = self._attempts.get(user_id_str, 0) + 1
+                if attempts >= self.max_attempts:
+                    del self._attempts[user_id_str]
+                    dropped.append(user_id_str)
+                else:
+                    # Put it back unless a newer value arrived meanwhile; retried after the backoff
+                    self._pending.setdefault(user_id_str, batch[user_id_str])
+            self._stats['dropped'] += len(dropped)
+        if dropped:
+            logger.error(f"Ranking write-behind dropped {len(dropped)} rows after {self.max_attempts} failed flushes: "
+                         f"{dropped[:10]}")
+        if len(failed) > len(dropped):
+            logger.warning(f"Ranking write-behind retrying {len(failed) - len(dropped)} rows in {self._retry_delay:g}s")
+
+    def _write(self, batch):
+        # Returns the set of userIds whose row was not written
+        try:
+            rows = self._load_rows(list(batch)) if self._load_rows else batch
+        except Exception as e:
+            with self._lock:
+                self._stats['errors'] += 1
+            logger.error(f"Ranking write-behind could not load {len(batch)} rows: {e}")
+            return set(batch)
+        user_ids = list(rows)
+        if not user_ids:
+            return set()
+        operations = [UpdateOne({'userId': user_id_str}, {'$set': rows[user_id_str]}, upsert=True)
+                      for user_id_str in user_ids]
+        try:
+            self._collection.bulk_write(operations, ordered=False)
+            failed = set()
+        except BulkWriteError as e:
+            # Unordered: the other rows were written
+            write_errors = e.details.get('writeErrors') or []
+            failed = {user_ids[error['index']] for error in write_errors if error.get('index', len(user_ids)) < len(user_ids)}
+            failed = failed or set(user_ids) # e.g. only a write concern error: assume nothing was written
+            logger.error(f"Ranking write-behind flush failed for {len(failed)} of {len(operations)} rows: "
+                         f"{write_errors[:1] or e}")
+        except Exception as e:
+            failed = set(user_ids)
+            logger.error(f"Ranking write-behind flush failed ({len(operations)} rows): {e}")
+        with self._lock:
+            if failed:
+                self._stats['errors'] += 1
+            self._stats['flushed'] += len(operations) - len(failed)
+            self._stats['batches'] += 1
+        logger.debug(f"Ranking write-behind flushed {len(operations) - len(failed)} rows")
+        return failed
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ranking write-behind error: {e}", exc_info=True)
+
+    def close(self):
+        """Stops the background flusher and writes whatever is still pending (shutdown hook)."""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        written = self.flush(force=True)
+        logger.info(f"Ranking write-behind closed. Final flush: {written} rows. Stats: {self.stats()}")
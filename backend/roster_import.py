@@ -0,0 +1,68 @@
+# backend/roster_import.py
+# Row reader for the teacher roster import (POST /api/users/import).
+# Accepts CSV with a header row (email, name, password, optional role; any column order,
+# case-insensitive) or NDJSON (one JSON object per line). Rows are read one at a time from
+# the uploaded stream, so a large roster is never held in memory as a whole; the app
+# validates, hashes and inserts them in batches.
+import csv
+import io
+import json
+
+ROSTER_FIELDS = ('email', 'name', 'password', 'role')
+ROSTER_FORMATS = {'csv': 'csv', 'ndjson': 'ndjson', 'jsonl': 'ndjson'}
+
+
+class RosterFormatError(ValueError):
+    """The upload is not a readable CSV/NDJSON roster."""
+
+
+def roster_format(filename, requested=None):
+    """'csv' or 'ndjson' from ?format= or the file extension; None if unknown."""
+    if requested:
+        return ROSTER_FORMATS.get(requested.lower())
+    extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+    return ROSTER_FORMATS.get(extension)
+
+
+def iter_roster_rows(binary_stream, fmt):
+    """Yields (line number, {field: str}) for each non-empty row; raises RosterFormatError."""
+    text = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='') # utf-8-sig: Excel's BOM
+    try:
+        if fmt == 'csv':
+            yield from _csv_rows(text)
+        else:
+            yield from _ndjson_rows(text)
+    except UnicodeDecodeError as e:
+        raise RosterFormatError(f"File is not UTF-8 text: {e}") from e
+    finally:
+        text.detach() # Leave closing the upload to the request
+
+
+def _csv_rows(text):
+    reader = csv.reader(text)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [column.strip().lower() for column in header]
+    if 'email' not in columns:
+        raise RosterFormatError("CSV header must include an 'email' column")
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        row = {column: value for column, value in zip(columns, values) if column in ROSTER_FIELDS}
+        yield reader.line_num, row
+
+
+def _ndjson_rows(text):
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield line_number, None # Reported as an invalid row; the rest of the file is still read
+            continue
+        if not isinstance(item, dict):
+            yield line_number, None
+            continue
+        yield line_number, {key: item[key] for key in ROSTER_FIELDS if key in item}
@@ -0,0 +1,172 @@
+# backend/static_assets.py
+# Fingerprinted, precompressed frontend assets.
+# `python backend/static_assets.py` (run at deploy time) copies every file under
+# frontend/assets to BUILD_DIR as <name>.<hash>.<ext>, adds .gz and .br (if the `brotli`
+# package is installed) variants for text-like files when they are smaller, and writes
+# manifest.json mapping each logical path to its build file. The app then serves
+# fingerprinted names with year-long immutable caching and picks the precompressed
+# variant matching Accept-Encoding, so nothing is compressed per request.
+# The app reads the manifest once at startup, so restart it after a build to serve the
+# new names; until then the previous build's files, kept in the new build for one
+# generation, keep the old names working.
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+FINGERPRINT_LENGTH = 10
+# Images, audio and woff2 are already compressed; only these are worth a .gz/.br
+COMPRESSIBLE_EXTENSIONS = {'.js', '.mjs', '.css', '.svg', '.json', '.map', '.txt', '.html', '.xml',
+                           '.ttf', '.otf', '.eot', '.ico', '.wasm'}
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'} # Preference order when the client accepts both
+
+
+def fingerprinted_name(relative_path, sha256):
+    directory, filename = os.path.split(relative_path)
+    stem, ext = os.path.splitext(filename)
+    return os.path.join(directory, f"{stem}.{sha256[:FINGERPRINT_LENGTH]}{ext}").replace(os.sep, '/')
+
+
+def _write_if_smaller(path, data, original_size):
+    if len(data) >= original_size:
+        return None
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+
+def build_assets(assets_dir, build_dir):
+    """Rebuilds `build_dir` from `assets_dir`; returns the manifest."""
+    staging_dir = build_dir.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    assets = {}
+    for current_dir, dir_names, file_names in os.walk(assets_dir):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+        for file_name in sorted(file_names):
+            if file_name.startswith('.'):
+                continue
+            source_path = os.path.join(current_dir, file_name)
+            relative_path = os.path.relpath(source_path, assets_dir).replace(os.sep, '/')
+            with open(source_path, 'rb') as f:
+                data = f.read()
+            sha256 = hashlib.sha256(data).hexdigest()
+            build_name = fingerprinted_name(relative_path, sha256)
+            build_path = os.path.join(staging_dir, build_name)
+            os.makedirs(os.path.dirname(build_path), exist_ok=True)
+            shutil.copyfile(source_path, build_path)
+
+            encodings = {}
+            if os.path.splitext(file_name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                # mtime=0 keeps the .gz identical across builds of the same file
+                size = _write_if_smaller(build_path + '.gz', gzip.compress(data, 9, mtime=0), len(data))
+                if size is not None:
+                    encodings['gzip'] = size
+                if brotli is not None:
+                    size = _write_if_smaller(build_path + '.br', brotli.compress(data, quality=11), len(data))
+                    if size is not None:
+                        encodings['br'] = size
+            assets[relative_path] = {'path': build_name, 'sha256': sha256, 'size': len(data), 'encodings': encodings}
+
+    manifest = {'version': 1, 'assets': assets}
+    with open(os.path.join(staging_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    _carry_over_previous_build(build_dir, staging_dir)
+    # Swap the finished build in. A running server keeps its old manifest until it restarts;
+    # the carried-over files keep every name in it resolvable meanwhile
+    previous_dir = build_dir.rstrip(os.sep) + '.old'
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    if os.path.exists(build_dir):
+        os.replace(build_dir, previous_dir)
+    os.replace(staging_dir, build_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    return manifest
+
+
+def _carry_over_previous_build(build_dir, staging_dir):
+    # Copies the files named by the current build's manifest into the new one (content-hashed
+    # names never clash), so servers started before this build don't 404 on their asset URLs.
+    # Only one generation is kept: files the previous build had carried over are not copied again.
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME), encoding='utf-8') as f:
+            previous_assets = json.load(f)['assets']
+    except (FileNotFoundError, ValueError, KeyError):
+        return
+    for entry in previous_assets.values():
+        for suffix in [''] + [ENCODING_SUFFIXES[encoding] for encoding in entry.get('encodings', {})]:
+            source_path = os.path.join(build_dir, entry['path'] + suffix)
+            target_path = os.path.join(staging_dir, entry['path'] + suffix)
+            if os.path.exists(target_path) or not os.path.exists(source_path):
+                continue
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.copyfile(source_path, target_path)
+
+
+class AssetManifest:
+    """Read side of a build: resolves requested /assets paths to build files."""
+
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+        self.assets = {}
+        self._by_build_path = {}
+        try:
+            with open(os.path.join(build_dir, MANIFEST_NAME), encoding='utf-8') as f:
+                self.assets = json.load(f)['assets']
+        except FileNotFoundError:
+            logger.warning(f"No asset build at {build_dir}; /assets is served uncompressed (run static_assets.py)")
+        except (ValueError, KeyError) as e:
+            logger.error(f"Unreadable asset manifest in {build_dir}: {e}")
+        for logical_path, entry in self.assets.items():
+            self._by_build_path[entry['path']] = logical_path
+
+    def __bool__(self):
+        return bool(self.assets)
+
+    def resolve(self, requested_path):
+        """Returns (entry, fingerprinted) for a logical or fingerprinted path, or (None, False)."""
+        logical_path = self._by_build_path.get(requested_path)
+        if logical_path is not None:
+            return self.assets[logical_path], True
+        return self.assets.get(requested_path), False
+
+    def url_for(self, logical_path, prefix='/assets'):
+        entry = self.assets.get(logical_path)
+        return f"{prefix}/{entry['path'] if entry else logical_path}"
+
+    def rewrite_html(self, html, prefix='/assets'):
+        """Points src/href="assets/..." references in a page at the fingerprinted files."""
+        pattern = re.compile(r'((?:src|href)=")(?:\./|/)?assets/([^"?#]+)(")')
+        return pattern.sub(lambda m: f"{m.group(1)}{self.url_for(m.group(2), prefix)}{m.group(3)}", html)
+
+
+def choose_encoding(entry, accept_encodings):
+    """Best precompressed variant of `entry` the client accepts: 'br', 'gzip' or None (identity).
+
+    `accept_encodings` is Werkzeug's request.accept_encodings.
+    """
+    for encoding in ENCODING_SUFFIXES:
+        if encoding in entry.get('encodings', {}) and accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    backend_dir = os.path.abspath(os.path.dirname(__file__))
+    source = os.path.join(os.path.dirname(backend_dir), 'frontend', 'assets')
+    target = os.getenv('ASSET_BUILD_DIR', os.path.join(backend_dir, 'build', 'assets'))
+    result = build_assets(source, target)
+    compressed = sum(1 for entry in result['assets'].values() if entry['encodings'])
+    logger.info(f"Built {len(result['assets'])} assets into {target} ({compressed} precompressed"
+                f"{'' if brotli else ', gzip only: install brotli for .br'})")
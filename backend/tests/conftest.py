@@ -0,0 +1,8 @@
+# backend/tests/conftest.py
+# The backend modules import each other as top-level modules (e.g. `from cache import ...`),
+# so the tests run with backend/ on sys.path. Run from the repo root: python -m pytest backend/tests
+# (test dependencies: pip install -r backend/requirements-dev.txt)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,152 @@
+# backend/tests/test_cache.py
+# Shared cache (cache.py): in-memory implementation, Redis implementation against fakeredis,
+# and the in-memory fallback when Redis stops answering.
+# The Redis tests need fakeredis (backend/requirements-dev.txt) and are skipped without it.
+import time
+from datetime import datetime, timezone
+
+import pytest
+from bson import ObjectId
+
+from cache import MemorySharedCache, RedisSharedCache
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+@pytest.fixture
+def redis_server():
+    if fakeredis is None:
+        pytest.skip('fakeredis is not installed (pip install -r backend/requirements-dev.txt)')
+    return fakeredis.FakeServer()
+
+
+def redis_cache(server):
+    return RedisSharedCache(fakeredis.FakeRedis(server=server))
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+# --- MemorySharedCache ---
+def test_memory_get_set_delete():
+    cache = MemorySharedCache()
+    assert cache.get('missing', 'default') == 'default'
+    assert cache.set('k', {'a': 1})
+    assert cache.get('k') == {'a': 1}
+    cache.delete('k')
+    assert cache.get('k') is None
+
+
+def test_memory_set_nx_and_ttl():
+    cache = MemorySharedCache()
+    assert cache.set('k', 1, nx=True)
+    assert not cache.set('k', 2, nx=True)
+    assert cache.get('k') == 1
+    cache.set('short', 1, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get('short') is None
+    assert cache.set('short', 2, nx=True) # Expired keys count as absent
+
+
+def test_memory_incr_starts_from_initial():
+    cache = MemorySharedCache()
+    assert cache.incr('counter', initial=100) == 101
+    assert cache.incr('counter', initial=100) == 102
+
+
+def test_memory_lock_is_exclusive_until_released():
+    cache = MemorySharedCache()
+    assert cache.acquire_lock('job', ttl=10)
+    assert not cache.acquire_lock('job', ttl=10)
+    cache.release_lock('job')
+    assert cache.acquire_lock('job', ttl=10)
+
+
+def test_memory_publish_reaches_subscribers_and_survives_errors():
+    cache = MemorySharedCache()
+    received = []
+
+    def failing(namespace, key):
+        raise RuntimeError('boom')
+
+    cache.subscribe(failing)
+    cache.subscribe(lambda namespace, key: received.append((namespace, key)))
+    cache.publish('user', '42')
+    assert received == [('user', '42')]
+
+
+# --- RedisSharedCache (fakeredis) ---
+def test_redis_values_round_trip_with_bson_types(redis_server):
+    cache = redis_cache(redis_server)
+    value = {'id': ObjectId(), 'at': datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc), 'rows': [1, 2]}
+    assert cache.set('k', value)
+    assert cache.get('k') == value
+    cache.delete('k')
+    assert cache.get('k', 'gone') == 'gone'
+
+
+def test_redis_values_are_shared_between_processes(redis_server):
+    first, second = redis_cache(redis_server), redis_cache(redis_server)
+    first.set('ranking:state', {'version': 7})
+    assert second.get('ranking:state') == {'version': 7}
+    assert first.set('only-once', 1, nx=True)
+    assert not second.set('only-once', 2, nx=True)
+
+
+def test_redis_ttl(redis_server):
+    cache = redis_cache(redis_server)
+    cache.set('k', 1, ttl=1)
+    assert cache._redis.ttl(cache._key('k')) == 1
+
+
+def test_redis_incr_is_one_sequence_across_processes(redis_server):
+    first, second = redis_cache(redis_server), redis_cache(redis_server)
+    assert first.incr('ranking:version', initial=1000) == 1001
+    assert second.incr('ranking:version', initial=5) == 1002 # Seed only applies to a missing key
+    assert first.incr('ranking:version') == 1003
+
+
+def test_redis_lock_is_shared(redis_server):
+    first, second = redis_cache(redis_server), redis_cache(redis_server)
+    assert first.acquire_lock('ranking:refresh', ttl=5)
+    assert not second.acquire_lock('ranking:refresh', ttl=5)
+    first.release_lock('ranking:refresh')
+    assert second.acquire_lock('ranking:refresh', ttl=5)
+
+
+def test_redis_invalidation_reaches_other_process(redis_server):
+    publisher, listener = redis_cache(redis_server), redis_cache(redis_server)
+    received = []
+    listener.subscribe(lambda namespace, key: received.append((namespace, key)))
+    # The listener thread subscribes asynchronously; publish until it sees a message
+    assert wait_for(lambda: (publisher.publish('ping', ''), received)[1] != [])
+    received.clear()
+    publisher.publish('user', '5f0c')
+    assert wait_for(lambda: ('user', '5f0c') in received)
+
+
+# --- Redis down: same API from process memory ---
+def test_redis_down_falls_back(redis_server):
+    cache = redis_cache(redis_server)
+    cache.set('k', 'cached')
+    received = []
+    cache._subscribers.append(lambda namespace, key: received.append((namespace, key))) # No listener thread
+    redis_server.connected = False
+
+    assert cache.get('k', 'default') == 'default'
+    assert cache.set('k', 'new') is False
+    cache.delete('k') # Logged, not raised
+    assert cache.incr('ranking:version', initial=500) == 501
+    assert cache.incr('ranking:version', initial=500) == 502
+    assert cache.acquire_lock('ranking:refresh', ttl=5) # This process does the work itself
+    cache.publish('user', '1')
+    assert received == [('user', '1')] # Local invalidation still happens
@@ -0,0 +1,134 @@
+# backend/tests/test_gemini_client.py
+# GeminiClient against a local HTTP stub standing in for generativelanguage.googleapis.com.
+# The model name in the URL picks the stub's behaviour: 'ok', 'bad' (400) or 'slow'
+# (waits until the test releases it).
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from gemini_client import GeminiBusy, GeminiClient, chunk_text
+
+
+def reply(text, finish_reason=None):
+    candidate = {'content': {'parts': [{'text': text}]}}
+    if finish_reason:
+        candidate['finishReason'] = finish_reason
+    return {'candidates': [candidate]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.path, self.headers.get('x-goog-api-key'), json.loads(body)))
+        model, method = self.path.split('/models/', 1)[1].split('?', 1)[0].split(':', 1)
+        if model == 'bad':
+            return self._send(400, b'{"error": {"message": "bad request"}}', 'application/json')
+        if model == 'slow':
+            self.server.release.wait(5)
+        if method == 'generateContent':
+            return self._send(200, json.dumps(reply('Hello')).encode(), 'application/json')
+        events = [reply('Hel'), reply('lo', 'STOP')]
+        stream = b''.join(b'data: ' + json.dumps(event).encode() + b'\r\n\r\n' for event in events)
+        self._send(200, stream, 'text/event-stream')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.release = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def client(stub, model='ok', **kwargs):
+    base_url = f"http://127.0.0.1:{stub.server_address[1]}/v1beta"
+    return GeminiClient('test-key', model, base_url=base_url, **kwargs)
+
+
+def free_slots(gemini):
+    return gemini._slots._value
+
+
+def test_generate_posts_payload_with_key_header(stub):
+    gemini = client(stub)
+    result = gemini.generate({'contents': []})
+    assert chunk_text(result) == 'Hello'
+    path, api_key, payload = stub.requests[0]
+    assert path == '/v1beta/models/ok:generateContent'
+    assert api_key == 'test-key'
+    assert payload == {'contents': []}
+    assert free_slots(gemini) == gemini.max_concurrent
+
+
+def test_stream_yields_sse_chunks(stub):
+    gemini = client(stub)
+    chunks = list(gemini.stream({'contents': []}))
+    assert [chunk_text(chunk) for chunk in chunks] == ['Hel', 'lo']
+    assert chunks[-1]['candidates'][0]['finishReason'] == 'STOP'
+    assert stub.requests[0][0] == '/v1beta/models/ok:streamGenerateContent?alt=sse'
+    assert free_slots(gemini) == gemini.max_concurrent
+
+
+def test_busy_when_all_slots_taken_and_released_after(stub):
+    gemini = client(stub, model='slow', max_concurrent=1, acquire_timeout=0.1)
+    result = {}
+    worker = threading.Thread(target=lambda: result.setdefault('reply', gemini.generate({})))
+    worker.start()
+    while not stub.requests:
+        threading.Event().wait(0.01)
+    with pytest.raises(GeminiBusy):
+        gemini.generate({})
+    with pytest.raises(GeminiBusy):
+        next(gemini.stream({}))
+    stub.release.set()
+    worker.join(5)
+    assert chunk_text(result['reply']) == 'Hello'
+    assert free_slots(gemini) == 1
+    assert chunk_text(gemini.generate({})) == 'Hello' # The slot is usable again
+
+
+def test_stream_closed_early_releases_slot(stub):
+    gemini = client(stub, max_concurrent=1)
+    chunks = gemini.stream({})
+    assert chunk_text(next(chunks)) == 'Hel'
+    assert free_slots(gemini) == 0
+    chunks.close() # Browser went away mid-reply
+    assert free_slots(gemini) == 1
+
+
+def test_4xx_raises_http_error_and_releases_slot(stub):
+    gemini = client(stub, model='bad', max_concurrent=1)
+    with pytest.raises(requests.exceptions.HTTPError) as error:
+        gemini.generate({})
+    assert error.value.response.status_code == 400
+    assert free_slots(gemini) == 1
+    with pytest.raises(requests.exceptions.HTTPError):
+        next(gemini.stream({}))
+    assert free_slots(gemini) == 1
+
+
+def test_chunk_text_tolerates_missing_candidates():
+    assert chunk_text({}) == ''
+    assert chunk_text({'candidates': []}) == ''
+    assert chunk_text(reply('x')) == 'x'
@@ -0,0 +1,93 @@
+# backend/token_claims.py
+# Revocation for claims-bearing JWTs.
+# Each user has a `tokenVersion` (0 if never set) that is copied into the tokens issued to
+# them; bumping it (password change) invalidates every older token. Checking a token
+# therefore needs only "user -> current tokenVersion", which TokenRevocations keeps in
+# memory: only users whose version was ever bumped are stored, loaded at startup and then
+# refreshed periodically by `tokenVersionChangedAt`, so routes that trust the token's claims
+# never read db.users. Bumps made by this process (or announced on the shared-cache bus)
+# apply at once; the periodic refresh bounds how long other processes may lag.
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+REVOCATION_NAMESPACE = 'token_version' # Shared-cache pub/sub namespace, key '<user id>:<version>'
+REFRESH_OVERLAP = timedelta(seconds=5) # Re-read a little before the last refresh (clock skew, slow writes)
+
+
+class TokenRevocations:
+    """user id -> minimum valid tokenVersion, mirrored from the users collection."""
+
+    def __init__(self, users_collection, shared_cache=None, refresh_interval=30):
+        self._users = users_collection
+        self._shared_cache = shared_cache
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._refreshed_at = None
+        self._thread = None
+        if shared_cache is not None:
+            shared_cache.subscribe(self._on_message)
+
+    def min_version(self, user_id):
+        with self._lock:
+            return self._versions.get(str(user_id), 0)
+
+    def is_valid(self, user_id, token_version):
+        return (token_version or 0) >= self.min_version(user_id)
+
+    def _apply(self, user_id, version):
+        with self._lock:
+            # Versions only grow; an older message arriving late must not lower the minimum
+            if version > self._versions.get(user_id, 0):
+                self._versions[user_id] = version
+
+    def announce(self, user_id, version):
+        """Applies a bump made by this process right away and tells the other processes."""
+        self._apply(str(user_id), version)
+        if self._shared_cache is not None and self._shared_cache.distributed:
+            self._shared_cache.publish(REVOCATION_NAMESPACE, f"{user_id}:{version}")
+
+    def _on_message(self, namespace, key):
+        if namespace != REVOCATION_NAMESPACE or ':' not in key:
+            return
+        user_id, version = key.rsplit(':', 1)
+        if version.isdigit():
+            self._apply(user_id, int(version))
+
+    def refresh(self):
+        """Loads versions bumped since the previous refresh (all bumped users the first time)."""
+        started_at = datetime.now(timezone.utc)
+        if self._refreshed_at is None:
+            query = {'tokenVersion': {'$gt': 0}}
+        else:
+            query = {'tokenVersionChangedAt': {'$gte': self._refreshed_at - REFRESH_OVERLAP}}
+        count = 0
+        for user in self._users.find(query, {'tokenVersion': 1}):
+            self._apply(str(user['_id']), user.get('tokenVersion') or 0)
+            count += 1
+        self._refreshed_at = started_at
+        return count
+
+    def start(self):
+        """Initial load (synchronous, so no revoked token is accepted at startup) plus the refresh thread."""
+        loaded = self.refresh()
+        logger.info(f"Token revocations loaded: {loaded} users with bumped token versions")
+        if self._thread is None and self.refresh_interval > 0:
+            self._thread = threading.Thread(target=self._run, name='token-revocations', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Token revocation refresh failed: {e}", exc_info=True)
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._versions), 'refreshedAt': self._refreshed_at}
@@ -0,0 +1,330 @@
+# backend/uploads.py
+# Streaming ingest for multipart uploads.
+# Werkzeug normally spools every file part to a temporary file (or memory) and the
+# handler then copies it again with file.save(). A view that sets an UploadPolicy on
+# the request instead gets each file part streamed, chunk by chunk as the parser
+# reads the body, into a temp file inside the destination folder:
+# - the extension is checked as soon as the part header arrives (before its body),
+# - the size limit is enforced while writing, so an oversize part stops the read,
+# - the SHA-256 is computed on the way in,
+# - commit_upload() moves the finished file into place with an atomic rename.
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import fcntl # Cross-process lock on partial uploads (POSIX)
+except ImportError:
+    fcntl = None
+
+from flask import Request
+
+logger = logging.getLogger(__name__)
+
+TEMP_PREFIX = '.upload-' # Partial files; never served (and safe to sweep)
+TEMP_SUFFIX = '.part'
+
+
+class UploadRejected(Exception):
+    """Upload refused while streaming; carries the HTTP status and client message."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class UploadPolicy:
+    """Where and what a view accepts: destination folder, allowed extensions, max bytes per file."""
+
+    def __init__(self, dest_dir, allowed_extensions, max_size):
+        self.dest_dir = dest_dir
+        self.allowed_extensions = allowed_extensions
+        self.max_size = max_size
+
+    def check_filename(self, filename):
+        ext = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+        if ext not in self.allowed_extensions:
+            raise UploadRejected(f'File type "{ext or "?"}" not allowed. Allowed: {", ".join(sorted(self.allowed_extensions))}')
+
+
+class HashingUploadFile:
+    """Writable/readable temp file that enforces the size limit and hashes while it is written."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        fd, self.temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX, dir=policy.dest_dir)
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.policy.max_size:
+            limit_mb = self.policy.max_size / (1024 * 1024)
+            self.close() # Not yet attached to request.files, so nothing else would remove it
+            raise UploadRejected(f'File size exceeds limit ({limit_mb:.1f}MB)', 413)
+        self._hash.update(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        # Uncommitted parts (rejected, failed or unused uploads) are removed with the request
+        if not self._file.closed:
+            self._file.close()
+        if not self.committed:
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        # read/readline/seek/tell/flush... go to the underlying file
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request class that streams file parts according to `upload_policy` when a view sets one."""
+
+    upload_policy = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._upload_files = [] # Temp files opened for this request's parts
+
+    def _load_form_data(self):
+        try:
+            super()._load_form_data()
+        except BaseException:
+            # A rejected (or broken) part stops the parse before request.files exists, so
+            # nothing would close the parts accepted before it: remove their temp files here
+            for upload_file in self._upload_files:
+                upload_file.close()
+            raise
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        policy = self.upload_policy
+        if policy is None or not filename:
+            # No policy, or an empty file input (the view reports "No selected file")
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        policy.check_filename(filename) # Reject before the part's body is read
+        if content_length is not None and content_length > policy.max_size:
+            raise UploadRejected(f'File size exceeds limit ({policy.max_size / (1024 * 1024):.1f}MB)', 413)
+        upload_file = HashingUploadFile(policy)
+        self._upload_files.append(upload_file)
+        return upload_file
+
+
+def commit_upload(file_storage, dest_path):
+    """Moves a streamed upload to `dest_path` (same filesystem, atomic). Returns (sha256, size)."""
+    stream = file_storage.stream
+    if not isinstance(stream, HashingUploadFile):
+        raise TypeError('commit_upload needs a file streamed under an UploadPolicy')
+    stream.flush()
+    os.fsync(stream.fileno())
+    os.replace(stream.temp_path, dest_path)
+    stream.committed = True
+    stream.close()
+    return stream.sha256, stream.size
+
+
+def new_temp_path(directory):
+    """A fresh temp-file name in `directory` that remove_stale_temp_files() will sweep if it is left behind."""
+    return os.path.join(directory, f"{TEMP_PREFIX}{uuid.uuid4().hex}{TEMP_SUFFIX}")
+
+
+def remove_stale_temp_files(directory, max_age_seconds=3600, now=None):
+    """Deletes partial uploads left behind by crashed workers or aborted requests; returns how many were removed."""
+    now = now or time.time()
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.startswith(TEMP_PREFIX) and entry.name.endswith(TEMP_SUFFIX):
+            try:
+                if now - entry.stat().st_mtime > max_age_seconds:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"Could not remove stale upload {entry.path}: {e}")
+    return removed
+
+
+# --- Resumable uploads (tus-style: create -> PATCH chunks at offsets -> finalize) ---
+# State lives on disk next to the submissions so any worker process can continue an
+# upload: <id>.part holds the bytes received so far (its size IS the offset) and
+# <id>.json the metadata given at creation. Abandoned uploads are expired by a janitor.
+RESUMABLE_DIR_NAME = '.resumable'
+RESUMABLE_CHUNK_SIZE = 64 * 1024 # Bytes read from the request per write
+
+
+class ResumableUploadStore:
+    """Partial uploads on disk, appended to in order and expired after `ttl` seconds of inactivity."""
+
+    def __init__(self, parent_dir, ttl=24 * 3600):
+        self.root = os.path.join(parent_dir, RESUMABLE_DIR_NAME)
+        self.ttl = ttl
+        os.makedirs(self.root, exist_ok=True)
+        self._janitor = None
+
+    def _paths(self, upload_id):
+        # Ids are uuid4 hex; anything else could escape the folder
+        if not upload_id or len(upload_id) != 32 or not all(c in '0123456789abcdef' for c in upload_id):
+            return None, None
+        base = os.path.join(self.root, upload_id)
+        return base + TEMP_SUFFIX, base + '.json'
+
+    def create(self, size, meta):
+        """Registers a new upload of `size` bytes; returns its id."""
+        upload_id = uuid.uuid4().hex
+        part_path, meta_path = self._paths(upload_id)
+        open(part_path, 'xb').close()
+        record = dict(meta, size=size, createdAt=time.time())
+        # Write-then-rename so a reader never sees half a metadata file
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        return upload_id
+
+    def get(self, upload_id):
+        """Metadata plus the current 'offset' and 'expiresAt', or None if unknown/expired."""
+        part_path, meta_path = self._paths(upload_id)
+        if part_path is None:
+            return None
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                record = json.load(f)
+            stat = os.stat(part_path)
+        except (FileNotFoundError, ValueError):
+            return None
+        record['offset'] = stat.st_size
+        record['expiresAt'] = max(stat.st_mtime, record['createdAt']) + self.ttl
+        return record
+
+    def append(self, upload_id, offset, stream):
+        """Writes `stream` at `offset` (must equal the current offset); returns the new offset.
+
+        Bytes received before a disconnect are kept, so the client resumes from the returned
+        (or HEAD-reported) offset instead of from zero.
+        """
+        record = self.get(upload_id)
+        if record is None:
+            raise UploadRejected('Upload not found or expired', 404)
+        part_path, _ = self._paths(upload_id)
+        with open(part_path, 'r+b') as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raise UploadRejected('Another request is writing to this upload', 423)
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise UploadRejected(f'Upload-Offset mismatch (expected {current})', 409)
+            remaining = record['size'] - current
+            f.seek(current)
+            written = 0
+            try:
+                while True:
+                    chunk = stream.read(RESUMABLE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if written + len(chunk) > remaining:
+                        raise UploadRejected('Chunk exceeds the declared upload length', 413)
+                    f.write(chunk)
+                    written += len(chunk)
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+            return current + written
+
+    def finish(self, upload_id, dest_path):
+        """Moves a complete upload to `dest_path` (atomic rename); returns (sha256, size).
+
+        Holds the same lock as append(), so of two concurrent calls one finishes the upload
+        and the other gets 409 (while it is being finished) or 404 (once it has been).
+        """
+        record = self.get(upload_id)
+        if record is None:
+            raise UploadRejected('Upload not found or expired', 404)
+        part_path, meta_path = self._paths(upload_id)
+        try:
+            f = open(part_path, 'rb')
+        except FileNotFoundError:
+            raise UploadRejected('Upload not found or expired', 404)
+        with f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raise UploadRejected('Another request is writing to or finishing this upload', 409)
+            # A request that held the lock before us may have finished (moved) this very file
+            try:
+                still_pending = os.path.exists(meta_path) and os.stat(part_path).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                still_pending = False
+            if not still_pending:
+                raise UploadRejected('Upload not found or expired', 404)
+            size = os.fstat(f.fileno()).st_size
+            if size != record['size']:
+                raise UploadRejected(f"Upload incomplete ({size}/{record['size']} bytes)", 409)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+            try:
+                os.replace(part_path, dest_path)
+            except FileNotFoundError:
+                raise UploadRejected('Upload not found or expired', 404) # Finished elsewhere (no flock here)
+            self._remove(meta_path)
+        return digest.hexdigest(), size
+
+    def delete(self, upload_id):
+        part_path, meta_path = self._paths(upload_id)
+        if part_path is None:
+            return False
+        existed = os.path.exists(meta_path)
+        self._remove(part_path)
+        self._remove(meta_path)
+        return existed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def expire(self, now=None):
+        """Deletes uploads idle for longer than the TTL; returns how many were removed."""
+        now = now or time.time()
+        removed = 0
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith('.json'):
+                continue
+            upload_id = entry.name[:-len('.json')]
+            record = self.get(upload_id)
+            if record is None or record['expiresAt'] <= now:
+                removed += int(self.delete(upload_id))
+        return removed
+
+    def start_janitor(self, interval=600):
+        """Runs expire() every `interval` seconds in a daemon thread (once per process)."""
+        if self._janitor is not None:
+            return
+        def run():
+            while True:
+                try:
+                    removed = self.expire()
+                    if removed:
+                        logger.info(f"Expired {removed} abandoned resumable uploads")
+                except Exception as e:
+                    logger.error(f"Resumable upload janitor error: {e}", exc_info=True)
+                time.sleep(interval)
+        self._janitor = threading.Thread(target=run, name='resumable-upload-janitor', daemon=True)
+        self._janitor.start()
@@ -0,0 +1,128 @@
+# backend/user_events.py
+# Per-user Server-Sent Events: things that happen to a user's data (a submission reviewed,
+# a feedback reply) are pushed to every stream that user has open, instead of each tab
+# polling the API.
+# Events go through the shared cache's pub/sub (cache.py), so with REDIS_URL set an
+# event published by any process reaches the streams held by every process. Each process
+# keeps the last few events per user so a reconnecting EventSource (Last-Event-ID) gets
+# what it missed. subscribe() gives the same events as a stream_sources() source, which is
+# how /api/events/stream carries them on one stream together with the ranking changes.
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+from ranking_stream import SSE_HEARTBEAT_INTERVAL, WakeupQueue, parse_event_ids, stream_sources
+
+logger = logging.getLogger(__name__)
+
+USER_EVENT_NAMESPACE = 'user_event' # Shared-cache pub/sub namespace
+USER_EVENT_HISTORY = 20 # Events kept per user for Last-Event-ID catch-up
+USER_EVENT_HISTORY_USERS = 5000 # Users whose history is kept (least recently active dropped)
+USER_EVENT_QUEUE_SIZE = 32 # Pending events per stream before the oldest are dropped
+
+
+class UserEventHub:
+    """Delivers events published for a user to that user's open SSE streams."""
+
+    def __init__(self, shared_cache, heartbeat_interval=SSE_HEARTBEAT_INTERVAL, queue_size=USER_EVENT_QUEUE_SIZE):
+        self._shared_cache = shared_cache
+        self.heartbeat_interval = heartbeat_interval
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._streams = {} # user id -> set of client queues
+        self._history = OrderedDict() # user id -> deque of (event id, event, payload json)
+        self._counter = 0
+        shared_cache.subscribe(self._on_message)
+
+    def _next_id(self):
+        # Millisecond clock + local counter: increasing per process, comparable across processes
+        with self._lock:
+            self._counter = (self._counter + 1) % 1000
+            return int(time.time() * 1000) * 1000 + self._counter
+
+    def publish(self, user_id, event, payload):
+        """Sends `payload` (JSON-serializable) as `event` to all streams of `user_id`, in any process."""
+        message = json.dumps({'u': str(user_id), 'id': self._next_id(), 'e': event, 'p': payload}, default=str)
+        self._shared_cache.publish(USER_EVENT_NAMESPACE, message)
+
+    def _on_message(self, namespace, key):
+        if namespace != USER_EVENT_NAMESPACE or not key:
+            return
+        message = json.loads(key)
+        user_id, item = message['u'], (message['id'], message['e'], json.dumps(message['p']))
+        with self._lock:
+            history = self._history.get(user_id)
+            if history is None:
+                history = self._history[user_id] = deque(maxlen=USER_EVENT_HISTORY)
+                while len(self._history) > USER_EVENT_HISTORY_USERS:
+                    self._history.popitem(last=False)
+            else:
+                self._history.move_to_end(user_id)
+            history.append(item)
+            client_queues = list(self._streams.get(user_id, ()))
+        for client_queue in client_queues:
+            try:
+                client_queue.put_nowait(item)
+            except queue.Full:
+                # Slow client: drop its oldest event rather than block the publisher
+                try:
+                    client_queue.get_nowait()
+                    client_queue.put_nowait(item)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def connected_users(self):
+        with self._lock:
+            return len(self._streams)
+
+    def subscribe(self, user_id, last_event_id, wakeup):
+        """Source for stream_sources(): events of `user_id` after `last_event_id` (None = only new ones)."""
+        return UserEventSubscription(self, str(user_id), last_event_id, wakeup)
+
+    def stream(self, user_id, last_event_id=None):
+        """Generator of SSE frames for one stream of `user_id`; replays kept events after `last_event_id`."""
+        wakeup = threading.Event()
+        last_id, = parse_event_ids(last_event_id, 1)
+        yield from stream_sources([self.subscribe(user_id, last_id, wakeup)], wakeup, self.heartbeat_interval)
+
+
+class UserEventSubscription:
+    """One stream's place in a user's event sequence."""
+
+    def __init__(self, hub, user_id, last_id, wakeup):
+        self._hub = hub
+        self._user_id = user_id
+        self.last_id = last_id
+        self._queue = WakeupQueue(hub.queue_size, wakeup)
+        with hub._lock:
+            hub._streams.setdefault(user_id, set()).add(self._queue)
+            # Taken together with the registration, so nothing falls between replay and live events
+            self._missed = [item for item in hub._history.get(user_id, ()) if last_id is not None and item[0] > last_id]
+
+    def catch_up(self):
+        for event_id, event, data in self._missed:
+            self.last_id = event_id
+            yield event, data
+        self._missed = []
+
+    def pending(self):
+        while True:
+            try:
+                event_id, event, data = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if self.last_id is not None and event_id <= self.last_id:
+                continue # Already replayed
+            self.last_id = event_id
+            yield event, data
+
+    def close(self):
+        with self._hub._lock:
+            streams = self._hub._streams.get(self._user_id)
+            if streams is not None:
+                streams.discard(self._queue)
+                if not streams:
+                    del self._hub._streams[self._user_id]
@@ -0,0 +1,88 @@
+# backend/video_transcode.py
+# Web renditions of video submissions.
+# Phone recordings (.mov/.avi, often 4K or HEVC) are large and frequently not playable in
+# the browser. When ffmpeg is installed, each uploaded video is re-encoded once, in a
+# background job, to a small H.264/AAC MP4 (long side at most RENDITION_MAX_SIDE, capped
+# bitrate, index at the front so playback starts before the download ends) plus a poster
+# JPEG. Renditions are keyed by the source file's SHA-256, so identical uploads share them.
+# Without ffmpeg, videos are served as uploaded.
+import logging
+import os
+import shutil
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'avi', 'webm'}
+RENDITION_NAME = 'web.mp4'
+POSTER_NAME = 'poster.jpg'
+RENDITION_MAX_SIDE = 854 # 480p for landscape video; portrait phone video is limited by its height
+RENDITION_CRF = 28
+RENDITION_MAXRATE = '1200k' # Keeps fast-moving scenes from blowing up the file
+AUDIO_BITRATE = '96k'
+POSTER_WIDTH = 640
+
+# Downscale (never upscale) to fit the box, then round to even dimensions as H.264 4:2:0 requires
+_SCALE_FILTER = (f"scale='min({RENDITION_MAX_SIDE},iw)':'min({RENDITION_MAX_SIDE},ih)':force_original_aspect_ratio=decrease,"
+                 "scale=trunc(iw/2)*2:trunc(ih/2)*2")
+
+
+class TranscodeError(RuntimeError):
+    """ffmpeg rejected the input (corrupt or unsupported file); retrying won't help."""
+
+
+def find_ffmpeg():
+    """Path of the ffmpeg binary (FFMPEG_PATH or the one on PATH), or None."""
+    return os.getenv('FFMPEG_PATH') or shutil.which('ffmpeg')
+
+
+def transcoding_supported():
+    return find_ffmpeg() is not None
+
+
+def _run_ffmpeg(args, timeout):
+    command = [find_ffmpeg(), '-hide_banner', '-loglevel', 'error', '-nostdin', '-y'] + args
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    if result.returncode != 0:
+        error = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise TranscodeError(f"ffmpeg exited with {result.returncode}: {error[-1] if error else 'no output'}")
+
+
+def render_video_rendition(source_path, renditions_dir, url_prefix, key, timeout=240):
+    """Writes the web MP4 and poster for `key` (the source SHA-256) and returns their URLs and sizes.
+
+    Result: {'url': ..., 'posterUrl': ..., 'size': rendition bytes}.
+    Files that already exist (same source uploaded before) are not rendered again.
+    A subprocess.TimeoutExpired is left to the caller (the job is retried); a TranscodeError is final.
+    """
+    if not transcoding_supported():
+        raise RuntimeError('ffmpeg is not installed')
+    target_dir = os.path.join(renditions_dir, key)
+    os.makedirs(target_dir, exist_ok=True)
+    video_path = os.path.join(target_dir, RENDITION_NAME)
+    poster_path = os.path.join(target_dir, POSTER_NAME)
+
+    # Temp names + rename: a half-written file is never served, and a killed run starts over
+    if not os.path.exists(video_path):
+        _run_ffmpeg(['-i', source_path, '-map', '0:v:0', '-map', '0:a:0?', '-vf', _SCALE_FILTER,
+                     '-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(RENDITION_CRF),
+                     '-maxrate', RENDITION_MAXRATE, '-bufsize', '2400k', '-pix_fmt', 'yuv420p',
+                     '-c:a', 'aac', '-b:a', AUDIO_BITRATE, '-ac', '2',
+                     '-movflags', '+faststart', '-f', 'mp4', f"{video_path}.tmp"], timeout)
+        os.replace(f"{video_path}.tmp", video_path)
+    if not os.path.exists(poster_path):
+        # Decoding the small rendition is much cheaper than the original; `thumbnail` skips black/blurred frames
+        _run_ffmpeg(['-i', video_path, '-vf', f"thumbnail,scale={POSTER_WIDTH}:-2", '-frames:v', '1',
+                     '-q:v', '4', '-f', 'image2', '-c:v', 'mjpeg', f"{poster_path}.tmp"], timeout)
+        os.replace(f"{poster_path}.tmp", poster_path)
+
+    return {
+        'url': f"{url_prefix}/{key}/{RENDITION_NAME}",
+        'posterUrl': f"{url_prefix}/{key}/{POSTER_NAME}",
+        'size': os.path.getsize(video_path)
+    }
+
+
+def remove_video_rendition(renditions_dir, key):
+    """Deletes the rendition for `key` (called when the source blob is garbage collected)."""
+    shutil.rmtree(os.path.join(renditions_dir, key), ignore_errors=True)
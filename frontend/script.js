@@ -9,7 +9,7 @@ const API_URL = (() => {
         return 'http://127.0.0.1:5001'; // Local development
     }
 })(); // Flask backend URL
-const RANKING_SSE_URL = `${API_URL}/api/rankings/stream`;
+const USER_EVENTS_SSE_URL = `${API_URL}/api/events/stream`;
 const MAX_AVATAR_SIZE_MB = 2;
 const MAX_SUBMISSION_SIZE_MB = 50;
 const ALLOWED_AVATAR_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif', 'webp'];
@@ -36,7 +36,12 @@ let userFeedbackList = [];
 let userNotifications = []; // Store user notifications
 let currentLanguage = 'vi';
 let isSpeechEnabled = false;
-let eventSourceRankings = null;
+let eventSourceUserEvents = null; // The tab's one live stream: ranking changes + this user's events
+let userEventsConnecting = false; // Fetching a stream ticket
+let userEventsLastId = null; // Last event id seen, so a new stream resumes after it
+let userEventsRetryTimer = null;
+const USER_EVENTS_RETRY_MS = 5 * 60 * 1000; // Retry a refused live event stream after 5 minutes
+const USER_EVENTS_RECONNECT_MS = 3000; // Reconnect (with a new ticket) after an open stream ended
 let recognition = null;
 let isRecognizing = false;
 let synthesis = window.speechSynthesis;
@@ -46,6 +51,7 @@ let teacherAnalytics = null;
 let teacherStudents = [];
 let lastRequestData = null; // Store last request data for mock responses
 let hasUnreadNotifications = false; // Track if there are unread notifications
+let notificationsNextCursor = null; // Keyset cursor for the next (older) inbox page
 
 // Mini-game questions for different levels
 const level1Questions = [
@@ -1116,6 +1122,71 @@ async function apiFetch(endpoint, options = {}) {
     }
 }
 
+// --- Resumable submission upload (backend: /api/uploads) ---
+// Large videos are sent in chunks; after a dropped connection only the missing bytes are re-sent.
+const RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024; // Use resumable uploads for files above 5MB
+const RESUMABLE_CHUNK_SIZE = 2 * 1024 * 1024;
+const RESUMABLE_MAX_RETRIES = 8;
+
+async function uploadChunkRequest(method, uploadUrl, offset, body) {
+    // Plain fetch (not apiFetch) so retries don't raise a notification per failed chunk
+    const send = () => fetch(uploadUrl, {
+        method,
+        headers: {
+            'Authorization': `Bearer ${localStorage.getItem('token')}`,
+            ...(method === 'PATCH' ? { 'Content-Type': 'application/offset+octet-stream', 'Upload-Offset': String(offset) } : {})
+        },
+        body,
+        mode: 'cors',
+        credentials: 'include'
+    });
+    let response = await send();
+    if (response.status === 401 && await refreshToken()) response = await send();
+    return response;
+}
+
+async function uploadSubmissionResumable(file, fields, onProgress) {
+    // fields: { type, relatedId, relatedTitle, note }. Resolves with the same body as POST /api/submissions.
+    const createResponse = await apiFetch('/api/uploads', {
+        method: 'POST',
+        body: JSON.stringify({ filename: file.name, size: file.size, ...fields })
+    });
+    const { uploadId } = await createResponse.json();
+    const uploadUrl = `${API_URL}/api/uploads/${uploadId}`;
+
+    let offset = 0;
+    let retries = 0;
+    while (offset < file.size) {
+        try {
+            const response = await uploadChunkRequest('PATCH', uploadUrl, offset, file.slice(offset, offset + RESUMABLE_CHUNK_SIZE));
+            if (response.status === 204) {
+                offset = parseInt(response.headers.get('Upload-Offset'), 10);
+                retries = 0;
+                if (onProgress) onProgress(offset / file.size);
+                continue;
+            }
+            if (response.status === 404 || response.status === 413) {
+                const err = await response.json().catch(() => ({}));
+                throw Object.assign(new Error(err.message || `HTTP ${response.status}`), { fatal: true });
+            }
+            throw new Error(`HTTP ${response.status}`);
+        } catch (err) {
+            if (err.fatal || ++retries > RESUMABLE_MAX_RETRIES) throw err;
+            // Back off, then ask the server how much it actually has
+            await new Promise(resolve => setTimeout(resolve, Math.min(30000, 1000 * 2 ** retries)));
+            try {
+                const head = await uploadChunkRequest('HEAD', uploadUrl);
+                if (head.ok) offset = parseInt(head.headers.get('Upload-Offset'), 10);
+            } catch (headErr) {
+                console.warn('Upload offset check failed, retrying:', headErr);
+            }
+        }
+    }
+
+    const completeResponse = await apiFetch(`/api/uploads/${uploadId}/complete`, { method: 'POST' });
+    return completeResponse.json();
+}
+
 // Mock response functions for when the API is unavailable
 async function mockFlashcardResponse(endpoint) {
     console.log('Flashcard endpoint called:', endpoint);
@@ -1653,6 +1724,7 @@ async function loadInitialData() {
             }
             await Promise.all(dataFetchPromises);
             startRankingUpdatesSSE(); // Start SSE after initial fetches complete
+            startUserEventsSSE(); // Submission review / feedback reply pushes
         } else {
             clearPersonalCoursesUI(); clearLearningPathUI(); clearUserFeedbackUI();
             renderFlashcardUI(); renderChallenge(null); renderRanking([]);
@@ -2053,7 +2125,7 @@ function logout() { console.log("Logging out..."); const uid=currentUser?._id; l
     // For backward compatibility, remove the old generic key
     localStorage.removeItem('challenge_submissions');
     localStorage.removeItem('submittedChallenges');
-    currentUser=null; courses={instruments:[],martialArts:[]}; personalCourseIds=[]; rankings=[]; appFlashcardsData={}; currentDailyChallenge=null; learningPathItems=[]; currentMiniGame=null; userFeedbackList=[]; chatbotHistory=[]; stopRankingUpdatesSSE(); if(isRecognizing)stopSpeechRecognition(); if(synthesis?.speaking)synthesis.cancel(); updateAuthUI(); clearChatbotUI(); clearGrid('instrument-grid','no-courses-available'); clearGrid('martial-grid','no-courses-available'); clearPersonalCoursesUI(); clearLearningPathUI(); clearUserFeedbackUI(); clearTeacherSubmissionsUI(); clearTeacherAnalyticsUI(); clearTeacherStudentsUI(); renderFlashcardUI(); renderRanking([]); renderChallenge(null); displayProfileLoadingOrLogin(); showNotification(getTranslation('logout-success'),'success'); resetToHomePage(); }
+    currentUser=null; courses={instruments:[],martialArts:[]}; personalCourseIds=[]; rankings=[]; appFlashcardsData={}; currentDailyChallenge=null; learningPathItems=[]; currentMiniGame=null; userFeedbackList=[]; chatbotHistory=[]; stopRankingUpdatesSSE(); userEventsLastId=null; stopSubmissionStatusPolling(); if(isRecognizing)stopSpeechRecognition(); if(synthesis?.speaking)synthesis.cancel(); updateAuthUI(); clearChatbotUI(); clearGrid('instrument-grid','no-courses-available'); clearGrid('martial-grid','no-courses-available'); clearPersonalCoursesUI(); clearLearningPathUI(); clearUserFeedbackUI(); clearTeacherSubmissionsUI(); clearTeacherAnalyticsUI(); clearTeacherStudentsUI(); renderFlashcardUI(); renderRanking([]); renderChallenge(null); displayProfileLoadingOrLogin(); showNotification(getTranslation('logout-success'),'success'); resetToHomePage(); }
 function updateAuthUI() { const l=document.getElementById('login-btn');const s=document.getElementById('signup-btn');const a=document.getElementById('user-avatar');const o=document.getElementById('logout-btn');const t=document.querySelector('a[data-section="teacher-dashboard"]');const uL=document.querySelectorAll('li > a[data-section="flashcards"], li > a[data-section="ranking"], li > a[data-section="challenges"], li > a[data-section="mini-games"], li > a[data-section="feedback"], li > a[data-section="profile"]');const cT=document.getElementById('chatbot-toggle');
     // Challenge teacher dashboard button
     const challengeTeacherActions = document.getElementById('challenge-teacher-actions');
@@ -2448,7 +2520,7 @@ async function handleAvatarUpload(e) {
 async function handleProfileEditSubmit(e){e.preventDefault();const i=document.getElementById('edit-name');const n=i?.value.trim();if(!n){showNotification(getTranslation('enter-new-name'),'error');return;}if(n===currentUser?.name){showNotification(getTranslation('name-not-changed'),'info');toggleEditProfile(false);return;}showLoading();try{const r=await apiFetch(`/api/users/${currentUser._id}`,{method:'PUT',body:JSON.stringify({name:n})});currentUser=await r.json();updateProfileUI();updateAuthUI();showNotification(getTranslation('name-changed'),'success');toggleEditProfile(false);}catch(err){console.error("Profile edit err:",err);if(err.message!==getTranslation('session-expired'))showNotification(err.message||getTranslation('update-profile-error'),'error');}finally{hideLoading();}}
 function openChangePasswordModal(){const m=document.getElementById('change-password-modal');if(m){m.querySelector('form')?.reset();m.querySelectorAll('input').forEach(i=>i.classList.remove('error'));animateModalOpen(m);}}
 function closeChangePasswordModal(){animateModalClose(document.getElementById('change-password-modal'));}
-async function handleChangePasswordSubmit(e){e.preventDefault();const m=document.getElementById('change-password-modal');const cur=m?.querySelector('#current-password');const nw=m?.querySelector('#new-password');const cnf=m?.querySelector('#confirm-password');if(!cur||!nw||!cnf)return;const curP=cur.value,newP=nw.value,cnfP=cnf.value;[cur,nw,cnf].forEach(i=>i.classList.remove('error'));let v=true,k=null;if(!curP){cur.classList.add('error');v=false;}if(!newP||newP.length<6){nw.classList.add('error');k='password-too-short';v=false;}else if(newP!==cnfP){cnf.classList.add('error');k='passwords-mismatch';v=false;}else if(curP===newP&&curP){nw.classList.add('error');k='passwords-same';v=false;}if(!v){showNotification(getTranslation(k||'check-password-fields'),'error');return;}showLoading();try{const r=await apiFetch('/api/users/change-password',{method:'POST',body:JSON.stringify({currentPassword:curP,newPassword:newP})});const d=await r.json();if(!r.ok){if(r.status===401&&d.message?.toLowerCase().includes('incorrect')){showNotification(getTranslation('current-password-incorrect'),'error');cur.classList.add('error');}else throw new Error(d.message||`HTTP ${r.status}`);}else{showNotification(getTranslation('password-changed'),'success');closeChangePasswordModal();}}catch(err){console.error("Change pw err:",err);if(err.message!==getTranslation('session-expired')&&!err.message.includes('incorrect'))showNotification(err.message||getTranslation('server-error'),'error');}finally{hideLoading();}}
+async function handleChangePasswordSubmit(e){e.preventDefault();const m=document.getElementById('change-password-modal');const cur=m?.querySelector('#current-password');const nw=m?.querySelector('#new-password');const cnf=m?.querySelector('#confirm-password');if(!cur||!nw||!cnf)return;const curP=cur.value,newP=nw.value,cnfP=cnf.value;[cur,nw,cnf].forEach(i=>i.classList.remove('error'));let v=true,k=null;if(!curP){cur.classList.add('error');v=false;}if(!newP||newP.length<6){nw.classList.add('error');k='password-too-short';v=false;}else if(newP!==cnfP){cnf.classList.add('error');k='passwords-mismatch';v=false;}else if(curP===newP&&curP){nw.classList.add('error');k='passwords-same';v=false;}if(!v){showNotification(getTranslation(k||'check-password-fields'),'error');return;}showLoading();try{const r=await apiFetch('/api/users/change-password',{method:'POST',body:JSON.stringify({currentPassword:curP,newPassword:newP})});const d=await r.json();if(!r.ok){if(r.status===401&&d.message?.toLowerCase().includes('incorrect')){showNotification(getTranslation('current-password-incorrect'),'error');cur.classList.add('error');}else throw new Error(d.message||`HTTP ${r.status}`);}else{if(d.token){localStorage.setItem('token',d.token);stopUserEventsSSE();startUserEventsSSE();}showNotification(getTranslation('password-changed'),'success');closeChangePasswordModal();}}catch(err){console.error("Change pw err:",err);if(err.message!==getTranslation('session-expired')&&!err.message.includes('incorrect'))showNotification(err.message||getTranslation('server-error'),'error');}finally{hideLoading();}}
 async function handleAvatarChange(e){const i=e.target;const f=i.files[0];if(!f)return;const x=f.name.split('.').pop().toLowerCase();if(!ALLOWED_AVATAR_EXTENSIONS.includes(x)){showNotification(getTranslation('invalid-avatar-type'),'error');i.value=null;return;}if(f.size>MAX_AVATAR_SIZE_MB*1024*1024){showNotification(getTranslation('avatar-too-large'),'error');i.value=null;return;}showLoading();try{const fd=new FormData();fd.append('avatar',f);const r=await apiFetch('/api/users/change-avatar',{method:'POST',body:fd});const d=await r.json();if(d.user)currentUser=d.user;else if(d.avatarUrl)currentUser.avatar=d.avatarUrl;updateProfileUI();updateAuthUI();showNotification(getTranslation('avatar-changed'),'success');}catch(err){console.error("Avatar upload err:",err);if(err.message!==getTranslation('session-expired'))showNotification(err.message||getTranslation('avatar-upload-error'),'error');}finally{hideLoading();i.value=null;}}
 
 // --- Courses & Learning ---
@@ -3052,27 +3124,104 @@ async function fetchInitialRankings() {
     }
 }
 function startRankingUpdatesSSE() {
+    // Ranking changes arrive on the tab's live event stream, together with this user's own events
     if (!currentUser) { updateSSEStatus('disconnected', getTranslation('please-login-ranking')); return; }
-    if (eventSourceRankings && eventSourceRankings.readyState !== EventSource.CLOSED) return; // Already running
-    console.log("SSE: Initializing..."); updateSSEStatus('connecting', getTranslation('connecting'));
-    const token = localStorage.getItem('token'); if (!token) { updateSSEStatus('error', getTranslation('token-missing')); logout(); return; }
+    startUserEventsSSE();
+}
+function stopRankingUpdatesSSE() { stopUserEventsSSE(); }
+// --- Live event stream: one per tab (ranking update/delta + submission reviews, feedback replies, notifications) ---
+async function startUserEventsSSE() {
+    if (!currentUser || typeof EventSource === 'undefined') return;
+    if (userEventsConnecting || (eventSourceUserEvents && eventSourceUserEvents.readyState !== EventSource.CLOSED)) return; // Already running
+    userEventsConnecting = true;
+    updateSSEStatus('connecting', getTranslation('connecting'));
+    let ticket = null;
     try {
-        eventSourceRankings = new EventSource(`${RANKING_SSE_URL}?token=${encodeURIComponent(token)}`);
-        eventSourceRankings.onopen = () => { console.log("SSE: Connected."); updateSSEStatus('connected', getTranslation('ranking-stream-connected')); };
-        // NOTE: This listener waits for 'update' events.
-        // Your CURRENT backend `/api/rankings/stream` only sends 'connected'.
-        // You MUST modify the backend to periodically send 'update' events with new ranking data for this to work.
-        eventSourceRankings.addEventListener('update', (e) => {
-            console.log("SSE: Received 'update' event from backend.");
-            try {
-                rankings = JSON.parse(e.data);
-                if (document.getElementById('ranking')?.style.display !== 'none') renderRanking(rankings);
-            } catch (err) { console.error("SSE Parse err:", err); }
-        });
-        eventSourceRankings.onerror = (err) => { console.error("SSE Error:", err); updateSSEStatus('error', getTranslation('ranking-stream-error')); stopRankingUpdatesSSE(); /* Consider reconnect */ };
-    } catch (e) { console.error("SSE Create failed:", e); updateSSEStatus('error', getTranslation('ranking-stream-error')); }
+        // The stream URL carries a short-lived ticket instead of the session token (URLs end up in logs)
+        const response = await apiFetch('/api/events/ticket', { method: 'POST' });
+        if (response.ok) ticket = (await response.json()).ticket;
+    } catch (err) { console.error("Stream ticket err:", err); }
+    userEventsConnecting = false;
+    if (!currentUser) return; // Logged out meanwhile
+    if (!ticket) { fallBackToStatusPolling(); return; }
+    const params = new URLSearchParams({ ticket, rankings: '1' });
+    if (userEventsLastId) params.set('lastEventId', userEventsLastId); // Resume where the previous stream stopped
+    const source = eventSourceUserEvents = new EventSource(`${USER_EVENTS_SSE_URL}?${params}`);
+    let opened = false;
+    const on = (event, handler) => source.addEventListener(event, (e) => {
+        if (e.lastEventId) userEventsLastId = e.lastEventId;
+        try { handler(JSON.parse(e.data)); } catch (err) { console.error(`Live event '${event}' err:`, err); }
+    });
+    // 'update' carries the full ranking list, 'delta' only rows whose rank/data changed plus removed userIds
+    on('update', (rows) => {
+        rankings = rows;
+        if (document.getElementById('ranking')?.style.display !== 'none') renderRanking(rankings);
+    });
+    on('delta', (delta) => {
+        const byUser = new Map((rankings || []).map(r => [r.userId, r]));
+        (delta.removed || []).forEach(id => byUser.delete(id));
+        (delta.changed || []).forEach(row => byUser.set(row.userId, row));
+        rankings = Array.from(byUser.values()).sort((a, b) => (a.rank || 0) - (b.rank || 0));
+        if (document.getElementById('ranking')?.style.display !== 'none') renderRanking(rankings);
+    });
+    on('submission', applySubmissionStatusEvent);
+    on('notification', applyNotificationEvent);
+    on('feedback', (reply) => {
+        const item = Array.isArray(userFeedbackList) ? userFeedbackList.find(fb => fb._id === reply._id) : null;
+        if (item) { Object.assign(item, reply); renderUserFeedbackList(userFeedbackList); }
+        showNotification(`${getTranslation('replied')}: ${reply.reply || ''}`, 'info', 7000);
+    });
+    source.onopen = () => {
+        opened = true;
+        stopSubmissionStatusPolling();
+        updateSSEStatus('connected', getTranslation('ranking-stream-connected'));
+    };
+    // EventSource reconnects on its own after a dropped connection. It gives up on an error response:
+    // after the stream had been open that is usually its expired ticket, so reconnect with a new one;
+    // a stream refused from the start (503 at the server's stream limit) falls back to polling
+    source.onerror = () => {
+        if (source !== eventSourceUserEvents) return;
+        if (source.readyState !== EventSource.CLOSED) { updateSSEStatus('connecting', getTranslation('connecting')); return; }
+        stopUserEventsSSE();
+        if (opened) userEventsRetryTimer = setTimeout(() => { userEventsRetryTimer = null; startUserEventsSSE(); }, USER_EVENTS_RECONNECT_MS);
+        else fallBackToStatusPolling();
+    };
+}
+function fallBackToStatusPolling() {
+    updateSSEStatus('error', getTranslation('ranking-stream-error'));
+    startSubmissionStatusPolling();
+    if (userEventsRetryTimer) clearTimeout(userEventsRetryTimer);
+    userEventsRetryTimer = setTimeout(() => { userEventsRetryTimer = null; startUserEventsSSE(); }, USER_EVENTS_RETRY_MS);
+}
+function stopUserEventsSSE() {
+    if (userEventsRetryTimer) { clearTimeout(userEventsRetryTimer); userEventsRetryTimer = null; }
+    if (eventSourceUserEvents) {
+        eventSourceUserEvents.close(); eventSourceUserEvents = null;
+        updateSSEStatus('disconnected', getTranslation('ranking-stream-disconnected'));
+    }
+}
+function applySubmissionStatusEvent(update) {
+    if (!currentUser) return;
+    if (!Array.isArray(currentUser.challenge_submissions)) currentUser.challenge_submissions = [];
+    const submissions = currentUser.challenge_submissions;
+    const existing = submissions.find(sub => sub._id === update._id);
+    if (existing && existing.status === update.status) return; // Already applied (replayed after a reconnect)
+    if (existing) Object.assign(existing, update);
+    else if (update.type === 'challenge') submissions.unshift({ ...update, userId: currentUser._id });
+    localStorage.setItem(`challenge_submissions_${currentUser._id}`, JSON.stringify(submissions));
+
+    if (update.status === 'approved') {
+        showNotification(`${getTranslation('challenge')} "${update.relatedTitle}" ${getTranslation('approved')}! +${update.pointsAwarded} ${getTranslation('points')}`, 'success', 7000);
+        updateChallengeStats();
+    } else if (update.status === 'rejected') {
+        showNotification(`${getTranslation('challenge')} "${update.relatedTitle}" ${getTranslation('rejected')}. ${update.teacherComment || ''}`, 'warning', 7000);
+    }
+    const challengesSection = document.getElementById('challenges');
+    if (challengesSection && challengesSection.style.display !== 'none') {
+        renderChallenge(currentDailyChallenge);
+        updateSubmissionHistoryItems();
+    }
 }
-function stopRankingUpdatesSSE() { if (eventSourceRankings) { eventSourceRankings.close(); eventSourceRankings = null; console.log("SSE: Closed."); updateSSEStatus('disconnected', getTranslation('ranking-stream-disconnected')); } }
 function updateSSEStatus(statusType, message) { /* Status indicator removed */ console.log(`SSE Status: ${statusType} - ${message}`); }
 function renderRanking(data = rankings) {
     const list = document.getElementById('ranking-list');
@@ -3306,11 +3455,13 @@ function createEnhancedTeacherFeedbackItem(s) {
 
     let preview = '';
     const ext = s.url?.split('.').pop().toLowerCase();
+    // Videos with a web rendition are served as a small MP4 at the same URL (see serve_submission)
+    const rendition = s.rendition?.status === 'ready' ? s.rendition : null;
 
     // Hiển thị thông tin file gốc và nút tải xuống
     preview = `<div class="submission-file-info">
         <p><strong>File:</strong> ${originalFilename}</p>
-        <p><a href="${url}" download="${originalFilename}" class="download-btn"><i class="fas fa-download"></i> Tải xuống file</a></p>
+        <p><a href="${rendition ? `${url}?original=1` : url}" download="${originalFilename}" class="download-btn"><i class="fas fa-download"></i> Tải xuống file</a></p>
     </div>`;
 
     // Hiển thị hình ảnh hoặc video trực tiếp với cách đơn giản hơn
@@ -3322,8 +3473,8 @@ function createEnhancedTeacherFeedbackItem(s) {
     } else if (['mp4', 'webm', 'mov', 'avi'].includes(ext)) {
         // Hiển thị video
         preview += `<div class="video-container">
-            <video controls class="feedback-video">
-                <source src="${url}" type="video/${ext === 'mov' ? 'mp4' : ext}">
+            <video controls preload="metadata" class="feedback-video"${rendition?.posterUrl ? ` poster="${API_URL.replace(/\/$/, '')}${rendition.posterUrl}"` : ''}>
+                <source src="${url}" type="video/${rendition || ext === 'mov' ? 'mp4' : ext}">
                 ${getTranslation('video-not-supported')}
             </video>
         </div>`;
@@ -3499,11 +3650,13 @@ function createTeacherFeedbackItem(s) {
 
     let preview = '';
     const ext = s.url?.split('.').pop().toLowerCase();
+    // Videos with a web rendition are served as a small MP4 at the same URL (see serve_submission)
+    const rendition = s.rendition?.status === 'ready' ? s.rendition : null;
 
     // Hiển thị thông tin file gốc và nút tải xuống
     preview = `<div class="submission-file-info">
         <p><strong>File:</strong> ${originalFilename}</p>
-        <p><a href="${url}" download="${originalFilename}" class="download-btn"><i class="fas fa-download"></i> Tải xuống file</a></p>
+        <p><a href="${rendition ? `${url}?original=1` : url}" download="${originalFilename}" class="download-btn"><i class="fas fa-download"></i> Tải xuống file</a></p>
     </div>`;
 
     // Hiển thị hình ảnh hoặc video trực tiếp với cách đơn giản hơn
@@ -3515,8 +3668,8 @@ function createTeacherFeedbackItem(s) {
     } else if (['mp4', 'webm', 'mov', 'avi'].includes(ext)) {
         // Hiển thị video
         preview += `<div class="video-container">
-            <video controls class="feedback-video">
-                <source src="${url}" type="video/${ext === 'mov' ? 'mp4' : ext}">
+            <video controls preload="metadata" class="feedback-video"${rendition?.posterUrl ? ` poster="${API_URL.replace(/\/$/, '')}${rendition.posterUrl}"` : ''}>
+                <source src="${url}" type="video/${rendition || ext === 'mov' ? 'mp4' : ext}">
                 ${getTranslation('video-not-supported')}
             </video>
         </div>`;
@@ -5012,15 +5165,20 @@ async function initChallenges() {
     // Load challenge history
     await loadChallengeHistory();
 
-    // Set up periodic submission status check (every 2 minutes)
-    if (currentUser) {
-        console.log('Setting up periodic submission status check');
-        // Initial check after 30 seconds
-        setTimeout(checkSubmissionStatusUpdates, 30000);
-        // Then check every 2 minutes
-        setInterval(checkSubmissionStatusUpdates, 120000);
-    }
+    // Status changes are pushed over the user event stream; poll only where EventSource is unavailable
+    if (currentUser && typeof EventSource === 'undefined') startSubmissionStatusPolling();
+}
+// Fallback when the user event stream is unavailable (no EventSource, or the server is at its stream limit)
+let submissionStatusPollTimer = null;
+function startSubmissionStatusPolling() {
+    if (submissionStatusPollTimer) return;
+    console.log('Setting up periodic submission status check');
+    // Initial check after 30 seconds
+    setTimeout(checkSubmissionStatusUpdates, 30000);
+    // Then check every 2 minutes
+    submissionStatusPollTimer = setInterval(checkSubmissionStatusUpdates, 120000);
 }
+function stopSubmissionStatusPolling() { if (submissionStatusPollTimer) { clearInterval(submissionStatusPollTimer); submissionStatusPollTimer = null; } }
 function updateChallengeTimer() {
     const timerEl = document.getElementById('challenge-timer');
     if (!timerEl) return;
@@ -6546,13 +6704,22 @@ async function handleChallengeSubmit(e) {
         formData.append('userId', currentUser._id);
 
         try {
-            // Gọi API để tạo submission mới
-            const response = await apiFetch('/api/submissions', {
-                method: 'POST',
-                body: formData
-            });
-
-            const result = await response.json();
+            // Gọi API để tạo submission mới (large files go through the resumable upload API)
+            let result;
+            if (file.size > RESUMABLE_UPLOAD_THRESHOLD) {
+                result = await uploadSubmissionResumable(file, {
+                    type: 'challenge',
+                    relatedId: currentDailyChallenge._id,
+                    relatedTitle: currentDailyChallenge.title || 'Daily Challenge',
+                    note: note
+                });
+            } else {
+                const response = await apiFetch('/api/submissions', {
+                    method: 'POST',
+                    body: formData
+                });
+                result = await response.json();
+            }
             console.log('Submission created successfully on server:', result);
 
             // Update the user's challenge_submissions array with the new submission
@@ -8300,15 +8467,18 @@ async function sendChatMessage(messageOverride=null) {
             history: historyToSend
         };
 
-        // First try to get a response from the Gemini API
+        // First try to get a response from the Gemini API: streamed while it is written, else in one piece
         try {
-            const r = await apiFetch('/api/chat', {
-                method: 'POST',
-                body: JSON.stringify(payload)
-            });
+            let botReply = await streamChatToBubble(payload);
+            if (!botReply) {
+                const r = await apiFetch('/api/chat', {
+                    method: 'POST',
+                    body: JSON.stringify(payload)
+                });
 
-            const d = await r.json();
-            const botReply = d.reply || null;
+                const d = await r.json();
+                botReply = d.reply || null;
+            }
 
             if (botReply) {
                 // Add suggested questions based on the response
@@ -8358,6 +8528,74 @@ async function sendChatMessage(messageOverride=null) {
     }
 }
 
+// Reads the chatbot reply from /api/chat/stream (Server-Sent Events over fetch), calling onText(textSoFar)
+// per chunk. Resolves with the full reply, or null when the stream is unavailable.
+async function streamChatReply(payload, onText) {
+    const token = localStorage.getItem('token');
+    const response = await fetch(`${API_URL}/api/chat/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', ...(token ? { 'Authorization': `Bearer ${token}` } : {}) },
+        body: JSON.stringify(payload)
+    });
+    if (!response.ok || !response.body || !(response.headers.get('Content-Type') || '').includes('text/event-stream')) {
+        return null;
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let reply = '';
+    let note = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const event = (frame.match(/^event: (.*)$/m) || [])[1] || 'message';
+            const data = (frame.match(/^data: (.*)$/m) || [])[1];
+            if (!data) continue;
+            const parsed = JSON.parse(data);
+            if (event === 'message' && parsed.text) {
+                reply += parsed.text;
+                onText(reply);
+            } else if (event === 'done') {
+                note = parsed.note || '';
+            } else if (event === 'error') {
+                throw new Error(parsed.reply);
+            }
+        }
+    }
+    return reply ? reply + note : null;
+}
+
+// Shows the reply in a plain bot bubble while it streams; the bubble is removed afterwards so the
+// caller can append the formatted message. Resolves with the reply, or null to use /api/chat instead.
+async function streamChatToBubble(payload) {
+    const body = document.getElementById('chatbot-body');
+    let bubble = null;
+    try {
+        return await streamChatReply(payload, text => {
+            if (!bubble && body) {
+                bubble = document.createElement('div');
+                bubble.classList.add('chat-message', 'bot-message');
+                bubble.innerHTML = '<div class="message-avatar"><i class="fas fa-robot"></i></div><div class="message-content-wrapper"><div class="message-content"><p></p></div></div>';
+                body.appendChild(bubble);
+            }
+            if (bubble) {
+                bubble.querySelector('.message-content p').textContent = text;
+                body.scrollTop = body.scrollHeight;
+            }
+        });
+    } catch (streamError) {
+        console.warn("Chat stream failed, retrying without streaming:", streamError);
+        return null;
+    } finally {
+        bubble?.remove();
+    }
+}
+
 // Helper functions for the enhanced chatbot
 function normalizeQuestion(question) {
     return question.toLowerCase().trim().replace(/\s+/g, ' ');
@@ -8513,23 +8751,12 @@ async function fetchUserNotifications() {
     console.log("Fetching user notifications...");
 
     try {
-        // Use mock data instead of making an API call to avoid CORS issues
-        // const r = await apiFetch('/api/notifications');
-        // userNotifications = await r.json();
-
-        // Mock data
-        userNotifications = [
-            {
-                _id: 'mock1',
-                type: 'system',
-                message: 'Welcome to FPT Learning Hub!',
-                read: false,
-                createdAt: new Date().toISOString()
-            }
-        ];
-
-        hasUnreadNotifications = userNotifications.some(notification => !notification.read);
-        updateNotificationBadge();
+        // First (newest) page; older pages via fetchMoreNotifications()
+        const r = await apiFetch('/api/notifications?limit=20', { useCache: false });
+        const data = await r.json();
+        userNotifications = data.notifications || [];
+        notificationsNextCursor = data.nextCursor;
+        setUnreadNotificationCount(data.unreadCount);
     } catch (err) {
         console.error("Fetch notifications err:", err);
         if (err.message !== getTranslation('session-expired')) {
@@ -8538,6 +8765,35 @@ async function fetchUserNotifications() {
     }
 }
 
+async function fetchMoreNotifications() {
+    if (!currentUser || !notificationsNextCursor) return;
+    try {
+        const r = await apiFetch(`/api/notifications?limit=20&cursor=${encodeURIComponent(notificationsNextCursor)}`, { useCache: false });
+        const data = await r.json();
+        userNotifications = userNotifications.concat(data.notifications || []);
+        notificationsNextCursor = data.nextCursor;
+        setUnreadNotificationCount(data.unreadCount);
+        renderNotifications();
+    } catch (err) {
+        console.error("Fetch more notifications err:", err);
+    }
+}
+
+// The server keeps the unread total, so the badge never depends on which pages are loaded
+function setUnreadNotificationCount(count) {
+    hasUnreadNotifications = (count || 0) > 0;
+    updateNotificationBadge();
+}
+
+// Pushed by the user event stream when a new notification is created
+function applyNotificationEvent(event) {
+    if (!event || !event.notification) return;
+    if (!userNotifications.some(n => n._id === event.notification._id)) userNotifications.unshift(event.notification);
+    setUnreadNotificationCount(event.unreadCount);
+    const panel = document.getElementById('notifications-panel');
+    if (panel && panel.classList.contains('open')) renderNotifications();
+}
+
 function updateNotificationBadge() {
     const badge = document.getElementById('notification-badge');
     if (!badge) return;
@@ -8598,15 +8854,13 @@ async function handleMarkNotificationAsRead(e) {
     if (!notificationId) return;
 
     try {
-        // Mock API call to avoid CORS issues
-        // const r = await apiFetch(`/api/notifications/${notificationId}/read`, {
-        //     method: 'PUT'
-        // });
-
-        // Simulate successful response
-        const mockResponse = { ok: true };
+        const r = await apiFetch('/api/notifications/read', {
+            method: 'POST',
+            body: JSON.stringify({ ids: [notificationId] })
+        });
+        const result = await r.json();
 
-        if (mockResponse.ok) {
+        if (r.ok) {
             // Update local notification data
             const notification = userNotifications.find(n => n._id === notificationId);
             if (notification) {
@@ -8621,9 +8875,7 @@ async function handleMarkNotificationAsRead(e) {
                 btn.remove();
             }
 
-            // Check if all notifications are read
-            hasUnreadNotifications = userNotifications.some(notification => !notification.read);
-            updateNotificationBadge();
+            setUnreadNotificationCount(result.unreadCount);
         }
     } catch (err) {
         console.error("Mark notification as read error:", err);